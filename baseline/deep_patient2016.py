@@ -12,7 +12,6 @@ encoder: two layers of autoencoder
 
 import pickle
 import sys
-import json
 import os
 
 import torch
@@ -23,6 +22,11 @@ from gensim.models import LdaModel
 import numpy as np
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from lda_topics import user_topics
+from token_corpus import open_token_corpus
+
 
 class AE(nn.Module):
     def __init__(self, input_size, hidden_size):
@@ -84,10 +88,12 @@ class Lda2User(object):
             self.ae.load_state_dict(torch.load(self.ae_path), strict=False)
 
     def train_autoencoder(self):
+        # averaged topic vectors are dense, they stay in a dense dataset
         user_features = list(self.lda2user().values())
-        user_features = TensorDataset(torch.FloatTensor(user_features))
+        user_features = TensorDataset(torch.FloatTensor(np.asarray(user_features)))
         user_features = DataLoader(user_features, batch_size=32, shuffle=True)
 
+        self.ae.to(self.device)
         optimizer = torch.optim.SGD(self.ae.parameters(), lr=.001)
         criterion = torch.nn.BCELoss().to(self.device)
         self.ae.train()
@@ -95,8 +101,7 @@ class Lda2User(object):
         for _ in tqdm(range(10)):
             for idx, batch in enumerate(user_features):
                 optimizer.zero_grad()
-                batch = batch[0]
-                batch.to(self.device)
+                batch = batch[0].to(self.device)
                 output, _ = self.ae(batch)  # omit encoded features
                 loss = criterion(output, batch)
                 loss.backward()
@@ -113,44 +118,22 @@ class Lda2User(object):
             mode: str
                 Methods to combine document representations
         """
-        item_dict = dict()
-
         print('Loading Data')
-        with open(self.data_path) as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                if user['uid'] not in item_dict:
-                    item_dict[user['uid']] = []
-                for doc_entity in user['docs']:
-                    # collect data
-                    if mode == 'average':
-                        item_dict[user['uid']].append(doc_entity['text'].split())
-                    else:
-                        if len(item_dict[user['uid']]) == 0:
-                            item_dict[user['uid']].append(doc_entity['text'].split())
-                        else:
-                            item_dict[user['uid']][0].extend(doc_entity['text'].split())
-
-        for uid in list(item_dict.keys()):
-            # encode the document by lda
-            for idx, doc in enumerate(item_dict[uid]):
-                output = self.model[self.dictionary.doc2bow(doc)]
-                item_dict[uid][idx] = [0.] * self.model.num_topics
-                for item in output:
-                    item_dict[uid][idx][item[0]] = item[1]
-            # average the lda inferred documents
-            item_dict[uid] = np.mean(item_dict[uid], axis=0)
-
-        return item_dict
+        corpus = open_token_corpus(self.data_path)
+        # topics of all documents are inferred by chunks and averaged by the users
+        uids, user_features, found = user_topics(self.model, self.dictionary, corpus, mode=mode)
+        return dict((uid, user_features[idx]) for idx, uid in enumerate(uids) if found[idx])
 
     def inference(self, user_features=None):
+        self.ae.to(self.device)
         self.ae.eval()
-        if not user_features:
-            user_features = self.lda2user()
+        if user_features is None:
+            user_features = list(self.lda2user().values())
         if not torch.is_tensor(user_features):
-            user_features = torch.FloatTensor(user_features)
+            user_features = torch.FloatTensor(np.asarray(user_features))
 
-        _, user_embs = self.ae(user_features)
+        with torch.no_grad():
+            _, user_embs = self.ae(user_features.to(self.device))
         user_embs = user_embs.cpu().detach().numpy()
         return user_embs
 
@@ -171,8 +154,6 @@ if __name__ == '__main__':
     if not os.path.exists(odir):
         os.mkdir(odir)
 
-    opath_user = odir + 'user.txt'
-
     dict_path = task_dir + 'lda_dict.pkl'
     model_path = task_dir + 'lda.model'
     autoencoder_path = odir + 'ae_model.pth'
@@ -189,13 +170,12 @@ if __name__ == '__main__':
     )
 
     # user vectors
-    user_topics = l2u.lda2user(mode='average')
-    ufeatures = l2u.inference(list(user_topics.values()))
-    user_topics = dict(zip(list(user_topics.keys()), ufeatures))
-
-    # write to file
-    wfile = open(opath_user, 'w')
-    for tid in list(user_topics.keys()):
-        wfile.write(tid + '\t' + ' '.join(map(str, user_topics[tid])) + '\n')
-    wfile.flush()
-    wfile.close()
+    user_features = l2u.lda2user(mode='average')
+    ufeatures = l2u.inference(list(user_features.values()))
+    user_vectors = dict(zip(list(user_features.keys()), ufeatures))
+
+    # write to the store
+    writer = UserEmbWriter(odir, 'deeppatient2user', '../data/processed_data/{}/user_encoder.json'.format(task))
+    for tid in list(user_vectors.keys()):
+        writer.add(tid, user_vectors[tid])
+    writer.close()
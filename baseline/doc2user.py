@@ -6,39 +6,60 @@ Patient representation learning and interpretable evaluation using clinical note
 """
 
 from gensim.models.doc2vec import Doc2Vec
+from multiprocessing import Pool
 import sys
 import os
 import json
+import time
 import numpy as np
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+
+# Doc2Vec model of the worker processes
+worker_model = None
+
+
+def init_worker(mpath):
+    """Load the model memory-mapped, the workers share the pages of the arrays"""
+    global worker_model
+    worker_model = Doc2Vec.load(mpath, mmap='r')
+
+
+def infer_user(item):
+    """Mean of the inferred vectors of the documents of a user"""
+    tid, docs = item
+    return tid, np.mean(np.asarray([worker_model.infer_vector(doc) for doc in docs]), axis=0), len(docs)
 
 
 class Doc2User(object):
-    def __init__(self, task, mpath):
+    def __init__(self, task, mpath, num_workers=1):
         """Apply Doc2Vec model on the documents to generate user and product representation.
-            Outputs will be one user/product_id + vect per line.
+            Outputs will be saved into the user embedding store.
 
             Parameters
             ----------
             task: str
                 Task name, such as amazon, yelp and imdb
             mpath: str
-                Path of LDA model file
+                Path of Doc2Vec model file
+            num_workers: int
+                Number of inference processes, 1 to infer in the current process
         """
         self.task = task
-        self.model = Doc2Vec.load(mpath)
-        self.model.delete_temporary_training_data(
-            keep_doctags_vectors=True, keep_inference=True)
+        self.mpath = mpath
+        self.num_workers = num_workers
 
-    def doc2item(self, data_path, opath, mode='average'):
+    def doc2item(self, data_path, writer, mode='average'):
         """Extract user vectors from the given data path
 
         :param data_path:
-        :param opath:
+        :param writer: UserEmbWriter of the user embedding store
         :param mode:
         :return:
         """
         item_dict = dict()
-        ofile = open(opath, 'w')
 
         print('Loading Data')
         with open(data_path) as dfile:
@@ -60,22 +81,32 @@ class Doc2User(object):
                         else:
                             item_dict[tid][0].extend(text.split())
 
-        for tid in list(item_dict.keys()):
-            print('Working on user: ', tid)
-            # encode the document by doc2vec
-            item_dict[tid] = np.asarray([
-                self.model.infer_vector(doc) for doc in item_dict[tid]
-            ])
-            # average the lda inferred documents
-            item_dict[tid] = np.mean(item_dict[tid], axis=0)
-
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(str, item_dict[tid])) + '\n')
-
-            # save memory
-            del item_dict[tid]
-        ofile.flush()
-        ofile.close()
+        # users are inferred by the workers, results come back in the user order for the single writer
+        num_docs = 0
+        start = time.time()
+        if self.num_workers > 1:
+            pool = Pool(self.num_workers, initializer=init_worker, initargs=(self.mpath,))
+            results = pool.imap(infer_user, item_dict.items(), chunksize=16)
+        else:
+            pool = None
+            init_worker(self.mpath)
+            results = map(infer_user, item_dict.items())
+
+        try:
+            for tid, user_vector, user_num_docs in tqdm(results, total=len(item_dict), desc='Inferring users'):
+                # write to the store
+                writer.add(tid, user_vector)
+                num_docs += user_num_docs
+        finally:
+            # all results are received, or a worker failed and the rest is dropped
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = max(time.time() - start, 1e-6)
+        print('Inferred {} documents of {} users in {:.1f}s, {:.1f} documents/s'.format(
+            num_docs, len(item_dict), elapsed, num_docs / elapsed))
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -94,13 +125,13 @@ if __name__ == '__main__':
     odir = task_dir + 'doc2user/'
     if not os.path.exists(odir):
         os.mkdir(odir)
-    opath_user = odir + 'user.txt'
     model_path = task_dir + 'doc2v.model'
 
     # Doc2User
-    d2u = Doc2User(dname, model_path)
+    d2u = Doc2User(dname, model_path, num_workers=os.cpu_count() // 2)
     # user vectors
     d2u.doc2item(
         data_path=task_data_path, 
-        opath=opath_user
+        writer=UserEmbWriter(
+            odir, 'doc2user', '../data/processed_data/{}/user_encoder.json'.format(dname))
     )
@@ -6,15 +6,18 @@ PostLDA-Doc
 """
 from gensim.models import LdaModel
 import pickle
-import numpy as np
 import sys
-import json
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from lda_topics import user_topics
+from token_corpus import open_token_corpus
+
 
 class Lda2User(object):
     """Apply LDA model on the documents to generate user and product representation.
-        Outputs will be one user/product_id + vect per line.
+        Outputs will be saved into the user embedding store.
 
         Parameters
         ----------
@@ -30,54 +33,28 @@ class Lda2User(object):
         self.dictionary = pickle.load(open(dictionary_path, 'rb'))
         self.model = LdaModel.load(mpath)
 
-    def lda2item(self, data_path, opath, mode='average'):
+    def lda2item(self, data_path, writer, mode='average'):
         """Extract user vectors from the given data path
 
             Parameters
             ----------
             data_path: str
-                Path of data file, tsv file
-            opath: str
-                Path of output path for user vectors
+                Path of data file, json file
+            writer: UserEmbWriter
+                Writer of the user embedding store
             mode: str
                 Methods to combine document representations
         """
-        item_dict = dict()
-        ofile = open(opath, 'w')
-
         print('Loading Data')
-        with open(data_path) as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                if user['uid'] not in item_dict:
-                    item_dict[user['uid']] = []
-                for doc_entity in user['docs']:
-                    # collect data
-                    if mode == 'average':
-                        item_dict[user['uid']].append(doc_entity['text'].split())
-                    else:
-                        if len(item_dict[user['uid']]) == 0:
-                            item_dict[user['uid']].append(doc_entity['text'].split())
-                        else:
-                            item_dict[user['uid']][0].extend(doc_entity['text'].split())
-
-        for tid in list(item_dict.keys()):
-            # encode the document by lda
-            for idx, doc in enumerate(item_dict[tid]):
-                output = self.model[self.dictionary.doc2bow(doc)]
-                item_dict[tid][idx] = [0.] * self.model.num_topics
-                for item in output:
-                    item_dict[tid][idx][item[0]] = item[1]
-            # average the lda inferred documents
-            item_dict[tid] = np.mean(item_dict[tid], axis=0)
+        corpus = open_token_corpus(data_path)
+        # topics of all documents are inferred by chunks and averaged by the users
+        uids, item_embs, found = user_topics(self.model, self.dictionary, corpus, mode=mode)
 
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(str, item_dict[tid])) + '\n')
-
-            # save memory
-            del item_dict[tid]
-        ofile.flush()
-        ofile.close()
+        # write to the store, users without documents are left missing
+        for idx, tid in enumerate(uids):
+            if found[idx]:
+                writer.add(tid, item_embs[idx])
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -96,8 +73,6 @@ if __name__ == '__main__':
     if not os.path.exists(odir):
         os.mkdir(odir)
 
-    opath_user = odir + 'user.txt'
-
     dict_path = task_dir + 'lda_dict.pkl'
     model_path = task_dir + 'lda.model'
 
@@ -106,6 +81,7 @@ if __name__ == '__main__':
     # user vectors
     l2u.lda2item(
         data_path=task_data_path, 
-        opath=opath_user,
+        writer=UserEmbWriter(
+            odir, 'lda2user', '../data/processed_data/{}/user_encoder.json'.format(task)),
         mode='average'
     )
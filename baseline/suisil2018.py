@@ -10,7 +10,6 @@ import os
 
 import torch
 from torch import nn as nn
-from torch.utils.data import TensorDataset
 from torch.utils.data.dataloader import DataLoader
 
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -21,6 +20,11 @@ from tqdm import tqdm
 
 from baseline_utils import train_doc2v
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from concept_store import open_concept_store
+from sparse_batches import CSRDataset, sparse_dropout, sparse_linear, to_sparse_tensor
+
 
 def dummy_func(doc):
     if type(doc) == str:
@@ -32,14 +36,12 @@ def get_tfidf_vect(task_name, concept_directory, save_dir):
     opath = os.path.join(save_dir, 'tfidf_vect_{}.pkl'.format(task_name))
     if os.path.exists(opath):
         return opath
-    flist = os.listdir(concept_directory)
     user_concepts = dict()
 
-    for fname in flist:
-        uid = fname.split('_')[0]
+    for doc_key, concepts in open_concept_store(concept_directory).iter_docs():
+        uid = doc_key.split('_')[0]
         if uid not in user_concepts:
             user_concepts[uid] = []
-        concepts = pickle.load(open(concept_directory + fname, 'rb'))
         user_concepts[uid].extend([concept['preferred_name'].lower() for concept in concepts])
 
     tfidf_vect = TfidfVectorizer(tokenizer=dummy_func, preprocessor=dummy_func, max_features=10000)
@@ -67,8 +69,11 @@ class AE(nn.Module):
         self.dp = nn.Dropout(0.05)
 
     def forward(self, topics):
-        features = self.dp(topics)
-        features = self.encoder_hidden_layer(features)
+        # sparse inputs are multiplied by the first layer without densifying
+        if topics.is_sparse:
+            features = sparse_linear(sparse_dropout(topics, self.dp), self.encoder_hidden_layer)
+        else:
+            features = self.encoder_hidden_layer(self.dp(topics))
         features = torch.sigmoid(features)
         code_features = self.encoder_output_layer(features)
         code_features = torch.sigmoid(code_features)
@@ -105,29 +110,29 @@ class Doc2User(object):
     def train_autoencoder(self):
         user_concepts = dict()
         # load concepts
-        flist = os.listdir(self.concept_dir)
-        for fname in flist:
-            uid = fname.split('_')[0]
+        for doc_key, concepts in open_concept_store(self.concept_dir).iter_docs():
+            uid = doc_key.split('_')[0]
             if uid not in user_concepts:
                 user_concepts[uid] = []
-            concepts = pickle.load(open(self.concept_dir + fname, 'rb'))
             user_concepts[uid].extend([concept['preferred_name'].lower() for concept in concepts])
 
-        user_features = self.tf_idf_vect.transform(
+        # users x concepts CSR matrix, rows are densified per batch
+        user_features = CSRDataset(self.tf_idf_vect.transform(
             list(user_concepts.values())
-        ).toarray()
-        user_features = TensorDataset(torch.FloatTensor(user_features))
-        user_features = DataLoader(user_features, batch_size=32, shuffle=True)
+        ))
+        user_features = DataLoader(
+            user_features, batch_size=32, shuffle=True, collate_fn=user_features.collate)
 
+        self.ae.to(self.device)
         optimizer = torch.optim.Adam(self.ae.parameters(), lr=.001)
         criterion = torch.nn.BCELoss().to(self.device)
         self.ae.train()
 
         for _ in tqdm(range(10)):  # train 10 epochs
-            for batch in user_features:
-                batch = batch[0]
-                batch.to(self.device)
-                output, _ = self.ae(batch)  # omit encoded features
+            for inputs, batch in user_features:
+                optimizer.zero_grad()
+                inputs, batch = inputs.to(self.device), batch.to(self.device)
+                output, _ = self.ae(inputs)  # omit encoded features
                 loss = criterion(output, batch)
                 loss.backward()
                 # torch.nn.utils.clip_grad_norm_(self.ae.parameters(), 0.1)
@@ -139,6 +144,8 @@ class Doc2User(object):
         user_docs = dict()
         user_concepts = dict()
         user_features = dict()
+        # concepts are decoded per document, the shards are read once and cached
+        doc_concepts = open_concept_store(concept_directory)
 
         with open(data_path) as dfile:
             for line in dfile:
@@ -166,13 +173,14 @@ class Doc2User(object):
                             user_docs[user['uid']][0].extend(doc_entity['text'].split())
 
                     # get concept files
-                    concept_fname = '{}_{}.pkl'.format(uid, doc_entity['doc_id'])
-                    if os.path.exists(concept_directory + concept_fname):
-                        concepts = pickle.load(open(concept_directory + concept_fname, 'rb'))
+                    concept_key = '{}_{}'.format(uid, doc_entity['doc_id'])
+                    if concept_key in doc_concepts:
+                        concepts = doc_concepts[concept_key]
                         user_concepts[user['uid']].extend(
                             [concept['preferred_name'].lower() for concept in concepts])
 
         uids = list(user_docs.keys())
+        self.ae.to(self.device)
         self.ae.eval()
         batch_size = 128
         steps = len(uids) // batch_size
@@ -182,8 +190,7 @@ class Doc2User(object):
         for idx in range(steps):
             batch_uids = uids[idx*batch_size: (idx + 1)*batch_size]
             batch_features = [user_concepts[item_uid] for item_uid in batch_uids]
-            batch_features = torch.FloatTensor(self.tf_idf_vect.transform(batch_features).toarray())
-            # batch_features.to(self.device)
+            batch_features = to_sparse_tensor(self.tf_idf_vect.transform(batch_features)).to(self.device)
             with torch.no_grad():
                 _, batch_features = self.ae(batch_features)
             batch_features = batch_features.cpu().detach().numpy()
@@ -226,7 +233,6 @@ if __name__ == '__main__':
     if not os.path.exists(odir):
         os.mkdir(odir)
 
-    opath_user = odir + 'user.txt'
     doc2vec_path = odir + 'doc2v.model'
     autoencoder_path = odir + 'ae_model.pth'
 
@@ -251,9 +257,8 @@ if __name__ == '__main__':
     # user vectors
     ufeatures = l2u.inference(task_data_path, concept_dir)
 
-    # write to file
-    wfile = open(opath_user, 'w')
+    # write to the store
+    writer = UserEmbWriter(odir, 'suisil2user', '../data/processed_data/{}/user_encoder.json'.format(task))
     for tid in list(ufeatures.keys()):
-        wfile.write(tid + '\t' + ' '.join(map(str, ufeatures[tid])) + '\n')
-    wfile.flush()
-    wfile.close()
+        writer.add(tid, ufeatures[tid])
+    writer.close()
@@ -1,72 +1,50 @@
 import json
 import os
-import pickle
 import sys
 
 from tqdm import tqdm
 import keras
 import numpy as np
-from keras_preprocessing.text import Tokenizer
-import gensim
-from baseline_utils import user_word_sampler
+from baseline_utils import user_docs_sampler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import save_user_embs
+from build_cache import BuildCache
+from pretrained_vectors import open_pretrained_vectors
+from sampling import UnigramSampler
+from train_pairs import load_pairs, pair_batches, pair_paths, save_pairs
+from token_corpus import open_token_corpus
 
 # from keras.preprocessing.sequence import pad_sequences
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # for cpu usage
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
 
-def user_doc_builder(user_docs, tokenizer, negative_samples=1, output_dir=''):
+def user_doc_builder(user_docs, tokenizer, negative_samples=1):
     """This function was re-implemented from the Silvio Amir
     https://github.com/samiroid/usr2vec/tree/master/code
 
         user_docs (dict): user docs
         sequence (list): a sequence of word indices
         emb_dim (int): document size
+    :return: int32 columns of the user and word indices, uint8 labels
     """
-    if os.path.exists(output_dir + 'usr2vec_user_docs.pkl'):
-        tmp = pickle.load(open(output_dir + 'usr2vec_user_docs.pkl', 'rb'))
-        return tmp['couples'], tmp['labels']
-    else:
-        uids = list(user_docs.keys())
-        np.random.shuffle(uids)
-        couples = []
-        labels = []
-
-        for uid in uids:
-            for doc in user_docs[uid]:
-                doc_couples, doc_labels = user_word_sampler(
-                    uid=uid, sequence=doc, tokenizer=tokenizer, negative_samples=negative_samples
-                )
-                couples.extend(doc_couples)
-                labels.extend(doc_labels)
-
-        couples = np.asarray(couples, dtype=object)
-        labels = np.asarray(labels)
-
-        tmp = {
-            'couples': couples,
-            'labels': labels
-        }
-        with open(output_dir + 'usr2vec_user_docs.pkl', 'wb') as wfile:
-            pickle.dump(tmp, wfile)
-        del tmp
-
-        return couples, labels
-
-
-def user_doc_generator(couples, labels, batch_size):
-    # shuffle the dataset
-    rand_indices = list(range(len(labels)))
-    np.random.shuffle(rand_indices)
-    couples = couples[rand_indices]
-    labels = labels[rand_indices]
-
-    steps = len(labels) // batch_size
-    if len(labels) % batch_size != 0:
-        steps += 1
+    uids = list(user_docs.keys())
+    np.random.shuffle(uids)
+    user_indices = []
+    word_indices = []
+    labels = []
+    # the unigram distribution is built once for all documents
+    sampler = UnigramSampler.from_vocab(tokenizer)
+
+    for uid in uids:
+        doc_words, doc_labels = user_docs_sampler(
+            sequences=user_docs[uid], sampler=sampler, negative_samples=negative_samples
+        )
+        user_indices.append(np.full(len(doc_labels), uid, dtype=np.int32))
+        word_indices.append(doc_words)
+        labels.append(doc_labels)
 
-    for idx in range(steps):
-        yield couples[batch_size * idx: batch_size * (idx + 1)], labels[batch_size * idx: batch_size * (idx + 1)]
+    return [np.concatenate(user_indices), np.concatenate(word_indices)], np.concatenate(labels)
 
 
 # design model
@@ -161,64 +139,31 @@ def build_model(params=None):
 
 
 def build_emb_layer(tokenizer, emb_path, save_path):
-    """"""
-    # support three types, bin/txt/npy
-    emb_len = len(tokenizer.word_index)
+    """Extract the rows of the tokenizer vocabulary from the pretrained vectors, bin/txt"""
+    # index 0 is the padding, the known words are from 1 to num_words - 1
+    emb_len = len(tokenizer.word_index) + 1
     if emb_len > tokenizer.num_words:
         emb_len = tokenizer.num_words
 
-    if emb_path.endswith('.bin'):
-        w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-            emb_path, binary=True
-        )
-        emb_model = np.zeros((emb_len, w2v_model.vector_size))
-        for pair in zip(w2v_model.index_to_key, w2v_model.vectors):
-            if pair[0] in tokenizer.word_index and \
-                    tokenizer.word_index[pair[0]] < tokenizer.num_words:
-                emb_model[tokenizer.word_index[pair[0]]] = pair[1]
-
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-
-    elif emb_path.endswith('.txt'):
-        line = open(emb_path).readline()
-        emb_model = np.zeros((emb_len, len(line.strip().split()) - 1))  # first one is a word not vector.
-        emb_dim = len(line.strip().split()) - 1
-
-        with open(emb_path) as dfile:
-            for line in dfile:
-                line = line.strip().split()
-                word = line[0]
-                vectors = np.asarray(line[1:], dtype='float32')
-                if len(vectors) != emb_dim:
-                    continue
-
-                if word in tokenizer.word_index and \
-                        tokenizer.word_index[word] < tokenizer.num_words:
-                    emb_model[tokenizer.word_index[word]] = vectors
-
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-    else:
-        raise ValueError('Current other formats are not supported!')
+    emb_model = open_pretrained_vectors(emb_path).embedding_matrix(tokenizer.word_index, emb_len)
+    # save the extracted embedding weights
+    np.save(save_path, emb_model)
 
 
-def main(data_name, encode_directory, odirectory='../resources/'):
-    # load tokenizer
-    if os.path.exists(encode_directory + data_name + '.tkn'):
-        tok = pickle.load(open(encode_directory + data_name + '.tkn', 'rb'))
-    else:
-        all_docs = []
-        with open(encode_directory + data_name + '.json') as dfile:
-            for idx, line in enumerate(dfile):
-                user_info = json.loads(line)
-                for doc in user_info['docs']:
-                    all_docs.append(doc['text'])
-
-        tok = Tokenizer(num_words=15001)  # 15000 known + 1 unknown tokens
-        tok.fit_on_texts(all_docs)
-        pickle.dump(tok, open(encode_directory + data_name + '.tkn', 'wb'))
-        del all_docs
+def main(data_name, encode_directory, odirectory='../resources/', trainer='keras'):
+    """
+        trainer (str): keras, torch for the sparse PyTorch trainer,
+            or stream for the PyTorch trainer sampling the pairs in the data loader workers every epoch
+    """
+    if trainer not in ['keras', 'torch', 'stream']:
+        raise ValueError('Trainer {} is not supported!'.format(trainer))
+    data_path = encode_directory + data_name + '.json'
+    cache = BuildCache(odirectory)
+
+    # load the tokenized corpus, its vocabulary is the tokenizer
+    corpus = open_token_corpus(data_path)
+    tok = corpus.vocab(num_words=15001)  # 15000 known + 1 unknown tokens
+    tkn_key = cache.key(inputs=[data_path], params={'num_words': tok.num_words})
 
     params = {
         'batch_size': 512,
@@ -236,51 +181,79 @@ def main(data_name, encode_directory, odirectory='../resources/'):
         'lr': 5e-5,
         'negative_sample': 20,
         'max_len': 512,
+        'torch_batch_size': 8192,  # large batches of the torch trainer
+        'num_threads': os.cpu_count(),
+        'num_workers': 4,  # data loader workers of the streamed pairs
     }
+    # the losses are means over the batches, the torch sgd steps are scaled by the batch ratio to keep
+    # the same update per pair as the keras batches, adam normalizes its steps and keeps the rate
+    params['torch_lr'] = params['lr'] * params['torch_batch_size'] / params['batch_size'] \
+        if params['optimizer'] == 'sgd' else params['lr']
 
     # load user encoder, which convert users into indices
-    if os.path.exists(odirectory + 'train_corpus.pkl') and \
-            os.path.exists(encode_directory + 'user_encoder.json'):
-        user_corpus = pickle.load(open(odirectory + 'train_corpus.pkl', 'rb'))
-        user_encoder = json.load(open(encode_directory + 'user_encoder.json'))
-    else:
-        user_corpus = dict()
-        user_encoder = dict()
-        with open(encode_directory + data_name + '.json') as dfile:
-            for idx, line in enumerate(dfile):
-                user_info = json.loads(line)
-                user_info['uid'] = str(user_info['uid'])
-                if user_info['uid'] not in user_encoder:
-                    user_encoder[user_info['uid']] = len(user_encoder)
-                user_info['uid'] = user_encoder[user_info['uid']]
-
-                user_corpus[user_info['uid']] = []
-
-                for doc in user_info['docs']:
-                    user_corpus[user_info['uid']].append(
-                        tok.texts_to_sequences([doc['text']])[0]  # [:params['max_len']]
-                    )
-        pickle.dump(user_corpus, open(odirectory + 'train_corpus.pkl', 'wb'))
-        json.dump(user_encoder, open(encode_directory + 'user_encoder.json', 'w'))
+    user_rows = dict()
+    user_encoder = dict()
+    for udx, uid in enumerate(corpus.uids):
+        if uid not in user_encoder:
+            user_encoder[uid] = len(user_encoder)
+        # the last entry of a user is kept
+        user_rows[user_encoder[uid]] = udx
+    json.dump(user_encoder, open(encode_directory + 'user_encoder.json', 'w'))
 
     # update user information
     params['user_size'] = len(user_encoder) + 1
-    if not os.path.exists(encode_directory + 'user_encoder.json'):
-        json.dump(user_encoder, open(encode_directory + 'user_encoder.json', 'w'))
 
     if not os.path.exists('../resources/embedding/{}/'.format(data_name)):
         os.mkdir('../resources/embedding/{}/'.format(data_name))
 
-    # build datasets
-    user_words, labels = user_doc_builder(
-        user_corpus, tok, negative_samples=params['negative_sample'], output_dir=odirectory
-    )
-
     # build embedding model
-    if not os.path.exists(params['word_emb_path']):
+    emb_key = cache.key(inputs=[params['emb_path']], deps=[tkn_key])
+    if not cache.fresh('word_emb', emb_key, [params['word_emb_path']]):
         build_emb_layer(
             tok, params['emb_path'], params['word_emb_path']
         )
+        cache.record('word_emb', emb_key, [params['word_emb_path']])
+
+    if trainer == 'stream':
+        import torch
+        from usr2vec_torch import train_usr2vec_stream
+
+        print(params)
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        user_embs = train_usr2vec_stream(
+            corpus.corpus_dir, [(udx, uidx) for uidx, udx in sorted(user_rows.items())], params, device,
+            model_path=odirectory + 'ud_model.pth'
+        )
+        save_user_embs(odirectory, user_embs, 'user2vec', encode_directory + 'user_encoder.json')
+        return
+
+    # build datasets
+    pair_names = ['uids', 'wids']
+    pairs_key = cache.key(
+        inputs=[data_path], params={'negative_sample': params['negative_sample']}, deps=[tkn_key]
+    )
+    if not cache.fresh('usr2vec_pairs', pairs_key, pair_paths(odirectory, 'usr2vec', pair_names)):
+        user_corpus = dict(
+            (uidx, corpus.user_docs(udx, num_words=tok.num_words))  # [:params['max_len']]
+            for uidx, udx in user_rows.items()
+        )
+        user_words, labels = user_doc_builder(
+            user_corpus, tok, negative_samples=params['negative_sample']
+        )
+        save_pairs(odirectory, 'usr2vec', pair_names, user_words, labels)
+        cache.record('usr2vec_pairs', pairs_key, pair_paths(odirectory, 'usr2vec', pair_names))
+    else:
+        user_words, labels = load_pairs(odirectory, 'usr2vec', pair_names)
+
+    if trainer == 'torch':
+        import torch
+        from usr2vec_torch import train_usr2vec
+
+        print(params)
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        user_embs = train_usr2vec(user_words, labels, params, device, model_path=odirectory + 'ud_model.pth')
+        save_user_embs(odirectory, user_embs, 'user2vec', encode_directory + 'user_encoder.json')
+        return
 
     ud_model = build_model(params)
     print()
@@ -289,7 +262,7 @@ def main(data_name, encode_directory, odirectory='../resources/'):
     for epoch in tqdm(range(params['epochs'])):
         loss = 0
 
-        train_iter = user_doc_generator(
+        train_iter = pair_batches(
             user_words, labels, params['batch_size']
         )
         total_steps = len(labels) // params['batch_size']
@@ -297,8 +270,6 @@ def main(data_name, encode_directory, odirectory='../resources/'):
         for step, train_batch in tqdm(enumerate(train_iter), total=total_steps):
             '''user info, uw: user-word'''
             ud_pairs, ud_labels = train_batch
-            ud_pairs = [np.array(x, dtype=np.int32) for x in zip(*ud_pairs)]
-            ud_labels = np.array(ud_labels, dtype=np.int32)
 
             '''Train'''
             loss += ud_model.train_on_batch(ud_pairs, ud_labels)
@@ -313,11 +284,16 @@ def main(data_name, encode_directory, odirectory='../resources/'):
     # save the model
     ud_model.save(odirectory + 'ud_model.h5')
     # save the user embedding
-    np.save(odirectory + 'user.npy', ud_model.get_layer(name='user_emb').get_weights()[0])
+    save_user_embs(
+        odirectory, ud_model.get_layer(name='user_emb').get_weights()[0],
+        'user2vec', encode_directory + 'user_encoder.json'
+    )
 
 
 if __name__ == '__main__':
     dname = sys.argv[1]
+    # keras, torch or stream
+    trainer_name = sys.argv[2] if len(sys.argv) > 2 else 'keras'
 
     encode_dir = '../data/processed_data/'
     encode_dir = encode_dir + dname + '/'
@@ -329,4 +305,4 @@ if __name__ == '__main__':
     if not os.path.exists(odir):
         os.mkdir(odir)
 
-    main(data_name=dname, encode_directory=encode_dir, odirectory=odir)
+    main(data_name=dname, encode_directory=encode_dir, odirectory=odir, trainer=trainer_name)
@@ -0,0 +1,250 @@
+"""PyTorch trainer of the usr2vec baseline
+
+The same user-word model as the Keras usr2vec, with sparse user and word embeddings.
+Each step gathers the rows of a batch, scores the pairs by the dot products and
+applies the binary cross entropy on the logits, only the gathered rows receive gradients.
+Batches are sliced and converted on a background thread while the previous batch is trained.
+Pairs can also be streamed: data loader workers sample the positives and negatives of their share of
+the users from the token corpus every epoch, so the pairs are never materialized.
+"""
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+import torch
+from torch import nn as nn
+from torch.utils.data import IterableDataset, get_worker_info
+from torch.utils.data.dataloader import DataLoader
+from tqdm import tqdm
+
+from baseline_utils import user_docs_sampler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sampling import UnigramSampler
+from token_corpus import TokenCorpus
+from train_pairs import pair_batches
+
+
+class Usr2Vec(nn.Module):
+    def __init__(self, user_size, vocab_size, emb_dim, word_weights=None, word_emb_train=False):
+        super(Usr2Vec, self).__init__()
+        self.user_emb = nn.Embedding(user_size, emb_dim, sparse=True)
+        # the same initialization as the Keras embedding
+        nn.init.uniform_(self.user_emb.weight, -.05, .05)
+
+        if word_weights is not None:
+            self.word_emb = nn.Embedding.from_pretrained(
+                torch.FloatTensor(word_weights), freeze=not word_emb_train, sparse=True
+            )
+        else:
+            self.word_emb = nn.Embedding(vocab_size, emb_dim, sparse=True)
+            nn.init.uniform_(self.word_emb.weight, -.05, .05)
+            self.word_emb.weight.requires_grad = word_emb_train
+
+        self.transform = None
+        if self.word_emb.embedding_dim != emb_dim:
+            self.transform = nn.Linear(self.word_emb.embedding_dim, emb_dim)
+
+    def forward(self, user_ids, word_ids):
+        """Logits of the user-word pairs"""
+        user_rep = self.user_emb(user_ids)
+        word_rep = self.word_emb(word_ids)
+        if self.transform is not None:
+            word_rep = self.transform(word_rep)
+        return (user_rep * word_rep).sum(dim=-1)
+
+
+def build_optimizers(model, optimizer='adam', lr=1e-3):
+    """SparseAdam for the embeddings and Adam for the dense layers, or SGD for both"""
+    sparse_params = [param for param in [model.user_emb.weight, model.word_emb.weight] if param.requires_grad]
+    dense_params = [param for param in model.transform.parameters()] if model.transform is not None else []
+    if optimizer == 'adam':
+        optimizers = []
+        if len(sparse_params) > 0:
+            optimizers.append(torch.optim.SparseAdam(sparse_params, lr=lr))
+        if len(dense_params) > 0:
+            optimizers.append(torch.optim.Adam(dense_params, lr=lr))
+        return optimizers
+    # plain SGD supports the sparse gradients
+    return [torch.optim.SGD(sparse_params + dense_params, lr=lr)]
+
+
+def prefetch_batches(columns, labels, batch_size, device, max_size=8):
+    """Yield the tensor batches of the pairs, produced by a background thread"""
+    batches = queue.Queue(maxsize=max_size)
+    end = object()
+
+    def produce():
+        try:
+            for (user_ids, word_ids), batch_labels in pair_batches(columns, labels, batch_size):
+                batches.put((
+                    torch.from_numpy(user_ids.astype(np.int64)).to(device),
+                    torch.from_numpy(word_ids.astype(np.int64)).to(device),
+                    torch.from_numpy(batch_labels.astype(np.float32)).to(device),
+                ))
+            batches.put(end)
+        except Exception as error:  # raised again by the consumer
+            batches.put(error)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    while True:
+        batch = batches.get()
+        if batch is end:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+    producer.join()
+
+
+class UserPairStream(IterableDataset):
+    """Batches of the user-word pairs sampled from the token corpus, the users are sharded across the workers.
+        Every epoch draws fresh positives and negatives, the pairs of several users are shuffled in a buffer.
+
+        Parameters
+        ----------
+        corpus_dir: str
+            Directory of the token corpus
+        user_rows: list
+            (user index in the corpus, encoded user index) of the users to train
+        num_words: int
+            Number of word ids to keep
+        negative_samples: int
+            Number of negatives per positive
+        batch_size: int
+        buffer_size: int
+            Number of batches shuffled together
+    """
+    def __init__(self, corpus_dir, user_rows, num_words, negative_samples=1, batch_size=8192, buffer_size=64):
+        self.corpus_dir = corpus_dir
+        self.user_rows = list(user_rows)
+        self.num_words = num_words
+        self.negative_samples = negative_samples
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        user_rows = self.user_rows
+        if worker_info is not None:
+            user_rows = user_rows[worker_info.id::worker_info.num_workers]
+            # forked workers share the numpy state, torch seeds every worker differently on every epoch
+            np.random.seed(torch.initial_seed() % 2 ** 32)
+        # the memory map is opened by each worker
+        corpus = TokenCorpus(self.corpus_dir)
+        sampler = UnigramSampler.from_vocab(corpus.vocab(num_words=self.num_words))
+
+        buffer_users, buffer_words, buffer_labels = [], [], []
+        buffered = 0
+        for row in np.random.permutation(len(user_rows)).tolist():
+            udx, uid = user_rows[row]
+            doc_words, doc_labels = user_docs_sampler(
+                sequences=corpus.user_docs(udx, num_words=self.num_words), sampler=sampler,
+                negative_samples=self.negative_samples
+            )
+            buffer_users.append(np.full(len(doc_labels), uid, dtype=np.int64))
+            buffer_words.append(doc_words.astype(np.int64))
+            buffer_labels.append(doc_labels.astype(np.float32))
+            buffered += len(doc_labels)
+            if buffered < self.batch_size * self.buffer_size:
+                continue
+
+            # full batches are yielded, the remaining pairs stay in the buffer
+            columns = [np.concatenate(buffer_users), np.concatenate(buffer_words)]
+            labels = np.concatenate(buffer_labels)
+            order = np.random.permutation(len(labels))
+            num_yield = len(labels) - len(labels) % self.batch_size
+            for (user_ids, word_ids), batch_labels in pair_batches(
+                    [column[order[:num_yield]] for column in columns], labels[order[:num_yield]],
+                    self.batch_size, shuffle=False):
+                yield torch.from_numpy(user_ids), torch.from_numpy(word_ids), torch.from_numpy(batch_labels)
+            buffer_users = [columns[0][order[num_yield:]]]
+            buffer_words = [columns[1][order[num_yield:]]]
+            buffer_labels = [labels[order[num_yield:]]]
+            buffered = len(labels) - num_yield
+
+        if buffered > 0:
+            for (user_ids, word_ids), batch_labels in pair_batches(
+                    [np.concatenate(buffer_users), np.concatenate(buffer_words)], np.concatenate(buffer_labels),
+                    self.batch_size):
+                yield torch.from_numpy(user_ids), torch.from_numpy(word_ids), torch.from_numpy(batch_labels)
+
+
+def build_usr2vec(params, device):
+    if params.get('num_threads', 0) > 0:
+        torch.set_num_threads(params['num_threads'])
+    word_weights = np.load(params['word_emb_path']) if os.path.exists(params['word_emb_path']) else None
+    model = Usr2Vec(
+        params['user_size'], params['vocab_size'], params['emb_dim'],
+        word_weights=word_weights, word_emb_train=params['word_emb_train']
+    )
+    if os.path.exists(params['user_emb_path']):
+        model.user_emb.weight.data.copy_(torch.FloatTensor(np.load(params['user_emb_path'])))
+    model.user_emb.weight.requires_grad = params['user_emb_train']
+    return model.to(device)
+
+
+def train_epochs(model, params, device, make_batches, total_steps=None, model_path=None):
+    """Train the model on the batches of every epoch
+
+    :param params: the usr2vec parameters, the learning rate is params['torch_lr'] if given, else params['lr']
+    :param make_batches: function returning an iterator over the (user ids, word ids, labels) tensors of an epoch
+    :return: user embedding matrix
+    """
+    optimizers = build_optimizers(model, params['optimizer'], params.get('torch_lr', params['lr']))
+    criterion = nn.BCEWithLogitsLoss().to(device)
+
+    model.train()
+    for epoch in tqdm(range(params['epochs'])):
+        loss = 0
+        for step, (user_ids, word_ids, batch_labels) in tqdm(enumerate(make_batches()), total=total_steps):
+            user_ids, word_ids, batch_labels = user_ids.to(device), word_ids.to(device), batch_labels.to(device)
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            batch_loss = criterion(model(user_ids, word_ids), batch_labels)
+            batch_loss.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+
+            loss += batch_loss.item()
+            if step % 100 == 0:
+                print('Epoch: {}, Step: {}'.format(epoch, step))
+                print('\tLoss: {}.'.format(loss / (step + 1)))
+                print('-------------------------------------------------')
+
+    if model_path:
+        torch.save(model.state_dict(), model_path)
+    return model.user_emb.weight.detach().cpu().numpy()
+
+
+def train_usr2vec(user_words, labels, params, device, model_path=None):
+    """Train the user embeddings on the materialized pairs
+
+    :param user_words: int32 columns of the user and word indices
+    :param labels: uint8 labels of the pairs
+    :param params: the usr2vec parameters, batches of params['torch_batch_size'] pairs
+    :param model_path: path to save the model state, None to skip
+    :return: user embedding matrix
+    """
+    batch_size = params['torch_batch_size']
+    return train_epochs(
+        build_usr2vec(params, device), params, device,
+        lambda: prefetch_batches(user_words, labels, batch_size, device),
+        total_steps=(len(labels) + batch_size - 1) // batch_size, model_path=model_path
+    )
+
+
+def train_usr2vec_stream(corpus_dir, user_rows, params, device, model_path=None):
+    """Train the user embeddings on the pairs streamed by params['num_workers'] data loader workers
+
+    :param user_rows: (user index in the corpus, encoded user index) of the users to train
+    """
+    stream = UserPairStream(
+        corpus_dir, user_rows, params['vocab_size'], negative_samples=params['negative_sample'],
+        batch_size=params['torch_batch_size']
+    )
+    # the stream yields whole batches
+    loader = DataLoader(stream, batch_size=None, num_workers=params['num_workers'])
+    return train_epochs(build_usr2vec(params, device), params, device, lambda: iter(loader), model_path=model_path)
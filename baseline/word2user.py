@@ -3,108 +3,84 @@ average all document vectors as user or product representations
 """
 import os
 import sys
-import pickle
-import json
 
-import gensim
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from pretrained_vectors import open_pretrained_vectors
+from token_corpus import average_rows, open_token_corpus
+
 
 class Word2User(object):
     """Apply Word2Vec model on the documents to generate user and product representation.
-        Outputs will be one user/product_id + vect per line.
+        Outputs will be saved into the user embedding store.
 
         Parameters
         ----------
         task_name: str
             Task name, such as amazon, yelp and imdb
-        tknPath: str
-            Path of LDA dictionary file
+        tkn: vocab.Vocab
+            Tokenizer of the word embeddings
         modelPath: str
-            Path of LDA model file
+            Path of the word embeddings, bin/txt/npy
     """
 
-    def __init__(self, task_name, tknPath, modelPath, emb_dim=300):
+    def __init__(self, task_name, tkn, modelPath, emb_dim=300):
         self.task = task_name
-        self.tkn = pickle.load(open(tknPath, 'rb'))
+        self.tkn = tkn
         self.emb_dim = emb_dim
         self.model = self.__load_model(modelPath, emb_dim)
 
     def __load_model(self, modelPath, emb_dim=300):
         # support three types, bin/txt/npy
+        if modelPath.endswith('.npy'):
+            return np.load(modelPath)
+
         emb_len = len(self.tkn.word_index)
         if emb_len > self.tkn.num_words:
             emb_len = self.tkn.num_words
-        model = np.zeros((emb_len + 1, emb_dim))
-
-        if modelPath.endswith('.bin'):
-            w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-                modelPath, binary=True
-            )
-            for pair in zip(w2v_model.wv.index_to_key, w2v_model.wv.syn0):
-                if pair[0] in self.tkn.word_index and \
-                        self.tkn.word_index[pair[0]] < self.tkn.num_words:
-                    model[self.tkn.word_index[pair[0]]] = pair[1]
-
-        elif modelPath.endswith('.npy'):
-            model = np.load(modelPath)
-
-        elif modelPath.endswith('.txt'):
-            with open(modelPath) as dfile:
-                for line in dfile:
-                    line = line.strip().split()
-                    word = line[0]
-                    vectors = np.asarray(line[1:], dtype='float32')
-
-                    if word in self.tkn.word_index and \
-                            self.tkn.word_index[word] < self.tkn.num_words:
-                        model[self.tkn.word_index[word]] = vectors
-        else:
-            raise ValueError('Current other formats are not supported!')
-        return model
+        # only the rows of the known words are read from the pretrained vectors
+        word_index = dict(
+            (word, idx) for word, idx in self.tkn.word_index.items() if idx < self.tkn.num_words)
+        return open_pretrained_vectors(modelPath).embedding_matrix(word_index, emb_len + 1)
 
-    def word2item(self, data_path, opath, max_len=512):
+    def word2item(self, data_path, writer, max_len=512):
         """Extract user vectors from the given data path
 
             Parameters
             ----------
-            max_len
             data_path: str
-                Path of data file, tsv file
-            opath: str
-                Path of output path for user vectors
+                Path of data file, json file
+            writer: UserEmbWriter
+                Writer of the user embedding store
+            max_len: int
+                Number of the first tokens of each document to average
         """
-        item_dict = dict()
-        ofile = open(opath, 'w')
-
-        with open(data_path) as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                tid = user['uid']
-                if tid not in item_dict:
-                    item_dict[tid] = []
-
-                for doc_entity in user['docs']:
-                    text = doc_entity['text']
-                    # collect data
-                    item_dict[tid].extend(text.split()[:max_len])
-
-        for tid in list(item_dict.keys()):
-            # encode the document by word2vec
-            item_dict[tid] = np.asarray([
-                self.model[self.tkn.word_index[word]] for word in item_dict[tid]
-                if word in self.tkn.word_index and self.tkn.word_index[word] < self.tkn.num_words
-            ])
-            # average the word2vec inferred documents
-            item_dict[tid] = np.mean(item_dict[tid], axis=0)
-
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(str, item_dict[tid])) + '\n')
-
-            # save memory
-            del item_dict[tid]
-        ofile.flush()
-        ofile.close()
+        corpus = open_token_corpus(data_path)
+        # users repeated in the data are merged into one item
+        item_index = dict()
+        for tid in corpus.uids:
+            if tid not in item_index:
+                item_index[tid] = len(item_index)
+        num_words = min(self.tkn.num_words, len(self.model))
+
+        # documents x words counts of the first max_len tokens in the ids of the tokenizer,
+        # the corpus ids are the same when the tokenizer is the vocabulary of this corpus
+        if self.tkn.words[:num_words - 1] == corpus.words[:num_words - 1]:
+            doc_counts = corpus.doc_word_counts(num_words=num_words, max_len=max_len)
+        else:
+            doc_counts = corpus.doc_word_counts(max_len=max_len) @ corpus.word_remap(self.tkn.word_index, num_words)
+        # items x words counts
+        counts = corpus.user_doc_matrix([item_index[tid] for tid in corpus.uids], len(item_index)) @ doc_counts
+        # average the word2vec inferred documents
+        item_embs, found = average_rows(counts, self.model[:num_words])
+
+        # write to the store, items without known words are left missing
+        for tid, idx in item_index.items():
+            if found[idx]:
+                writer.add(tid, item_embs[idx])
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -116,10 +92,8 @@ if __name__ == '__main__':
     baseline_dir = '../resources/embedding/'
     task_dir = baseline_dir + dname + '/'
     odir = task_dir + 'word2user/'
-    opath_user = odir + 'user.txt'
 
     resource_dir = '../resources/embedding/'
-    tkn_path = '../data/processed_data/' + dname + '/' + dname + '.tkn'
     model_path = resource_dir + dname + '/word_emb.npy'
 
     # create directories
@@ -131,9 +105,11 @@ if __name__ == '__main__':
         os.mkdir(odir)
 
     # Word2User
-    l2u = Word2User(dname, tkn_path, model_path)
+    # the vocabulary of the word embeddings from usr2vec
+    tkn = open_token_corpus(task_data_path).vocab(num_words=15001)
+    l2u = Word2User(dname, tkn, model_path)
     # user vectors
     l2u.word2item(
         data_path=task_data_path,
-        opath=opath_user
+        writer=UserEmbWriter(odir, 'word2user', data_dir + 'user_encoder.json')
     )
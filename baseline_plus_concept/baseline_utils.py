@@ -12,25 +12,27 @@ from gensim.models.doc2vec import TaggedDocument, Doc2Vec
 from gensim.models.word2vec import Word2Vec
 from gensim.corpora import Dictionary
 from gensim.models.ldamulticore import LdaMulticore
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from build_cache import BuildCache
+from sampling import UnigramSampler
+from token_corpus import TokenCorpus, open_token_corpus
 
 
 class RawCorpus(object):
     def __init__(self, filep, doc2id=False, dictionary=None):
-        """ Load Json file
+        """ Load Json file, documents are read from its token corpus
         """
         self.filep = filep
         self.dictionary = dictionary
         self.doc2id = doc2id
+        self.corpus = open_token_corpus(filep)
 
     def __iter__(self):
-        with open(self.filep) as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                for doc_entity in user['docs']:
-                    if self.doc2id and self.dictionary:  # this is for inference
-                        yield self.dictionary.doc2bow(doc_entity['text'].split())
-                    else:
-                        yield doc_entity['text'].split()
+        for doc in self.corpus.iter_doc_words():
+            if self.doc2id and self.dictionary:  # this is for inference
+                yield self.dictionary.doc2bow(doc)
+            else:
+                yield doc
 
 
 def train_lda(dname, raw_dir='../data/raw/', odir='../resources/embedding/', dim=300):
@@ -43,12 +45,15 @@ def train_lda(dname, raw_dir='../data/raw/', odir='../resources/embedding/', dim
 
     # load data and build dictionary
     dpath = raw_dir + dname + '/' + dname + '.json'
-    if os.path.exists(odir + 'lda_dict.pkl'):
+    cache = BuildCache(odir)
+    dict_key = cache.key(inputs=[dpath], params={'prune_at': 10000})
+    if cache.fresh('lda_dict', dict_key, [odir + 'lda_dict.pkl']):
         dictionary = pickle.load(open(odir + 'lda_dict.pkl', 'rb'))
     else:
         corpus = RawCorpus(dpath)
         dictionary = Dictionary(corpus, prune_at=10000)
         dictionary.save(odir + 'lda_dict.pkl')
+        cache.record('lda_dict', dict_key, [odir + 'lda_dict.pkl'])
 
     doc_matrix = RawCorpus(dpath, True, dictionary)
 
@@ -70,19 +75,20 @@ def train_doc2v(dname, input_path, odir='../resources/embedding/', dim=300):
     """
     print(dname)
 
-    def read_corpus(data_path):
-        with open(data_path) as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                for idx, doc_entity in enumerate(user['docs']):
-                    line = doc_entity['text'].split()
-                    yield TaggedDocument(line, [user['uid'] + str(idx)])
+    class TaggedCorpus(object):
+        def __init__(self, data_path):
+            self.corpus = open_token_corpus(data_path)
+
+        def __iter__(self):
+            for udx, uid in enumerate(self.corpus.uids):
+                for idx, ddx in enumerate(self.corpus.user_doc_range(udx)):
+                    yield TaggedDocument(self.corpus.doc_words(ddx), [uid + str(idx)])
 
     if not os.path.exists(odir):
         os.mkdir(odir)
 
     # load the corpus
-    corpus = read_corpus(input_path)
+    corpus = TaggedCorpus(input_path)
 
     # init, train and save the model
     model = Doc2Vec(
@@ -129,59 +135,62 @@ def sample_decay(count, decay=2):
     return 1 / (1 + decay * count)
 
 
-def user_word_sampler(uid, sequence, tokenizer, filter_words=None, negative_samples=1):
+def user_word_sampler(uid, sequence, tokenizer, filter_words=None, negative_samples=1, sampler=None):
     """This function was partially adopted from
     https://github.com/keras-team/keras-preprocessing/blob/master/keras_preprocessing/sequence.py#L151
+
+    :param sampler: UnigramSampler of the tokenizer, built from the tokenizer if None.
+        Build it once and pass it when sampling many documents.
     """
-    couples = []
-    labels = []
-    word_set = set(sequence)
-    if filter_words:
-        word_set = word_set.union(filter_words)
+    if sampler is None:
+        sampler = UnigramSampler.from_vocab(tokenizer)
+    wids, labels = user_docs_sampler([sequence], sampler, filter_words, negative_samples)
+    return [[uid, wid] for wid in wids.tolist()], labels.tolist()
+
+
+def user_docs_sampler(sequences, sampler, filter_words=None, negative_samples=1, exclude_words=True):
+    """Words and labels of the documents of a user, the negatives of all documents are drawn in one call.
+        Each document is followed by its negatives.
 
+    :param sequences: list of sequences of word indices
+    :param sampler: UnigramSampler of the vocabulary
+    :param exclude_words: words of the document and filter_words are never drawn as its negatives
+    :return: int32 word indices and uint8 labels
+    """
     sample_size = 256
-    # to reduce number of training instances
-    sequence = set(sequence)
-    couples.extend([[uid, wid] for wid in sequence])
-    labels.extend([1] * len(sequence))
-
-    if len(couples) > sample_size:  # rush for conference deadline
-        sample_indices = list(np.random.choice(list(range(len(labels))), size=sample_size, replace=False))
-        couples = [couples[sample_idx] for sample_idx in sample_indices]
-        labels = [labels[sample_idx] for sample_idx in sample_indices]
-
-    # norm_probs = [0] * tokenizer.num_words
-    # for wid in tokenizer.index_word:
-    #     if wid > tokenizer.num_words-1:
-    #         continue
-    #     if wid in word_set:
-    #         continue
-    #     norm_probs[wid] = tokenizer.word_counts[tokenizer.index_word[wid]]**.75
-    # # scaling = int(np.ceil(1./min(norm_probs)))
-    # # norm_probs *= scaling
-    # norm_probs_sum = sum(norm_probs)
-    # norm_probs = [item/norm_probs_sum for item in norm_probs]
-    negative_set = [item for item in range(tokenizer.num_words)]
-    num_negative_samples = int(len(labels) * negative_samples)
+    doc_positives = []
+    word_sets = []
+    for sequence in sequences:
+        word_set = set(sequence)
+        # for wid in sequence:
+        positives = list(word_set)  # to reduce number of training instances, rush for conference deadline
+        if len(positives) > sample_size:  # rush for conference deadline
+            sample_indices = np.random.choice(list(range(len(positives))), size=sample_size, replace=False)
+            positives = [positives[idx] for idx in sample_indices]
+        if filter_words:
+            word_set = word_set.union(filter_words)
+        doc_positives.append(positives)
+        word_sets.append(word_set)
 
     if negative_samples > 0:
-        wid_list = np.random.choice(
-            negative_set,
-            size=num_negative_samples,
-            # p=norm_probs
+        doc_negatives = sampler.sample_many(
+            [int(len(positives) * negative_samples) for positives in doc_positives],
+            word_sets if exclude_words else None
         )
-        # 0 is placeholder, starts by 1
-        # ensure user did not use the word
-        couples.extend([[uid, wid] for wid in wid_list])
-        labels.extend([0] * len(wid_list))
+    else:
+        doc_negatives = [[] for _ in doc_positives]
 
-    # shuffle
-    # seed = np.random.randint(0, int(10e6))
-    # np.random.seed(seed)
-    # np.random.shuffle(couples)
-    # np.random.seed(seed)
-    # np.random.shuffle(labels)
-    return couples, labels
+    wids = []
+    labels = []
+    for positives, negatives in zip(doc_positives, doc_negatives):
+        # 0 is placeholder, starts by 1
+        wids.append(np.asarray(positives, dtype=np.int32))
+        labels.append(np.ones(len(positives), dtype=np.uint8))
+        wids.append(np.asarray(negatives, dtype=np.int32))
+        labels.append(np.zeros(len(negatives), dtype=np.uint8))
+    if len(wids) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(wids), np.concatenate(labels)
 
 
 def npy2tsv(npy_path, idx2id_path, opath):
@@ -206,8 +215,10 @@ def get_free_gpu():
 
 
 def data_loader(dpath):
-    loaded_data = pickle.load(open(dpath, 'rb'))
-    return loaded_data[0], loaded_data[1]  # user_corpus, all_docs
+    """User corpus and the snippet texts, the texts are read from the token corpus next to it when accessed"""
+    user_corpus = pickle.load(open(dpath, 'rb'))
+    token_corpus = TokenCorpus(os.path.join(os.path.dirname(dpath), 'token_corpus/'))
+    return user_corpus, token_corpus.texts()
 
 
 if __name__ == '__main__':
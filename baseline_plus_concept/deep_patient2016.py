@@ -23,6 +23,9 @@ import numpy as np
 from tqdm import tqdm
 from baseline_utils import data_loader
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+
 
 class ConceptCorpus(object):
     def __init__(self, concept_list, doc2id=False, dictionary=None):
@@ -157,9 +160,11 @@ class Lda2User(object):
             self.ae.load_state_dict(torch.load(self.concept_ae_path), strict=False)
 
     def train_autoencoder(self, user_features, ae_model, ae_model_path):
-        user_features = TensorDataset(torch.FloatTensor(user_features))
+        # averaged topic vectors are dense, they stay in a dense dataset
+        user_features = TensorDataset(torch.FloatTensor(np.asarray(user_features)))
         user_features = DataLoader(user_features, batch_size=32, shuffle=True)
 
+        ae_model.to(self.device)
         optimizer = torch.optim.SGD(ae_model.parameters(), lr=.001)
         criterion = torch.nn.BCELoss().to(self.device)
         ae_model.train()
@@ -167,8 +172,7 @@ class Lda2User(object):
         for _ in tqdm(range(10)):
             for idx, batch in enumerate(user_features):
                 optimizer.zero_grad()
-                batch = batch[0]
-                batch.to(self.device)
+                batch = batch[0].to(self.device)
                 output, _ = ae_model(batch)  # omit encoded features
                 loss = criterion(output, batch)
                 loss.backward()
@@ -177,17 +181,16 @@ class Lda2User(object):
 
         torch.save(ae_model.state_dict(), ae_model_path)
 
-    def lda2item(self, data_path, opath):
+    def lda2item(self, data_path, writer):
         """Extract user vectors from the given data path
 
             Parameters
             ----------
             data_path: str
                 Path of data file, tsv file
-            opath: str
-                Path of output path for user vectors
+            writer: UserEmbWriter
+                Writer of the user embedding store
         """
-        ofile = open(opath, 'w')
         # load the datasets from caue_gru task
         user_docs, all_docs = data_loader(data_path)
         doc_features = list()
@@ -229,20 +232,20 @@ class Lda2User(object):
         # convert the doc features by the autoencoder.
         if not torch.is_tensor(doc_features):
             doc_features = torch.FloatTensor(doc_features)
-        _, doc_features = self.ae(doc_features)
+        self.ae.to(self.device)
+        _, doc_features = self.ae(doc_features.to(self.device))
         doc_features = doc_features.cpu().detach().numpy()
 
         if not torch.is_tensor(concept_features):
             concept_features = torch.FloatTensor(concept_features)
-        _, concept_features = self.concept_ae(concept_features)
+        self.concept_ae.to(self.device)
+        _, concept_features = self.concept_ae(concept_features.to(self.device))
         concept_features = concept_features.cpu().detach().numpy()
 
         for idx, user_id in enumerate(list(user_docs.keys())):
-            # write to file
-            ofile.write(user_id + '\t' + ' '.join(map(
-                str, np.concatenate((doc_features[idx], concept_features[idx]), axis=None))) + '\n')
-        ofile.flush()
-        ofile.close()
+            # write to the store
+            writer.add(user_id, np.concatenate((doc_features[idx], concept_features[idx]), axis=None))
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -260,7 +263,6 @@ if __name__ == '__main__':
     odir = task_dir + 'deeppatient2user_concept/'
     if not os.path.exists(odir):
         os.mkdir(odir)
-    opath_user = odir + 'user.txt'
 
     word_dict_path = odir + 'lda_dict.pkl'
     word_model_path = odir + 'lda.model'
@@ -292,4 +294,7 @@ if __name__ == '__main__':
         concept_dict_path=concept_dict_path, concept_model_path=concept_model_path,
         data_path=task_data_path, ae_path=autoencoder_path, concept_ae_path=concept_ae_path, device=device,
     )
-    l2u.lda2item(task_data_path, opath_user)
+    l2u.lda2item(
+        task_data_path,
+        UserEmbWriter(odir, 'deeppatient2user_concept', '../data/processed_data/{}/user_encoder.json'.format(task))
+    )
@@ -7,11 +7,43 @@ Patient representation learning and interpretable evaluation using clinical note
 
 import sys
 import os
+import time
+from multiprocessing import Pool
 import numpy as np
 from tqdm import tqdm
 from gensim.models.doc2vec import TaggedDocument, Doc2Vec
 from baseline_utils import data_loader
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+
+# Doc2Vec models of the worker processes
+worker_doc_model = None
+worker_concept_model = None
+
+
+def init_worker(doc_model_path, concept_model_path):
+    """Load the models memory-mapped, the workers share the pages of the arrays"""
+    global worker_doc_model, worker_concept_model
+    worker_doc_model = Doc2Vec.load(doc_model_path, mmap='r')
+    worker_concept_model = Doc2Vec.load(concept_model_path, mmap='r')
+
+
+def infer_user(item):
+    """Means of the inferred vectors of the documents and the concepts of a user"""
+    tid, docs, concept_lists = item
+    # encode the document by doc2vec
+    doc_vectors = np.asarray([worker_doc_model.infer_vector(doc.split()) for doc in docs])
+    concept_vectors = np.asarray([
+        worker_concept_model.infer_vector(concepts) for concepts in concept_lists
+        if len(concepts) > 0
+    ])
+
+    # average the lda inferred documents
+    doc_vectors = np.mean(doc_vectors, axis=0)
+    concept_vectors = np.mean(concept_vectors, axis=0)
+    return tid, np.concatenate((doc_vectors, concept_vectors), axis=None), len(docs)
+
 
 def train_concept_doc2v(concept_list, output_dir, dim=300):
     """ Build paragraph2vec model
@@ -41,46 +73,56 @@ def train_concept_doc2v(concept_list, output_dir, dim=300):
 class Doc2User(object):
     def __init__(self, **kwargs):
         """Apply Doc2Vec model on the documents to generate user and product representation.
-            Outputs will be one user/product_id + vect per line.
+            Outputs will be saved into the user embedding store.
+            Users are inferred by kwargs['num_workers'] processes, 1 to infer in the current process.
         """
         self.task = kwargs['task_name']
-        self.doc_model = Doc2Vec.load(kwargs['doc_model_path'])
-        self.concept_model = Doc2Vec.load(kwargs['concept_model_path'])
-        self.doc_model.delete_temporary_training_data(
-            keep_doctags_vectors=True, keep_inference=True)
-        self.concept_model.delete_temporary_training_data(
-            keep_doctags_vectors=True, keep_inference=True)
-
-    def doc2item(self, data_path, opath):
+        self.doc_model_path = kwargs['doc_model_path']
+        self.concept_model_path = kwargs['concept_model_path']
+        self.num_workers = kwargs.get('num_workers', 1)
+
+    def doc2item(self, data_path, writer):
         """Extract user vectors from the given data path
 
         :param data_path:
-        :param opath:
+        :param writer: UserEmbWriter of the user embedding store
         :return:
         """
         user_docs, all_docs = data_loader(data_path)
-        ofile = open(opath, 'w')
-
-        for tid in tqdm(list(user_docs.keys())):
-            # encode the document by doc2vec
-            doc_vectors = np.asarray([
-                self.doc_model.infer_vector(all_docs[doc_id].split()) for doc_id in user_docs[tid]['docs']
-            ])
-            concept_vectors = np.asarray([
-                self.concept_model.infer_vector(concepts) for concepts in user_docs[tid]['concepts']
-                if len(concepts) > 0
-            ])
-
-            # average the lda inferred documents
-            doc_vectors = np.mean(doc_vectors, axis=0)
-            concept_vectors = np.mean(concept_vectors, axis=0)
-
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(
-                str, np.concatenate((doc_vectors, concept_vectors), axis=None))) + '\n')
-
-        ofile.flush()
-        ofile.close()
+        items = (
+            (tid, [all_docs[doc_id] for doc_id in user_docs[tid]['docs']], user_docs[tid]['concepts'])
+            for tid in user_docs
+        )
+
+        # users are inferred by the workers, results come back in the user order for the single writer
+        num_docs = 0
+        start = time.time()
+        if self.num_workers > 1:
+            pool = Pool(
+                self.num_workers, initializer=init_worker,
+                initargs=(self.doc_model_path, self.concept_model_path)
+            )
+            results = pool.imap(infer_user, items, chunksize=16)
+        else:
+            pool = None
+            init_worker(self.doc_model_path, self.concept_model_path)
+            results = map(infer_user, items)
+
+        try:
+            for tid, user_vector, user_num_docs in tqdm(results, total=len(user_docs), desc='Inferring users'):
+                # write to the store
+                writer.add(tid, user_vector)
+                num_docs += user_num_docs
+        finally:
+            # all results are received, or a worker failed and the rest is dropped
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = max(time.time() - start, 1e-6)
+        print('Inferred {} documents of {} users in {:.1f}s, {:.1f} documents/s'.format(
+            num_docs, len(user_docs), elapsed, num_docs / elapsed))
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -99,7 +141,6 @@ if __name__ == '__main__':
     odir = task_dir + 'doc2user_concept/'
     if not os.path.exists(odir):
         os.mkdir(odir)
-    opath_user = odir + 'user.txt'
     doc_model_path = task_dir + 'doc2v.model'
 
     concept_model_path = odir + 'doc2v_concept.model'
@@ -112,9 +153,12 @@ if __name__ == '__main__':
 
     # Doc2User
     d2u = Doc2User(
-        task_name=dname, doc_model_path=doc_model_path, concept_model_path=concept_model_path)
+        task_name=dname, doc_model_path=doc_model_path, concept_model_path=concept_model_path,
+        num_workers=os.cpu_count() // 2
+    )
     # user vectors
     d2u.doc2item(
         data_path=task_data_path, 
-        opath=opath_user
+        writer=UserEmbWriter(
+            odir, 'doc2user_concept', '../data/processed_data/{}/user_encoder.json'.format(dname))
     )
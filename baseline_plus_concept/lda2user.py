@@ -16,6 +16,42 @@ from gensim.corpora import Dictionary
 from gensim.models.ldamulticore import LdaMulticore
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from lda_topics import segment_means, topic_rows
+
+# LDA models, dictionaries and documents of the worker processes, by word or concept
+worker_models = None
+worker_docs = None
+
+
+def load_models(word_model_path, word_dict_path, concept_model_path, concept_dict_path):
+    """Memory-mapped LDA models and their dictionaries, by word or concept"""
+    return {
+        'word': (LdaModel.load(word_model_path, mmap='r'), pickle.load(open(word_dict_path, 'rb'))),
+        'concept': (LdaModel.load(concept_model_path, mmap='r'), pickle.load(open(concept_dict_path, 'rb'))),
+    }
+
+
+def init_worker(model_paths, word_docs, concept_docs, models=None):
+    """Load the models once per worker, or reuse the loaded models in the current process.
+        The documents are shared by the fork.
+    """
+    global worker_models, worker_docs
+    worker_models = models if models is not None else load_models(*model_paths)
+    worker_docs = {'word': word_docs, 'concept': concept_docs}
+
+
+def infer_range(task):
+    """Topic rows of the documents start:end of the word or concept documents"""
+    kind, start, end = task
+    model, dictionary = worker_models[kind]
+    if kind == 'word':
+        bows = [dictionary.doc2bow(doc.split()) for doc in worker_docs[kind][start: end]]
+    else:
+        bows = [dictionary.doc2bow(concepts) for concepts in worker_docs[kind][start: end]]
+    return kind, start, topic_rows(model, bows)
+
 
 class ConceptCorpus(object):
     def __init__(self, concept_list, doc2id=False, dictionary=None):
@@ -89,114 +125,94 @@ def train_lda(docs, output_dir, dim=300):
 
 class Lda2User(object):
     """Apply LDA model on the documents to generate user and product representation.
-        Outputs will be one user/product_id + vect per line.
+        Outputs will be saved into the user embedding store.
 
         Parameters
         ----------
         task_name: str
             Task name, such as amazon, yelp and imdb
-        dictionary_path: str
-            Path of LDA dictionary file
-        mpath: str
-            Path of LDA model file
+        word_dict_path, concept_dict_path: str
+            Paths of LDA dictionary files
+        word_model_path, concept_model_path: str
+            Paths of LDA model files
+        num_workers: int
+            Number of inference processes, 1 to infer in the current process
     """
     def __init__(self, **kwargs):
         self.task = kwargs['task_name']
-        self.word_dict = pickle.load(open(kwargs['word_dict_path'], 'rb'))
-        self.concept_dict = pickle.load(open(kwargs['concept_dict_path'], 'rb'))
-        self.word_model = LdaModel.load(kwargs['word_model_path'])
-        self.concept_model = LdaModel.load(kwargs['concept_model_path'])
-
-    def lda2item_thread(self, info):
-        tid, docs, concepts_list = info
-        doc_vectors = []
-        for idx, doc in enumerate(docs):
-            output = self.word_model[self.word_dict.doc2bow(doc.split())]
-            doc_vectors.append([0.] * self.word_model.num_topics)
-            for item in output:
-                doc_vectors[-1][item[0]] = item[1]
-        # average the lda inferred documents
-        doc_vectors = np.mean(doc_vectors, axis=0)
-
-        concept_vectors = []
-        for idx, concepts in enumerate(concepts_list):
-            if len(concepts) == 0:
-                continue
-            output = self.concept_model[self.concept_dict.doc2bow(concepts)]
-            concept_vectors.append([0.] * self.concept_model.num_topics)
-            for item in output:
-                concept_vectors[-1][item[0]] = item[1]
-        # average the lda inferred documents
-        concept_vectors = np.mean(concept_vectors, axis=0)
-        return tid, np.concatenate((doc_vectors, concept_vectors), axis=None)
-
-    def lda2item_parallel(self, data_path, opath):
-        ofile = open(opath, 'w')
-        # load the datasets from caue_gru task
-        user_docs, all_docs = data_loader(data_path)
-        parallel_info = []
-        print('Loading Data')
-        for tid in list(user_docs.keys()):
-            # encode the document by lda
-            # docs = list(itertools.chain.from_iterable([all_docs[doc_id] for doc_id in user_docs[tid]['docs']]))
-            docs = [all_docs[doc_id] for doc_id in user_docs[tid]['docs']]
-            parallel_info.append((tid, docs, user_docs[tid]['concepts']))
-
-        pool = Pool(os.cpu_count()//2)
-        results = pool.map(self.lda2item_thread, parallel_info)
-
-        for tid, vector in results:
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(str, vector)) + '\n')
-
-        ofile.flush()
-        ofile.close()
-
-    def lda2item(self, data_path, opath):
+        self.model_paths = (
+            kwargs['word_model_path'], kwargs['word_dict_path'],
+            kwargs['concept_model_path'], kwargs['concept_dict_path'],
+        )
+        self.num_workers = kwargs.get('num_workers', 1)
+        # loaded once, the same models infer the topics in the current process
+        self.models = load_models(*self.model_paths)
+
+    def lda2item(self, data_path, writer, chunk_size=1000):
         """Extract user vectors from the given data path
 
             Parameters
             ----------
             data_path: str
                 Path of data file, tsv file
-            opath: str
-                Path of output path for user vectors
+            writer: UserEmbWriter
+                Writer of the user embedding store
+            chunk_size: int
+                Number of documents per inference task
         """
-        ofile = open(opath, 'w')
         # load the datasets from caue_gru task
         user_docs, all_docs = data_loader(data_path)
+        tids = list(user_docs.keys())
 
         print('Loading Data')
-        for tid in tqdm(list(user_docs.keys())):
-            # encode the document by lda
-            # docs = list(itertools.chain.from_iterable([all_docs[doc_id] for doc_id in user_docs[tid]['docs']]))
-            docs = [all_docs[doc_id] for doc_id in user_docs[tid]['docs']]
-            doc_vectors = []
-            for idx, doc in enumerate(docs):
-                output = self.word_model[self.word_dict.doc2bow(doc.split())]
-                doc_vectors.append([0.] * self.word_model.num_topics)
-                for item in output:
-                    doc_vectors[-1][item[0]] = item[1]
-            # average the lda inferred documents
-            doc_vectors = np.mean(doc_vectors, axis=0)
-
-            concept_vectors = []
-            for idx, concepts in enumerate(user_docs[tid]['concepts']):
-                if len(concepts) == 0:
-                    continue
-                output = self.concept_model[self.concept_dict.doc2bow(concepts)]
-                concept_vectors.append([0.] * self.concept_model.num_topics)
-                for item in output:
-                    concept_vectors[-1][item[0]] = item[1]
-            # average the lda inferred documents
-            concept_vectors = np.mean(concept_vectors, axis=0)
-
-            # write to file
-            ofile.write(tid + '\t' + ' '.join(map(
-                str, np.concatenate((doc_vectors, concept_vectors), axis=None))) + '\n')
-
-        ofile.flush()
-        ofile.close()
+        # documents of the users, each distinct document is inferred once
+        doc_ptr = np.zeros(len(tids) + 1, dtype=np.int64)
+        doc_ids = []
+        concept_ptr = np.zeros(len(tids) + 1, dtype=np.int64)
+        concept_docs = []
+        for idx, tid in enumerate(tids):
+            doc_ids.extend(user_docs[tid]['docs'])
+            doc_ptr[idx + 1] = len(doc_ids)
+            concept_docs.extend([concepts for concepts in user_docs[tid]['concepts'] if len(concepts) > 0])
+            concept_ptr[idx + 1] = len(concept_docs)
+        unique_ids, doc_rows = np.unique(np.asarray(doc_ids, dtype=np.int64), return_inverse=True)
+        word_docs = [all_docs[doc_id] for doc_id in unique_ids.tolist()]
+
+        # workers receive only the ranges of the documents
+        topics = {
+            'word': np.zeros((len(word_docs), self.models['word'][0].num_topics), dtype=np.float32),
+            'concept': np.zeros((len(concept_docs), self.models['concept'][0].num_topics), dtype=np.float32),
+        }
+        tasks = [
+            (kind, start, min(start + chunk_size, len(topics[kind])))
+            for kind in ['word', 'concept'] for start in range(0, len(topics[kind]), chunk_size)
+        ]
+        if self.num_workers > 1:
+            pool = Pool(
+                self.num_workers, initializer=init_worker, initargs=(self.model_paths, word_docs, concept_docs))
+            results = pool.imap_unordered(infer_range, tasks)
+        else:
+            pool = None
+            init_worker(self.model_paths, word_docs, concept_docs, self.models)
+            results = map(infer_range, tasks)
+        try:
+            for kind, start, rows in tqdm(results, total=len(tasks), desc='Inferring topics'):
+                topics[kind][start: start + len(rows)] = rows
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        # average the lda inferred documents
+        doc_vectors, doc_found = segment_means(topics['word'][doc_rows], doc_ptr)
+        concept_vectors, concept_found = segment_means(topics['concept'], concept_ptr)
+
+        # write to the store, users without documents or concepts are left missing
+        for idx, tid in enumerate(tids):
+            if doc_found[idx] and concept_found[idx]:
+                writer.add(tid, np.concatenate((doc_vectors[idx], concept_vectors[idx]), axis=None))
+
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -214,7 +230,6 @@ if __name__ == '__main__':
     odir = task_dir + 'lda2user_concept/'
     if not os.path.exists(odir):
         os.mkdir(odir)
-    opath_user = odir + 'user.txt'
 
     word_dict_path = odir + 'lda_dict.pkl'
     word_model_path = odir + 'lda.model'
@@ -236,11 +251,12 @@ if __name__ == '__main__':
     # Lda2User
     l2u = Lda2User(
         task_name=task, word_dict_path=word_dict_path, concept_model_path=concept_model_path,
-        concept_dict_path=concept_dict_path, word_model_path=word_model_path
+        concept_dict_path=concept_dict_path, word_model_path=word_model_path,
+        num_workers=os.cpu_count() // 2
     )
     # user vectors
-    # l2u.lda2item_parallel(
     l2u.lda2item(
         data_path=task_data_path, 
-        opath=opath_user,
+        writer=UserEmbWriter(
+            odir, 'lda2user_concept', '../data/processed_data/{}/user_encoder.json'.format(task)),
     )
@@ -7,80 +7,93 @@ import itertools
 from tqdm import tqdm
 import keras
 import numpy as np
-from keras_preprocessing.text import Tokenizer
-import gensim
 from gensim.models.doc2vec import Doc2Vec
 # from keras.preprocessing.sequence import pad_sequences
 # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # for cpu usage
 # os.environ["CUDA_VISIBLE_DEVICES"] = ""
-from baseline_utils import user_word_sampler, data_loader
+from baseline_utils import user_docs_sampler, data_loader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import save_user_embs
+from build_cache import BuildCache
+from pretrained_vectors import open_pretrained_vectors
+from sampling import UnigramSampler
+from token_corpus import TokenCorpus
+from train_pairs import load_pairs, pair_batches, pair_paths, save_pairs
+
+
+def user_concept_pairs(labels, user_concepts, negative_concepts):
+    """Concepts of the pairs of a user, drawn in one RNG call.
+        Positive pairs take the concepts of the user, weighted by their counts,
+        and negative pairs take the concepts the user never had.
+
+    :param labels: uint8 labels of the pairs
+    :param user_concepts: int32 concept indices of the user, repeated by their counts
+    :param negative_concepts: sorted int32 concept indices not of the user
+    :return: int32 concept indices of the pairs
+    """
+    positive = labels == 1
+    sizes = np.where(positive, len(user_concepts), len(negative_concepts))
+    picks = (np.random.random_sample(len(labels)) * sizes).astype(np.int64)
+    concepts = np.zeros(len(labels), dtype=np.int32)
+    concepts[positive] = user_concepts[picks[positive]]
+    concepts[~positive] = negative_concepts[picks[~positive]]
+    return concepts
 
 
 def user_doc_concept_builder(
-        user_docs, all_docs, word_tkn, concept_tkn, user_encoder, negative_samples=1, output_dir=''):
+        user_docs, all_docs, word_tkn, concept_tkn, user_encoder, negative_samples=1, negative_power=None):
     """This function was re-implemented from the Silvio Amir
     https://github.com/samiroid/usr2vec/tree/master/code
 
         user_docs (dict): user docs
         sequence (list): a sequence of word indices
         emb_dim (int): document size
+        negative_power (float): None for the uniform negative words of the original sampler,
+            otherwise the negatives follow the unigram distribution to the power, excluding the document words
+    :return: int32 columns of the user, word and concept indices, uint8 labels
     """
     uids = list(user_docs.keys())
     # np.random.shuffle(uids)
-    user_doc_concepts = []
-    user_doc_labels = []
-
-    for uidx, uid in tqdm(enumerate(uids)):
-        user_concepts = list(itertools.chain.from_iterable(user_docs[uid]['concepts']))
-        user_concepts_set = set(user_concepts)
-        concept_negative_space = [
-            concept_tkn[concept] for concept in concept_tkn if concept not in user_concepts_set]
-        user_concepts = [concept_tkn[concept] for concept in user_concepts if concept in concept_tkn]
-
-        for doc_id in user_docs[uid]['docs']:
-            doc = all_docs[doc_id]
-            # doc = word_tkn.texts_to_sequences([doc])[0]
-            doc_couples, doc_labels = user_word_sampler(
-                uid=user_encoder[uid], sequence=doc,
-                tokenizer=word_tkn, negative_samples=negative_samples
-            )
-
-            for idx in range(len(doc_labels)):
-                if doc_labels[idx] == 1:
-                    doc_couples[idx].append(np.random.choice(user_concepts))
-                else:  # negative samples
-                    doc_couples[idx].append(np.random.choice(concept_negative_space))
-            user_doc_concepts.extend(doc_couples)
-            user_doc_labels.extend(doc_labels)
-
-    user_doc_concepts = np.asarray(user_doc_concepts, dtype=object)
-    user_doc_labels = np.asarray(user_doc_labels)
-
-    tmp = {
-        'user_doc_concepts': user_doc_concepts,
-        'user_doc_labels': user_doc_labels,
-    }
-    with open(output_dir + 'usr2vec_user_docs.pkl', 'wb') as wfile:
-        pickle.dump(tmp, wfile)
-    del tmp
-
-    return user_doc_concepts, user_doc_labels
-
-
-def user_doc_generator(user_words_concepts, doc_labels, batch_size):
-    # shuffle the dataset
-    rand_indices = list(range(len(doc_labels)))
-    np.random.shuffle(rand_indices)
-    user_words_concepts = user_words_concepts[rand_indices]
-    doc_labels = doc_labels[rand_indices]
-
-    steps = len(doc_labels) // batch_size
-    if len(doc_labels) % batch_size != 0:
-        steps += 1
+    # the negative distribution and the concept space are built once for all users
+    if negative_power is None:
+        # uniform over all word ids, the same as np.random.choice(range(num_words))
+        sampler = UnigramSampler(np.ones(word_tkn.num_words), power=1)
+    else:
+        sampler = UnigramSampler.from_vocab(word_tkn, power=negative_power)
+    all_concepts = np.unique(np.asarray(list(concept_tkn.values()), dtype=np.int32))
+    user_indices = []
+    word_indices = []
+    concept_indices = []
+    labels = []
+    skipped = 0
+
+    for uid in tqdm(uids):
+        user_concepts = np.asarray([
+            concept_tkn[concept] for concept in itertools.chain.from_iterable(user_docs[uid]['concepts'])
+            if concept in concept_tkn
+        ], dtype=np.int32)
+        negative_concepts = np.setdiff1d(all_concepts, user_concepts)
+        # concepts can not be paired without positives or negatives
+        if len(user_concepts) == 0 or len(negative_concepts) == 0:
+            skipped += 1
+            continue
+
+        doc_words, doc_labels = user_docs_sampler(
+            sequences=[all_docs[doc_id] for doc_id in user_docs[uid]['docs']],
+            sampler=sampler, negative_samples=negative_samples, exclude_words=negative_power is not None
+        )
+        user_indices.append(np.full(len(doc_labels), user_encoder[uid], dtype=np.int32))
+        word_indices.append(doc_words)
+        concept_indices.append(user_concept_pairs(doc_labels, user_concepts, negative_concepts))
+        labels.append(doc_labels)
 
-    for idx in range(steps):
-        yield user_words_concepts[batch_size * idx: batch_size * (idx + 1)], \
-              doc_labels[batch_size * idx: batch_size * (idx + 1)]
+    if skipped > 0:
+        print('Skipped {} users without concepts to pair.'.format(skipped))
+    if len(labels) == 0:
+        raise ValueError('No users with concepts to pair!')
+    return [
+        np.concatenate(user_indices), np.concatenate(word_indices), np.concatenate(concept_indices)
+    ], np.concatenate(labels)
 
 
 # design model
@@ -210,64 +223,24 @@ def build_model(params=None):
 
 
 def build_emb_layer(tokenizer, emb_path, save_path):
-    """"""
-    # support three types, bin/txt/npy
-    emb_len = len(tokenizer.word_index)
+    """Extract the rows of the tokenizer vocabulary from the pretrained vectors, bin/txt"""
+    # index 0 is the padding, the known words are from 1 to num_words - 1
+    emb_len = len(tokenizer.word_index) + 1
     if emb_len > tokenizer.num_words:
         emb_len = tokenizer.num_words
 
-    if emb_path.endswith('.bin'):
-        w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-            emb_path, binary=True
-        )
-        emb_model = np.zeros((emb_len, w2v_model.vector_size))
-        for pair in zip(w2v_model.index_to_key, w2v_model.vectors):
-            if pair[0] in tokenizer.word_index and \
-                    tokenizer.word_index[pair[0]] < tokenizer.num_words:
-                emb_model[tokenizer.word_index[pair[0]]] = pair[1]
-
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-
-    elif emb_path.endswith('.txt'):
-        line = open(emb_path).readline()
-        emb_model = np.zeros((emb_len, len(line.strip().split())-1))  # first one is a word not vector.
-        emb_dim = len(line.strip().split()) - 1
-
-        with open(emb_path) as dfile:
-            for line in dfile:
-                line = line.strip().split()
-                word = line[0]
-                vectors = np.asarray(line[1:], dtype='float32')
-                if len(vectors) != emb_dim:
-                    continue
-
-                if word in tokenizer.word_index and \
-                        tokenizer.word_index[word] < tokenizer.num_words:
-                    emb_model[tokenizer.word_index[word]] = vectors
-
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-    else:
-        raise ValueError('Current other formats are not supported!')
+    emb_model = open_pretrained_vectors(emb_path).embedding_matrix(tokenizer.word_index, emb_len)
+    # save the extracted embedding weights
+    np.save(save_path, emb_model)
 
 
 def main(data_name, encode_directory, odirectory='../resources/'):
-    # load tokenizer
-    if os.path.exists(encode_directory + data_name + '.tkn'):
-        tok = pickle.load(open(encode_directory + data_name + '.tkn', 'rb'))
-    else:
-        all_docs = []
-        with open(encode_directory + data_name + '.json') as dfile:
-            for idx, line in enumerate(dfile):
-                user_info = json.loads(line)
-                for doc in user_info['docs']:
-                    all_docs.append(doc['text'])
-
-        tok = Tokenizer(num_words=15001)  # 15000 known + 1 unknown tokens
-        tok.fit_on_texts(all_docs)
-        pickle.dump(tok, open(encode_directory + data_name + '.tkn', 'wb'))
-        del all_docs
+    cache = BuildCache(odirectory)
+    # snippets tokenized by the main approach, its vocabulary is the tokenizer
+    corpus_dir = '../resources/embedding/{}/caue_gru/token_corpus/'.format(data_name)
+    corpus = TokenCorpus(corpus_dir)
+    tok = corpus.vocab(num_words=15001)  # 15000 known + 1 unknown tokens
+    tkn_key = cache.key(inputs=[corpus_dir + 'meta.json'], params={'num_words': tok.num_words})
 
     params = {
         'batch_size': 512,  # to accelerate training speed
@@ -290,6 +263,7 @@ def main(data_name, encode_directory, odirectory='../resources/'):
         'optimizer': 'adam',
         'lr': 3e-5,
         'negative_sample': 3,
+        'negative_power': None,  # None for uniform negative words, .75 for the unigram distribution
         'max_len': 512,
     }
 
@@ -300,28 +274,35 @@ def main(data_name, encode_directory, odirectory='../resources/'):
     # update user information
     params['user_size'] = len(user_encoder) + 1
 
-    if not os.path.exists(odirectory + 'usr2vec_user_docs.pkl'):
-        user_docs, all_docs = data_loader(params['data_path'])  # omit all documents
-        print('Tokenizing Documents...')
-        all_docs = tok.texts_to_sequences(all_docs)
+    pairs_key = cache.key(
+        inputs=[params['data_path'], params['concept_tkn'], encode_directory + 'user_encoder.json'],
+        params={'negative_sample': params['negative_sample'], 'negative_power': params['negative_power']}, deps=[tkn_key]
+    )
+    pair_names = ['uids', 'wids', 'cids']
+    if not cache.fresh('usr2vec_pairs', pairs_key, pair_paths(odirectory, 'usr2vec', pair_names)):
+        user_docs, _ = data_loader(params['data_path'])  # omit all documents
+        # snippets are the documents of the token corpus
+        all_docs = list(corpus.iter_docs(num_words=tok.num_words))
         # build datasets
         user_words_concepts, doc_labels = user_doc_concept_builder(
             user_docs, all_docs, tok, concept_tkn, user_encoder,
-            negative_samples=params['negative_sample'], output_dir=odirectory
+            negative_samples=params['negative_sample'], negative_power=params['negative_power']
         )
+        save_pairs(odirectory, 'usr2vec', pair_names, user_words_concepts, doc_labels)
+        cache.record('usr2vec_pairs', pairs_key, pair_paths(odirectory, 'usr2vec', pair_names))
     else:
-        tmp = pickle.load(open(odirectory + 'usr2vec_user_docs.pkl', 'rb'))
-        user_words_concepts = tmp['user_doc_concepts']
-        doc_labels = tmp['user_doc_labels']
+        user_words_concepts, doc_labels = load_pairs(odirectory, 'usr2vec', pair_names)
 
     if not os.path.exists('../resources/embedding/{}/'.format(data_name)):
         os.mkdir('../resources/embedding/{}/'.format(data_name))
 
     # build embedding model
-    if not os.path.exists(params['word_emb_path']):
+    emb_key = cache.key(inputs=[params['emb_path']], deps=[tkn_key])
+    if not cache.fresh('word_emb', emb_key, [params['word_emb_path']]):
         build_emb_layer(
             tok, params['emb_path'], params['word_emb_path']
         )
+        cache.record('word_emb', emb_key, [params['word_emb_path']])
 
     ud_model = build_model(params)
     print()
@@ -330,7 +311,7 @@ def main(data_name, encode_directory, odirectory='../resources/'):
     for epoch in tqdm(range(params['epochs'])):
         loss = 0
 
-        train_iter = user_doc_generator(
+        train_iter = pair_batches(
             user_words_concepts, doc_labels, params['batch_size']
         )
         total_steps = len(doc_labels) // params['batch_size']
@@ -338,8 +319,6 @@ def main(data_name, encode_directory, odirectory='../resources/'):
         for step, train_batch in tqdm(enumerate(train_iter), total=total_steps):
             '''user info, uw: user-word'''
             ud_pairs, ud_labels = train_batch
-            ud_pairs = [np.array(x, dtype=np.int32) for x in zip(*ud_pairs)]
-            ud_labels = np.array(ud_labels, dtype=np.int32)
 
             '''Train'''
             train_loss = ud_model.train_on_batch(
@@ -362,7 +341,10 @@ def main(data_name, encode_directory, odirectory='../resources/'):
         # save the model
         ud_model.save(odirectory + 'ud_model.h5')
         # save the user embedding
-        np.save(odirectory + 'user.npy', ud_model.get_layer(name='user_emb').get_weights()[0])
+        save_user_embs(
+            odirectory, ud_model.get_layer(name='user_emb').get_weights()[0],
+            'user2vec_concept', encode_directory + 'user_encoder.json'
+        )
 
 
 if __name__ == '__main__':
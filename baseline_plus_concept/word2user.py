@@ -6,20 +6,26 @@ import sys
 import pickle
 import itertools
 
-import gensim
 import numpy as np
-from tqdm import tqdm
+from scipy import sparse
 from baseline_utils import data_loader
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import UserEmbWriter
+from pretrained_vectors import open_pretrained_vectors
+from token_corpus import TokenCorpus, average_rows
+
 
 class Word2User(object):
     """Apply Word2Vec model on the documents to generate user and product representation.
-        Outputs will be one user/product_id + vect per line.
+        Outputs will be saved into the user embedding store.
 
         Parameters
         ----------
         task_name: str
             Task name, such as amazon, yelp and imdb
+        corpus: token_corpus.TokenCorpus
+            Token corpus of the snippets
         tknPath: str
             Path of LDA dictionary file
         modelPath: str
@@ -28,7 +34,9 @@ class Word2User(object):
 
     def __init__(self, **kwargs):
         self.task = kwargs['task_name']
-        self.word_tkn = pickle.load(open(kwargs['word_tkn_path'], 'rb'))
+        self.corpus = kwargs['corpus']
+        # the vocabulary of the word embeddings from usr2vec
+        self.word_tkn = self.corpus.vocab(num_words=kwargs['num_words'])
         self.concept_tkn = pickle.load(open(kwargs['concept_tkn_path'], 'rb'))
         self.emb_dim = kwargs['emb_dim']
         self.word_model = self.__load_model(kwargs['word_emb_path'], self.word_tkn, kwargs['emb_dim'])
@@ -36,81 +44,63 @@ class Word2User(object):
 
     def __load_model(self, modelPath, tkn, emb_dim=300):
         # support three types, bin/txt/npy
+        if modelPath.endswith('.npy'):
+            return np.load(modelPath)
+
         if type(tkn) == dict:
             emb_len = len(tkn)
+            word_index = tkn
         else:
             emb_len = len(self.word_tkn.word_index)
             if emb_len > self.word_tkn.num_words:
                 emb_len = self.word_tkn.num_words
-        model = np.zeros((emb_len + 1, emb_dim))
-
-        if modelPath.endswith('.bin'):
-            w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-                modelPath, binary=True
-            )
-            for pair in zip(w2v_model.wv.index_to_key, w2v_model.wv.syn0):
-                if pair[0] in tkn.word_index and \
-                        tkn.word_index[pair[0]] < tkn.num_words:
-                    model[tkn.word_index[pair[0]]] = pair[1]
-
-        elif modelPath.endswith('.npy'):
-            model = np.load(modelPath)
-
-        elif modelPath.endswith('.txt'):
-            with open(modelPath) as dfile:
-                for line in dfile:
-                    line = line.strip().split()
-                    word = line[0]
-                    vectors = np.asarray(line[1:], dtype='float32')
-
-                    if word in tkn.word_index and \
-                            tkn.word_index[word] < tkn.num_words:
-                        model[tkn.word_index[word]] = vectors
-        else:
-            raise ValueError('Current other formats are not supported!')
-        return model
+            word_index = dict((word, idx) for word, idx in tkn.word_index.items() if idx < tkn.num_words)
+        # only the rows of the known words are read from the pretrained vectors
+        return open_pretrained_vectors(modelPath).embedding_matrix(word_index, emb_len + 1)
 
-    def word2item(self, data_path, opath):
+    def word2item(self, data_path, writer):
         """Extract user vectors from the given data path
 
             Parameters
             ----------
             data_path: str
                 Path of data file, tsv file
-            opath: str
-                Path of output path for user vectors
+            writer: UserEmbWriter
+                Writer of the user embedding store
         """
-        ofile = open(opath, 'w')
-        # load the datasets from caue_gru task
-        user_docs, all_docs = data_loader(data_path)
-
-        for tid in tqdm(list(user_docs.keys())):
-            # encode the document by word2vec TODO
-            # docs = list(itertools.chain.from_iterable([all_docs[doc_id] for doc_id in user_docs[tid]['docs']]))
-            docs = [all_docs[doc_id].split() for doc_id in user_docs[tid]['docs']]
-            docs = list(itertools.chain.from_iterable(docs))
-            concepts = list(itertools.chain.from_iterable(user_docs[tid]['concepts']))
-
-            # average the word2vec inferred documents
-            word_emb = np.mean(np.asarray([
-                self.word_model[self.word_tkn.word_index[word]] for word in docs
-                if word in self.word_tkn.word_index and self.word_tkn.word_index[word] < self.word_tkn.num_words
-            ]), axis=0)
-            # average the word2vec inferred concepts
-            concept_emb = np.mean(np.asarray([
-                self.concept_model[self.concept_tkn[concept]] for concept in concepts
+        # load the datasets from caue_gru task, documents are the snippets of the token corpus
+        user_docs, _ = data_loader(data_path)
+        tids = list(user_docs.keys())
+        num_words = min(self.word_tkn.num_words, len(self.word_model))
+
+        # users x snippets and users x concepts counts
+        doc_rows, doc_cols, concept_rows, concept_cols = [], [], [], []
+        for idx, tid in enumerate(tids):
+            doc_cols.extend(user_docs[tid]['docs'])
+            doc_rows.extend([idx] * len(user_docs[tid]['docs']))
+            concepts = [
+                self.concept_tkn[concept] for concept in itertools.chain.from_iterable(user_docs[tid]['concepts'])
                 if concept in self.concept_tkn
-            ]), axis=0)
+            ]
+            concept_cols.extend(concepts)
+            concept_rows.extend([idx] * len(concepts))
+        user_doc_counts = sparse.csr_matrix(
+            (np.ones(len(doc_rows)), (doc_rows, doc_cols)), shape=(len(tids), self.corpus.num_docs))
+        user_concept_counts = sparse.csr_matrix(
+            (np.ones(len(concept_rows)), (concept_rows, concept_cols)), shape=(len(tids), len(self.concept_model)))
+
+        # average the word2vec inferred documents
+        word_embs, word_found = average_rows(
+            user_doc_counts @ self.corpus.doc_word_counts(num_words=num_words), self.word_model[:num_words])
+        # average the word2vec inferred concepts
+        concept_embs, concept_found = average_rows(user_concept_counts, self.concept_model)
 
-            # write to file
-            ofile.write(
-                tid + '\t' + ' '.join(map(
-                    str, np.concatenate((word_emb, concept_emb), axis=None))
-                ) + '\n'
-            )
+        # write to the store, users without known words or concepts are left missing
+        for idx, tid in enumerate(tids):
+            if word_found[idx] and concept_found[idx]:
+                writer.add(tid, np.concatenate((word_embs[idx], concept_embs[idx]), axis=None))
 
-        ofile.flush()
-        ofile.close()
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -122,10 +112,8 @@ if __name__ == '__main__':
     baseline_dir = '../resources/embedding/'
     task_dir = baseline_dir + dname + '/'
     odir = task_dir + 'word2user_concept/'
-    opath_user = odir + 'user.txt'
 
     resource_dir = '../resources/embedding/'
-    tkn_path = '../data/processed_data/' + dname + '/' + dname + '.tkn'
     model_path = resource_dir + dname + '/word_emb.npy'
 
     # create directories
@@ -138,12 +126,13 @@ if __name__ == '__main__':
 
     # Word2User
     l2u = Word2User(
-        task_name=dname, word_tkn_path=tkn_path, word_emb_path=model_path,
+        task_name=dname, word_emb_path=model_path,
+        corpus=TokenCorpus('../resources/embedding/{}/caue_gru/token_corpus/'.format(dname)), num_words=15001,
         concept_tkn_path=data_dir+'concept_tkn.pkl', emb_dim=300,
         concept_emb_path='../resources/embedding/{}/caue_gru/{}_concept_emb.npy'.format(dname, dname)
     )
     # user vectors
     l2u.word2item(
         data_path=task_data_path,
-        opath=opath_user
+        writer=UserEmbWriter(odir, 'word2user_concept', data_dir + 'user_encoder.json')
     )
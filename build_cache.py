@@ -0,0 +1,145 @@
+"""Content-addressed cache of the data preparation stages
+
+Every stage is keyed by the digests of its input files, its parameters and the keys of the stages it depends on.
+The keys of the built stages and their outputs are recorded in build_manifest.json of the cache directory,
+a stage is rebuilt only when its key changes or one of its outputs is missing:
+    cache = BuildCache(odir)
+    key = cache.key(inputs=[data_path], params={'max_len': 512})
+    if not cache.fresh('user_docs', key, [opath]):
+        ... build and save opath ...
+        cache.record('user_docs', key, [opath])
+Stages over many users can be built incrementally by RecordCache, only the new or changed records are processed.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+from emb_store import file_hash
+
+FORMAT_VERSION = 1
+
+
+def params_digest(params):
+    """sha1 of json serializable parameters, independent of the key order"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class BuildCache(object):
+    """Keys and outputs of the built stages.
+        File digests are memoized by their sizes and modification times, large inputs are hashed once.
+
+        Parameters
+        ----------
+        cache_dir: str
+            Directory of the manifest
+        manifest_name: str
+            File name of the manifest
+    """
+    def __init__(self, cache_dir, manifest_name='build_manifest.json'):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.manifest_path = os.path.join(cache_dir, manifest_name)
+        self.manifest = {'format_version': FORMAT_VERSION, 'stages': {}, 'files': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as dfile:
+                manifest = json.load(dfile)
+            if manifest.get('format_version') == FORMAT_VERSION:
+                self.manifest = manifest
+
+    def digest(self, path):
+        """Digest of an input file, None if it does not exist"""
+        if not os.path.exists(path):
+            return None
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        info = self.manifest['files'].get(path)
+        if info is None or info['size'] != stat.st_size or info['mtime_ns'] != stat.st_mtime_ns:
+            info = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': file_hash(path)}
+            self.manifest['files'][path] = info
+        return info['digest']
+
+    def key(self, inputs=(), params=None, deps=()):
+        """Key of a stage
+
+        :param inputs: paths of the input files
+        :param params: json serializable parameters of the stage
+        :param deps: keys of the upstream stages
+        :return: hex digest
+        """
+        return params_digest({
+            'format_version': FORMAT_VERSION,
+            'inputs': [self.digest(path) for path in inputs],
+            'params': params,
+            'deps': list(deps),
+        })
+
+    def stage_key(self, stage):
+        """Recorded key of a stage, None if never built"""
+        return self.manifest['stages'].get(stage, {}).get('key')
+
+    def fresh(self, stage, key, outputs=()):
+        """The stage was built with the same key and all its outputs exist"""
+        return self.stage_key(stage) == key and all(os.path.exists(path) for path in outputs)
+
+    def record(self, stage, key, outputs=()):
+        self.manifest['stages'][stage] = {'key': key, 'outputs': list(outputs)}
+        self.save()
+
+    def invalidate(self, stage):
+        if self.manifest['stages'].pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        with open(self.manifest_path + '.tmp', 'w') as wfile:
+            json.dump(self.manifest, wfile)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+
+class RecordCache(object):
+    """Values of the records of an incremental stage, each is kept with the digest of its content.
+        All records are dropped when the parameters change,
+        records not requested since the loading are dropped when saving.
+
+        Parameters
+        ----------
+        path: str
+            Pickle path of the records
+        params_key: str
+            Digest of the stage parameters the values depend on
+    """
+    def __init__(self, path, params_key):
+        self.path = path
+        self.params_key = params_key
+        self.records = dict()
+        if os.path.exists(path):
+            with open(path, 'rb') as dfile:
+                cached = pickle.load(dfile)
+            if cached.get('params_key') == params_key:
+                self.records = cached['records']
+        self.used = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, record_id, digest, default=None):
+        """Cached value of the record if its content is unchanged"""
+        if record_id in self.records and self.records[record_id][0] == digest:
+            self.hits += 1
+            self.used[record_id] = self.records[record_id]
+            return self.used[record_id][1]
+        self.misses += 1
+        return default
+
+    def put(self, record_id, digest, value):
+        self.used[record_id] = (digest, value)
+
+    def save(self):
+        with open(self.path + '.tmp', 'wb') as wfile:
+            pickle.dump({'params_key': self.params_key, 'records': self.used}, wfile)
+        os.replace(self.path + '.tmp', self.path)
+        self.records = self.used
+
+
+def record_digest(*items):
+    """sha1 of the json serialized items of a record"""
+    return params_digest(list(items))
@@ -0,0 +1,373 @@
+"""Consolidated store of the extracted medical concepts
+
+The extraction writes the concepts into a few sharded ``.npz`` files instead of per-note ``{uid}_{doc_id}.pkl``
+files, the pickles of earlier runs are migrated once. Every shard keeps the concepts of its documents as columns,
+ragged by the document pointers:
+    doc_ptr: concepts of the i-th document are rows doc_ptr[i]:doc_ptr[i+1]
+    cui_ids, name_ids, scores: one row per concept
+    sem_ptr, sem_ids: semantic types of the j-th concept are sem_ids[sem_ptr[j]:sem_ptr[j+1]]
+The string vocabularies are saved in vocab.json and the document keys of every shard in index.json,
+with the digest of the concepts of every document and the size and modification time of the pickle
+each document was migrated from.
+A document added again is read from its latest shard, the shards are compacted when the writer is closed.
+Readers get back the same concept dicts as the pickles (semtypes, score, preferred_name, cui).
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+FORMAT_VERSION = 1
+
+
+def concepts_digest(concepts):
+    """Short sha1 of the concept dicts of a document, scores are compared as floats the same as the readers"""
+    content = [
+        [concept['cui'], concept['preferred_name'], float(concept['score']), list(concept['semtypes'])]
+        for concept in concepts
+    ]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()[:16]
+
+
+class ConceptStoreWriter(object):
+    """Append documents into a concept store, existing shards are kept.
+
+        Parameters
+        ----------
+        store_dir: str
+            Directory of the concept store
+        shard_size: int
+            Number of documents per shard
+    """
+    def __init__(self, store_dir, shard_size=50000):
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.index = {'format_version': FORMAT_VERSION, 'shards': []}
+        self.vocab = {'cuis': [], 'names': [], 'semtypes': []}
+        if os.path.exists(os.path.join(store_dir, 'index.json')):
+            with open(os.path.join(store_dir, 'index.json')) as dfile:
+                self.index = json.load(dfile)
+            with open(os.path.join(store_dir, 'vocab.json')) as dfile:
+                self.vocab = json.load(dfile)
+        self.encoders = dict(
+            (field, dict((item, idx) for idx, item in enumerate(self.vocab[field]))) for field in self.vocab
+        )
+        self.doc_keys = set(itertools.chain.from_iterable(shard['docs'] for shard in self.index['shards']))
+        # doc key -> [size, mtime_ns] of its source pickle
+        self.index.setdefault('sources', dict())
+        # doc key -> digest of its concepts, readers check changed documents without decoding them
+        self.index.setdefault('digests', dict())
+        # shard names are not reused, compacted shards are written next to the old ones
+        self.index.setdefault('next_shard', len(self.index['shards']))
+        self.reset()
+
+    def reset(self):
+        self.buffer_docs = []
+        self.buffer_sources = dict()
+        self.buffer_digests = dict()
+        self.doc_ptr = [0]
+        self.cui_ids = []
+        self.name_ids = []
+        self.scores = []
+        self.sem_ptr = [0]
+        self.sem_ids = []
+
+    def encode(self, field, item):
+        if item not in self.encoders[field]:
+            self.encoders[field][item] = len(self.vocab[field])
+            self.vocab[field].append(item)
+        return self.encoders[field][item]
+
+    def __contains__(self, doc_key):
+        return doc_key in self.doc_keys
+
+    def source(self, doc_key):
+        """Recorded [size, mtime_ns] of the source of a document, None if unknown"""
+        return self.index['sources'].get(doc_key)
+
+    def add(self, doc_key, concepts, source=None):
+        """Add the concept dicts of one document, a document added again replaces its previous concepts
+
+        :param source: [size, mtime_ns] of the pickle the concepts are from
+        """
+        for concept in concepts:
+            self.cui_ids.append(self.encode('cuis', concept['cui']))
+            self.name_ids.append(self.encode('names', concept['preferred_name']))
+            self.scores.append(float(concept['score']))
+            self.sem_ids.extend(self.encode('semtypes', semtype) for semtype in concept['semtypes'])
+            self.sem_ptr.append(len(self.sem_ids))
+        self.doc_ptr.append(len(self.cui_ids))
+        self.buffer_docs.append(doc_key)
+        self.doc_keys.add(doc_key)
+        self.buffer_digests[doc_key] = concepts_digest(concepts)
+        if source is not None:
+            self.buffer_sources[doc_key] = source
+
+        if len(self.buffer_docs) >= self.shard_size:
+            self.flush()
+
+    def append_row(self, doc_key, shard, row):
+        """Copy a document row of a loaded shard into the buffer"""
+        start, end = shard['doc_ptr'][row], shard['doc_ptr'][row + 1]
+        self.cui_ids.extend(shard['cui_ids'][start: end].tolist())
+        self.name_ids.extend(shard['name_ids'][start: end].tolist())
+        self.scores.extend(shard['scores'][start: end].tolist())
+        sem_start = shard['sem_ptr'][start]
+        self.sem_ptr.extend((shard['sem_ptr'][start + 1: end + 1] - sem_start + len(self.sem_ids)).tolist())
+        self.sem_ids.extend(shard['sem_ids'][sem_start: shard['sem_ptr'][end]].tolist())
+        self.doc_ptr.append(len(self.cui_ids))
+        self.buffer_docs.append(doc_key)
+
+    def write_shard(self):
+        shard_name = 'shard_{:05d}.npz'.format(self.index['next_shard'])
+        self.index['next_shard'] += 1
+        np.savez(
+            os.path.join(self.store_dir, shard_name),
+            doc_ptr=np.asarray(self.doc_ptr, dtype=np.int64),
+            cui_ids=np.asarray(self.cui_ids, dtype=np.int32),
+            name_ids=np.asarray(self.name_ids, dtype=np.int32),
+            # float64 keeps the comparisons with the original string scores exact
+            scores=np.asarray(self.scores, dtype=np.float64),
+            sem_ptr=np.asarray(self.sem_ptr, dtype=np.int64),
+            sem_ids=np.asarray(self.sem_ids, dtype=np.int32),
+        )
+        self.index['shards'].append({'name': shard_name, 'docs': self.buffer_docs})
+        # sources are recorded with their shard, unflushed documents are migrated again after a crash
+        self.index['sources'].update(self.buffer_sources)
+        self.index['digests'].update(self.buffer_digests)
+        self.reset()
+
+    def flush(self):
+        if len(self.buffer_docs) == 0:
+            return
+        self.write_shard()
+        self.save_meta()
+
+    def fragmented(self):
+        """Some documents have several rows, or there are more shards than needed"""
+        num_rows = sum(len(shard['docs']) for shard in self.index['shards'])
+        min_shards = -(-len(self.doc_keys) // self.shard_size)
+        return num_rows > len(self.doc_keys) or len(self.index['shards']) > min_shards + 1
+
+    def compact(self):
+        """Rewrite the shards with only the latest row of every document, full shards in the order of the rows.
+            The index switches to the new shards at once, the old shards are removed afterwards.
+        """
+        self.flush()
+        latest = dict()
+        for sdx, shard_info in enumerate(self.index['shards']):
+            for row, doc_key in enumerate(shard_info['docs']):
+                latest[doc_key] = (sdx, row)
+
+        old_shards = self.index['shards']
+        self.index['shards'] = []
+        for sdx, shard_info in enumerate(tqdm(old_shards, desc='Compacting concept shards')):
+            with np.load(os.path.join(self.store_dir, shard_info['name'])) as dfile:
+                shard = dict((key, dfile[key]) for key in dfile.files)
+            for row, doc_key in enumerate(shard_info['docs']):
+                if latest[doc_key] != (sdx, row):
+                    continue
+                self.append_row(doc_key, shard, row)
+                if len(self.buffer_docs) >= self.shard_size:
+                    self.write_shard()
+        if len(self.buffer_docs) > 0:
+            self.write_shard()
+        self.save_meta()
+
+        for shard_info in old_shards:
+            os.remove(os.path.join(self.store_dir, shard_info['name']))
+
+    def save_meta(self):
+        # vocab first, an index never points to names missing in the vocab
+        for fname, content in [('vocab.json', self.vocab), ('index.json', self.index)]:
+            with open(os.path.join(self.store_dir, fname + '.tmp'), 'w') as wfile:
+                json.dump(content, wfile)
+            os.replace(os.path.join(self.store_dir, fname + '.tmp'), os.path.join(self.store_dir, fname))
+
+    def close(self):
+        self.flush()
+        if self.fragmented():
+            self.compact()
+        self.save_meta()
+
+
+class ConceptStore(object):
+    """Reader of the concept store, shards are loaded on the first access,
+        the max_shards most recently used shards are cached.
+        Documents appearing in several shards are read from the latest one.
+    """
+    def __init__(self, store_dir, max_shards=4):
+        self.store_dir = store_dir
+        self.max_shards = max_shards
+        with open(os.path.join(store_dir, 'index.json')) as dfile:
+            self.index = json.load(dfile)
+        with open(os.path.join(store_dir, 'vocab.json')) as dfile:
+            self.vocab = json.load(dfile)
+
+        # doc key -> (shard index, row in shard)
+        self.doc_index = dict()
+        for sdx, shard in enumerate(self.index['shards']):
+            for row, doc_key in enumerate(shard['docs']):
+                self.doc_index[doc_key] = (sdx, row)
+        self.shards = OrderedDict()
+
+    def __contains__(self, doc_key):
+        return doc_key in self.doc_index
+
+    def __len__(self):
+        return len(self.doc_index)
+
+    def doc_keys(self):
+        return list(self.doc_index.keys())
+
+    def load_shard(self, sdx, cache=True):
+        """Arrays of a shard, cache=False reads it without touching the cache"""
+        if sdx in self.shards:
+            self.shards.move_to_end(sdx)
+            return self.shards[sdx]
+        with np.load(os.path.join(self.store_dir, self.index['shards'][sdx]['name'])) as dfile:
+            shard = dict((key, dfile[key]) for key in dfile.files)
+        if cache:
+            self.shards[sdx] = shard
+            if len(self.shards) > self.max_shards:
+                self.shards.popitem(last=False)
+        return shard
+
+    def decode(self, shard, row):
+        concepts = []
+        for cdx in range(shard['doc_ptr'][row], shard['doc_ptr'][row + 1]):
+            concepts.append({
+                'semtypes': [
+                    self.vocab['semtypes'][sem_id]
+                    for sem_id in shard['sem_ids'][shard['sem_ptr'][cdx]: shard['sem_ptr'][cdx + 1]]
+                ],
+                'score': float(shard['scores'][cdx]),
+                'preferred_name': self.vocab['names'][shard['name_ids'][cdx]],
+                'cui': self.vocab['cuis'][shard['cui_ids'][cdx]],
+            })
+        return concepts
+
+    def digest(self, doc_key):
+        """Digest of the concepts of a document, None if missing.
+            Documents stored before the digests were saved are decoded to compute it.
+        """
+        if doc_key not in self.doc_index:
+            return None
+        digest = self.index.get('digests', dict()).get(doc_key)
+        if digest is None:
+            digest = concepts_digest(self.get(doc_key))
+        return digest
+
+    def __getitem__(self, doc_key):
+        if doc_key not in self.doc_index:
+            raise KeyError(doc_key)
+        return self.get(doc_key)
+
+    def get(self, doc_key, default=None):
+        """Concept dicts of one document"""
+        if doc_key not in self.doc_index:
+            return default
+        sdx, row = self.doc_index[doc_key]
+        return self.decode(self.load_shard(sdx), row)
+
+    def bulk(self, doc_keys):
+        """Concept dicts of the given documents, read shard by shard.
+            Use iter_docs to go through all documents, or get for random access.
+
+        :param doc_keys: list of document keys, {uid}_{doc_id}, missing keys are skipped
+        :return: dict of doc key and its concept dicts
+        """
+        shard_rows = dict()
+        for doc_key in doc_keys:
+            if doc_key not in self.doc_index:
+                continue
+            sdx, row = self.doc_index[doc_key]
+            if sdx not in shard_rows:
+                shard_rows[sdx] = []
+            shard_rows[sdx].append((doc_key, row))
+
+        results = dict()
+        for sdx in sorted(shard_rows):
+            # bulk reads go through the shards once, no need to keep them
+            shard = self.load_shard(sdx, cache=False)
+            for doc_key, row in shard_rows[sdx]:
+                results[doc_key] = self.decode(shard, row)
+        return results
+
+    def iter_docs(self):
+        """Iterate over (doc key, concept dicts) of all documents, shard by shard"""
+        for sdx, shard_info in enumerate(self.index['shards']):
+            shard = self.load_shard(sdx, cache=False)
+            for row, doc_key in enumerate(shard_info['docs']):
+                if self.doc_index[doc_key] == (sdx, row):
+                    yield doc_key, self.decode(shard, row)
+
+
+def migrate(concept_dir, store_dir, shard_size=50000):
+    """Convert the per-note concept pickles of earlier runs into the store.
+        Documents are skipped when their pickles have the same sizes and modification times as at their
+        last migration, pickles written again by a new extraction replace the concepts in the store.
+
+    :return: number of migrated documents
+    """
+    writer = ConceptStoreWriter(store_dir, shard_size=shard_size)
+    flist = sorted(fname for fname in os.listdir(concept_dir) if fname.endswith('.pkl'))
+    count = 0
+    for fname in tqdm(flist):
+        doc_key = fname[:-len('.pkl')]
+        stat = os.stat(os.path.join(concept_dir, fname))
+        source = [stat.st_size, stat.st_mtime_ns]
+        if doc_key in writer and writer.source(doc_key) == source:
+            continue
+        with open(os.path.join(concept_dir, fname), 'rb') as dfile:
+            writer.add(doc_key, pickle.load(dfile), source)
+        count += 1
+    writer.close()
+    return count
+
+
+def store_path(concept_dir):
+    """Default location of the store, next to the concept directory"""
+    return concept_dir.rstrip('/') + '_store/'
+
+
+def open_concept_writer(concept_dir, store_dir=None, shard_size=50000):
+    """Writer of the concept store of a concept directory, the pickles of earlier runs are migrated on the first use"""
+    if store_dir is None:
+        store_dir = store_path(concept_dir)
+    if not os.path.exists(os.path.join(store_dir, 'index.json')) and os.path.exists(concept_dir):
+        print('Migrating concepts from {} to {}'.format(concept_dir, store_dir))
+        migrate(concept_dir, store_dir, shard_size)
+    return ConceptStoreWriter(store_dir, shard_size=shard_size)
+
+
+def open_concept_store(concept_dir, store_dir=None):
+    """Open the concept store of a concept directory, it is migrated from the pickles on the first use"""
+    if store_dir is None:
+        store_dir = store_path(concept_dir)
+    if not os.path.exists(os.path.join(store_dir, 'index.json')):
+        if not os.path.exists(concept_dir):
+            raise ValueError('Neither concept store nor concept directory found: {}'.format(concept_dir))
+        print('Migrating concepts from {} to {}'.format(concept_dir, store_dir))
+        migrate(concept_dir, store_dir)
+    return ConceptStore(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate concept pickles into the concept store.')
+    parser.add_argument('--concept_dir', type=str, help='Directory of {uid}_{doc_id}.pkl concept files')
+    parser.add_argument('--store_dir', type=str, default=None, help='Default to {concept_dir}_store/')
+    parser.add_argument('--shard_size', type=int, default=50000)
+    args = parser.parse_args()
+
+    print('Migrated documents: ', migrate(
+        args.concept_dir, args.store_dir if args.store_dir else store_path(args.concept_dir), args.shard_size))
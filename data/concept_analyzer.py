@@ -23,6 +23,10 @@ import pandas as pd
 from keras.models import Sequential
 from keras.layers import Dense
 from keras.regularizers import L1L2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from concept_store import open_concept_store
+
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
 
@@ -39,17 +43,14 @@ def concept_stats(concept_dir, odir, task_name):
     score_filter = True  # to control if we use selected entities
 
     # number of medical documents
-    flist = os.listdir(concept_dir)
-
-    for fname in flist:
-        uid = fname.split('_')[0]
+    for doc_key, concepts in open_concept_store(concept_dir).iter_docs():
+        uid = doc_key.split('_')[0]
         if uid not in user_concepts:
             # record semantic types and individual tokens
             user_concepts[uid] = {
                 'semtypes': [],
                 'entities': [],
             }
-        concepts = pickle.load(open(concept_dir + fname, 'rb'))
         # control scores of the named entities
         for concept in concepts:
             if score_filter and float(concept['score']) < 3.6:
@@ -89,7 +90,6 @@ def qual_concepts_sim(**kwargs):
     odir = kwargs['output_dir']
     task_name = kwargs['task_name']
 
-    concept_files = set(os.listdir(concept_dir))
     data_stats = json.load(open(data_stats_path))
     labels = [item[0] for item in data_stats['tag_stats']]
 
@@ -98,6 +98,8 @@ def qual_concepts_sim(**kwargs):
         user_docs = pickle.load(open(odir + 'user_docs_{}.pkl'.format(task_name), 'rb'))
     else:
         user_docs = {}
+        # concepts are decoded per document, the shards are read once and cached
+        doc_concepts = open_concept_store(concept_dir)
         with open(corpus_path) as dfile:
             for line in dfile:
                 user_entry = json.loads(line)
@@ -121,9 +123,9 @@ def qual_concepts_sim(**kwargs):
                 uid = user_entry['uid'].split('-')[0]
                 for doc_entry in user_entry['docs']:
                     did = doc_entry['doc_id']
-                    fname = '{}_{}.pkl'.format(uid, did)
-                    if fname in concept_files:
-                        concepts = pickle.load(open(concept_dir + fname, 'rb'))
+                    concept_key = '{}_{}'.format(uid, did)
+                    if concept_key in doc_concepts:
+                        concepts = doc_concepts[concept_key]
                         concepts = [item['preferred_name'] for item in concepts]
                         user_docs[user_entry['uid']]['entity'].extend(concepts)
 
@@ -257,7 +259,6 @@ def quant_concepts_sim(**kwargs):
     task_name = kwargs['task_name']
     clf_name = kwargs['clf_name']
 
-    concept_files = set(os.listdir(concept_dir))
     data_stats = json.load(open(data_stats_path))
     num_label = 10  # only experiment with top 10 labels
     top_labels = [item[0] for item in data_stats['tag_stats']]
@@ -267,6 +268,8 @@ def quant_concepts_sim(**kwargs):
         user_docs = pickle.load(open(odir + 'user_docs_{}.pkl'.format(task_name), 'rb'))
     else:
         user_docs = {}
+        # concepts are decoded per document, the shards are read once and cached
+        doc_concepts = open_concept_store(concept_dir)
         with open(corpus_path) as dfile:
             for line in dfile:
                 user_entry = json.loads(line)
@@ -290,9 +293,9 @@ def quant_concepts_sim(**kwargs):
                 uid = user_entry['uid'].split('-')[0]
                 for doc_entry in user_entry['docs']:
                     did = doc_entry['doc_id']
-                    fname = '{}_{}.pkl'.format(uid, did)
-                    if fname in concept_files:
-                        concepts = pickle.load(open(concept_dir + fname, 'rb'))
+                    concept_key = '{}_{}'.format(uid, did)
+                    if concept_key in doc_concepts:
+                        concepts = doc_concepts[concept_key]
                         concepts = [item['preferred_name'] for item in concepts]
                         user_docs[user_entry['uid']]['entity'].extend(concepts)
 
@@ -0,0 +1,544 @@
+"""Concept extraction engine
+
+A pool of long-lived worker processes, each worker builds one extraction backend when it starts
+and keeps it for its lifetime. Sentences of a note are sent to the backend in large batches with
+integer ids, and the extracted concepts are routed back to their sentences by the ids.
+The concepts are written into the concept store of the concept directory, {concept_dir}_store/.
+Finished notes are recorded in a manifest next to the concept directory once their concepts are in a shard,
+a crashed run resumes from the notes that were neither recorded nor stored.
+"""
+import argparse
+import json
+import os
+import logging
+import re
+import sys
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+from nltk.tokenize import sent_tokenize
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from concept_store import open_concept_store, open_concept_writer
+
+# default options of the MIMIC-III notes, documentation: https://metamap.nlm.nih.gov/Docs/MM_2016_Usage.pdf
+METAMAP_OPTIONS = {
+    'word_sense_disambiguation': True,
+    'unique_acronym_variants': True,
+    'ignore_stop_phrases': True,
+    'no_derivational_variants': True,
+}
+# options of the diabetes notes, excluding semantic types that are mostly noise in the reports
+DIABETES_METAMAP_OPTIONS = {
+    'word_sense_disambiguation': True,
+    'unique_acronym_variants': True,
+    'ignore_stop_phrases': True,
+    'no_derivational_variants': True,
+    'no_nums': ['all'],
+    'exclude_sts': [
+        'bpoc', 'spco', 'lang', 'npop', 'orgf', 'qnco', 'tmco', 'hlca', 'idcn', 'hcro', 'clna',
+        'ftcn', 'qlco', 'fndg', 'acty', 'mnob', 'plnt', 'podg', 'popg', 'prog', 'pros', 'elii',
+        'anim', 'inpr'
+    ],
+}
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def process_concepts(entities):
+    results = []
+    for entity in entities:
+        item = dict()
+        try:
+            item['semtypes'] = entity.semtypes.lstrip('[').rstrip(']').split(',')
+        except AttributeError:
+            continue
+        # define filter list
+        # if 'qnco' in item['semtypes']:  # filter out Quantitative Concept: per year
+        #     continue
+        # if 'tmco' in item['semtypes']:  # filter out Temporal Concept: day
+        #     continue
+        # if 'hlca' in item['semtypes']:  # Health Care Activity: Hospital admission; Tapering - action;
+        #     continue
+        # if 'idcn' in item['semtypes']:  # Idea or Concept: Presentation
+        #     continue
+        # if 'hcro' in item['semtypes']:  # Health Care Related Organization: Accident and Emergency department
+        #     continue
+        # if 'clna' in item['semtypes']:  # Clinical Attribute: History of present illness
+        #     continue
+        # if 'ftcn' in item['semtypes']:  # Functional Concept: Negation, Extraocular; Due to
+        #     continue
+        # if 'qlco' in item['semtypes']:  # Qualitative Concept: Started
+        #     continue
+        # if 'fndg' in item['semtypes']:  # Finding: Present
+        #     continue
+        # if 'acty' in item['semtypes']:  # Activity: Obscure; Assessed; Departure - action
+        #     continue
+        # if 'mnob' in item['semtypes']:  # Manufactured Object: Machine; Beds
+        #     continue
+        # if 'plnt' in item['semtypes']:  # Plant
+        #     continue
+        # if 'podg' in item['semtypes']:  # Patient or Disabled Group: Patients
+        #     continue
+        # if 'popg' in item['semtypes']:  # Population Group
+        #     continue
+        # if 'prog' in item['semtypes']:  # Professional or Occupational Group: Physicians
+        #     continue
+        # if 'pros' in item['semtypes']:  # Professional Society
+        #     continue
+        # if 'elii' in item['semtypes']:  # Element, Ion, or Isotope: lead
+        #     continue
+        # if 'anim' in item['semtypes']:  # Animal: Show
+        #     continue
+        # if 'inpr' in item['semtypes']:  # Intellectual Product: Code; Telephone Number
+        #     continue
+        # if 'orgf' in item['semtypes']:  # Organism Function: Movement; Expiration, function; Inspiration function
+        #     continue
+        # if 'npop' in item['semtypes']:  # Natural Phenomenon or Process: Saturated
+        #     continue
+        # if 'lang' in item['semtypes']:  # Language: Herero language
+        #     continue
+        # if 'spco' in item['semtypes']:  # Spatial Concept: Scattered; Round shape
+        #     continue
+        # if 'bpoc' in item['semtypes']:  # Body Part, Organ, or Organ Component: Eminence
+        #     continue
+        # if 'phsf' in item['semtypes']:  # Physiologic Function: Respiration
+        #     continue
+        # if 'clas' in item['semtypes']:  # Classification: Trial Phase
+        #     continue
+        # if 'food' in item['semtypes']:  # Food: Food
+        #     continue
+        # if 'orga' in item['semtypes']:  # Organism Attribute: Body Temperature
+        #     continue
+        # if 'cnce' in item['semtypes']:  # Conceptual Entity: System Alert
+        #     continue
+        # if 'ocdi' in item['semtypes']:  # Occupation or Discipline: Science of Chemistry
+        #     continue
+        # if 'resa' in item['semtypes']:  # Research Activity: Diagnosis Study
+        #     continue
+        # if 'lbpr' in item['semtypes']:  # Laboratory Procedure: International Normalized Ratio
+        #     continue
+
+        # item['index'] = len(results)
+        # item['mm'] = entity.mm
+        item['score'] = entity.score
+        item['preferred_name'] = entity.preferred_name
+        item['cui'] = entity.cui
+        # item['trigger'] = entity.trigger.lstrip('[').rstrip(']').split(',')
+        # item['pos_info'] = entity.pos_info
+        results.append(item)
+
+    return results
+
+
+class ConceptBackend(object):
+    """Interface of the concept-extraction backends.
+        ``extract`` takes a list of sentences and returns a list of concept dicts per sentence,
+        every concept dict has the keys of semtypes, score, preferred_name and cui.
+    """
+    def extract(self, sentences):
+        raise NotImplementedError
+
+
+class MetaMapBackend(ConceptBackend):
+    """MetaMap through pymetamap, one instance per worker process.
+
+        Parameters
+        ----------
+        metamap_home: str
+            Path of the MetaMap binary, default to the METAMAP_HOME environment variable
+        batch_size: int
+            Maximum number of sentences per MetaMap call
+        max_chars: int
+            Maximum number of characters per MetaMap call
+        fallback_size: int
+            Number of sentences per call to retry a batch that MetaMap outputs cannot be parsed
+        partition_size: int
+            Split sentences longer than this number of tokens when retrying, None to disable
+        fallback_options: dict
+            Extra options of the retries, e.g., {'prune': 33}
+        options:
+            Options of pymetamap extract_concepts, default to METAMAP_OPTIONS
+    """
+    def __init__(self, metamap_home=None, batch_size=200, max_chars=50000, fallback_size=5,
+                 partition_size=None, fallback_options=None, **options):
+        self.mm = self.get_instance(metamap_home if metamap_home else os.environ['METAMAP_HOME'])
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.fallback_size = fallback_size
+        self.partition_size = partition_size
+        self.options = options if options else dict(METAMAP_OPTIONS)
+        self.fallback_options = dict(self.options)
+        if fallback_options:
+            self.fallback_options.update(fallback_options)
+
+    def get_instance(self, metamap_home):
+        from pymetamap import MetaMap
+        return MetaMap.get_instance(metamap_home)
+
+    def batches(self, sentences):
+        batch = []
+        num_chars = 0
+        for idx, sentence in enumerate(sentences):
+            if len(batch) > 0 and (len(batch) == self.batch_size or num_chars + len(sentence) > self.max_chars):
+                yield batch
+                batch = []
+                num_chars = 0
+            batch.append(idx)
+            num_chars += len(sentence)
+        if len(batch) > 0:
+            yield batch
+
+    def extract_batch(self, sentences, ids, results, options):
+        """Run MetaMap once and group the concepts by sentence ids"""
+        concepts, error = self.mm.extract_concepts(sentences=sentences, ids=ids, **options)
+        for concept in concepts if concepts else []:
+            try:
+                idx = int(str(concept.index).strip('\'" '))
+            except ValueError:
+                continue
+            if idx not in results:
+                results[idx] = []
+            results[idx].append(concept)
+
+    def retry_step(self, sentences, step_ids, results):
+        if self.partition_size is None:
+            step_sents = [sentences[idx] for idx in step_ids]
+        else:
+            # long sentences are split into partitions, all of them keep the id of their sentence
+            step_sents = []
+            tmp_ids = []
+            for idx in step_ids:
+                tokens = sentences[idx].split()
+                for start in range(0, max(len(tokens), 1), self.partition_size):
+                    step_sents.append(' '.join(tokens[start: start + self.partition_size]))
+                    tmp_ids.append(idx)
+            step_ids = tmp_ids
+        self.extract_batch(step_sents, step_ids, results, self.fallback_options)
+
+    def extract(self, sentences):
+        """Extract concepts of every sentence
+
+        :param sentences: list of sentences
+        :return: list of concept dicts per sentence
+        """
+        found = dict()
+        for batch in self.batches(sentences):
+            batch_found = dict()
+            try:
+                self.extract_batch([sentences[idx] for idx in batch], batch, batch_found, self.options)
+            except IndexError:
+                # long sentences break the output parser, retry by small steps and skip the failed ones
+                batch_found = dict()
+                for step in range(0, len(batch), self.fallback_size):
+                    step_found = dict()
+                    try:
+                        self.retry_step(sentences, batch[step: step + self.fallback_size], step_found)
+                    except IndexError:
+                        continue
+                    batch_found.update(step_found)
+            found.update(batch_found)
+
+        return [process_concepts(found[idx]) if idx in found else [] for idx in range(len(sentences))]
+
+
+class MetaMapLiteBackend(MetaMapBackend):
+    """MetaMapLite through pymetamap, supported options are restrict_to_sts and restrict_to_sources"""
+    def __init__(self, metamap_home=None, batch_size=200, max_chars=50000, fallback_size=5, **options):
+        super(MetaMapLiteBackend, self).__init__(
+            metamap_home=metamap_home, batch_size=batch_size, max_chars=max_chars,
+            fallback_size=fallback_size, **options
+        )
+        if not options:
+            self.options = dict()
+            self.fallback_options = dict()
+
+    def get_instance(self, metamap_home):
+        from pymetamap import MetaMapLite
+        return MetaMapLite.get_instance(metamap_home)
+
+
+class StubBackend(ConceptBackend):
+    """Deterministic backend for testing the pipeline without MetaMap:
+        every alphabetic token longer than min_len becomes a concept with a hashed CUI.
+    """
+    def __init__(self, min_len=6, score=5.0, **kwargs):
+        self.min_len = min_len
+        self.score = score
+
+    def extract(self, sentences):
+        results = []
+        for sentence in sentences:
+            results.append([
+                {
+                    'semtypes': ['stub'],
+                    'score': str(self.score),
+                    'preferred_name': token.lower(),
+                    'cui': 'C{:07d}'.format(zlib.crc32(token.lower().encode('utf8')) % 10000000),
+                }
+                for token in sentence.split() if token.isalpha() and len(token) > self.min_len
+            ])
+        return results
+
+
+def lexicon_tokens(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def build_lexicon(concept_dir, opath, min_score=None):
+    """Build the lexicon of the dictionary backend from the extracted concepts.
+        Every preferred name becomes a term, a term shared by several CUIs keeps the most frequent one,
+        and the score of an entry is the median MetaMap score of its occurrences.
+
+    :param concept_dir: concept directory of the store
+    :param opath: output path of the lexicon, json file
+    :param min_score: skip concept occurrences with scores lower than this value
+    :return: number of lexicon entries
+    """
+    term_cuis = dict()
+    for _, concepts in tqdm(open_concept_store(concept_dir).iter_docs()):
+        for concept in concepts:
+            if min_score is not None and float(concept['score']) < min_score:
+                continue
+            term = ' '.join(lexicon_tokens(concept['preferred_name']))
+            if len(term) == 0:
+                continue
+            if term not in term_cuis:
+                term_cuis[term] = dict()
+            if concept['cui'] not in term_cuis[term]:
+                term_cuis[term][concept['cui']] = {
+                    'preferred_name': concept['preferred_name'],
+                    'semtypes': concept['semtypes'],
+                    'scores': [],
+                }
+            term_cuis[term][concept['cui']]['scores'].append(float(concept['score']))
+
+    lexicon = []
+    for term in term_cuis:
+        cui = max(term_cuis[term], key=lambda item: len(term_cuis[term][item]['scores']))
+        entry = term_cuis[term][cui]
+        lexicon.append({
+            'term': term,
+            'cui': cui,
+            'preferred_name': entry['preferred_name'],
+            'semtypes': entry['semtypes'],
+            'score': '{:.2f}'.format(float(np.median(entry['scores']))),
+        })
+
+    with open(opath, 'w') as wfile:
+        json.dump(lexicon, wfile)
+    return len(lexicon)
+
+
+class DictionaryBackend(ConceptBackend):
+    """In-process matcher over a concept lexicon built by build_lexicon.
+        Terms are stored in a token trie and matched leftmost-longest, without overlaps.
+
+        Parameters
+        ----------
+        lexicon_path: str
+            Path of the lexicon json file
+        min_score: float
+            Skip lexicon entries with scores lower than this value
+    """
+    def __init__(self, lexicon_path, min_score=None, **kwargs):
+        self.trie = dict()
+        self.entries = []
+        with open(lexicon_path) as dfile:
+            lexicon = json.load(dfile)
+
+        for entry in lexicon:
+            if min_score is not None and float(entry['score']) < min_score:
+                continue
+            node = self.trie
+            for token in entry['term'].split():
+                if token not in node:
+                    node[token] = dict()
+                node = node[token]
+            # the None key marks the end of a term
+            node[None] = len(self.entries)
+            self.entries.append({
+                'semtypes': entry['semtypes'],
+                'score': entry['score'],
+                'preferred_name': entry['preferred_name'],
+                'cui': entry['cui'],
+            })
+
+    def match(self, tokens):
+        results = []
+        start = 0
+        while start < len(tokens):
+            node = self.trie
+            matched = None
+            end = start
+            for idx in range(start, len(tokens)):
+                node = node.get(tokens[idx])
+                if node is None:
+                    break
+                if None in node:
+                    matched = node[None]
+                    end = idx + 1
+
+            if matched is None:
+                start += 1
+            else:
+                results.append(dict(self.entries[matched]))
+                start = end
+        return results
+
+    def extract(self, sentences):
+        return [self.match(lexicon_tokens(sentence)) for sentence in sentences]
+
+
+def build_backend(name, **kwargs):
+    if name == 'metamap':
+        return MetaMapBackend(**kwargs)
+    elif name == 'metamaplite':
+        return MetaMapLiteBackend(**kwargs)
+    elif name == 'dictionary':
+        return DictionaryBackend(**kwargs)
+    elif name == 'stub':
+        return StubBackend(**kwargs)
+    else:
+        raise ValueError('Concept backend {} is not supported!'.format(name))
+
+
+class ExtractionManifest(object):
+    """Append-only list of finished documents, including those without any concepts.
+        The manifest sits next to the concept directory,
+        other stages keep their manifests next to their outputs in the same way.
+    """
+    def __init__(self, concept_dir):
+        self.path = concept_dir.rstrip('/') + '.manifest'
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as dfile:
+                self.done.update(line.strip() for line in dfile if len(line.strip()) > 0)
+        self.wfile = None
+
+    def __contains__(self, doc_key):
+        return doc_key in self.done
+
+    def add(self, doc_key):
+        if self.wfile is None:
+            self.wfile = open(self.path, 'a')
+        self.wfile.write(doc_key + '\n')
+        self.wfile.flush()
+        self.done.add(doc_key)
+
+    def close(self):
+        if self.wfile is not None:
+            self.wfile.close()
+            self.wfile = None
+
+
+# the backend of the current worker process
+worker_backend = None
+
+
+def init_worker(backend, backend_kwargs):
+    global worker_backend
+    worker_backend = build_backend(backend, **backend_kwargs)
+
+
+def extract_sentences(sentences):
+    """Concepts of the sentences by the backend of the current worker, in the sentence order"""
+    concepts = []
+    for sent_concepts in worker_backend.extract(sentences):
+        concepts.extend(sent_concepts)
+    return concepts
+
+
+def extract_doc(doc):
+    doc_key, text = doc
+    return doc_key, extract_sentences(sent_tokenize(text))
+
+
+def extract_doc_sentences(doc):
+    """Same as extract_doc, for documents already split into sentences"""
+    doc_key, sentences = doc
+    return doc_key, extract_sentences(sentences)
+
+
+def extraction_pool(backend='metamap', backend_kwargs=None, num_workers=None):
+    """Worker pool of extract_concepts, to be reused over several calls"""
+    if backend_kwargs is None:
+        backend_kwargs = dict()
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    return Pool(num_workers, initializer=init_worker, initargs=(backend, backend_kwargs))
+
+
+def extract_concepts(docs, concept_dir, backend='metamap', backend_kwargs=None, num_workers=None, chunksize=4,
+                     pool=None, writer=None):
+    """Extract concepts of the documents and write them into the concept store of concept_dir
+
+    :param docs: list of (doc_key, text) pairs, doc_key follows {uid}_{doc_id}
+    :param concept_dir: concept directory, the store is {concept_dir}_store/
+    :param backend: name of the extraction backend
+    :param backend_kwargs: parameters of the backend
+    :param num_workers: number of worker processes, default to the number of cpus
+    :param chunksize: number of documents sent to a worker per task
+    :param pool: pool from extraction_pool, kept open for the caller, backend and num_workers are then unused
+    :param writer: writer from open_concept_writer, kept open for the caller and flushed at the end
+    :return: number of processed documents
+    """
+    if backend_kwargs is None:
+        backend_kwargs = dict()
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    own_writer = writer is None
+    if own_writer:
+        writer = open_concept_writer(concept_dir)
+
+    # documents from previous runs are skipped, the stored ones and the recorded ones without concepts
+    manifest = ExtractionManifest(concept_dir)
+    docs = [doc for doc in docs if doc[0] not in manifest and doc[0] not in writer]
+    print('Extracting Concepts of {} documents...'.format(len(docs)))
+
+    own_pool = pool is None and num_workers > 1
+    if own_pool:
+        pool = extraction_pool(backend, backend_kwargs, num_workers)
+    if pool is not None:
+        results = pool.imap_unordered(extract_doc, docs, chunksize=chunksize)
+    else:
+        init_worker(backend, backend_kwargs)
+        results = map(extract_doc, docs)
+
+    # finished documents wait for the shard of their concepts before going into the manifest
+    pending = []
+    try:
+        for doc_key, concepts in tqdm(results, total=len(docs)):
+            if len(concepts) > 0:
+                writer.add(doc_key, concepts)
+            pending.append(doc_key)
+            if len(writer.buffer_docs) == 0:
+                record_done(manifest, pending)
+            logging.debug("Finished concept extraction with %s." % doc_key)
+        writer.flush()
+        record_done(manifest, pending)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+        if own_writer:
+            writer.close()
+        manifest.close()
+    return len(docs)
+
+
+def record_done(manifest, pending):
+    for doc_key in pending:
+        manifest.add(doc_key)
+    del pending[:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the lexicon of the dictionary backend.')
+    parser.add_argument('--concept_dir', type=str, help='Concept directory, the store is {concept_dir}_store/')
+    parser.add_argument('--lexicon_path', type=str, help='Output path of the lexicon')
+    parser.add_argument('--min_score', type=float, default=None)
+    args = parser.parse_args()
+
+    print('Number of lexicon entries: ', build_lexicon(args.concept_dir, args.lexicon_path, args.min_score))
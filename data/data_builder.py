@@ -3,31 +3,33 @@
 # https://github.com/YerevaNN/mimic3-benchmarks/blob/master/mimic3benchmark/resources/hcup_ccs_2015_definitions.yaml
 
 import json
-import multiprocessing
 import os
 import heapq
-from collections import Counter
+from collections import Counter, deque
 import re
 from dateutil.parser import parse
 import xmltodict
-import pickle
-import yaml
 from multiprocessing import Pool
 import sys
-import subprocess
-import tempfile
 import logging
 import argparse
 
 import numpy as np
 import pandas as pd
-from nltk.tokenize import word_tokenize, sent_tokenize
-from pymetamap import MetaMap
 # from pymetamap import MetaMapLite
-from tensorflow.keras.preprocessing.text import Tokenizer
-from pandarallel import pandarallel
 from tqdm import tqdm
 
+import concept_extractor
+import icd_mapper
+import mimic_stream
+import text_normalizer
+from concept_extractor import extract_concepts, METAMAP_OPTIONS, DIABETES_METAMAP_OPTIONS
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import concept_store
+from token_corpus import iter_json_users
+from vocab import Vocab
+
 logging.basicConfig(
     level=logging.DEBUG,
     format='%(asctime)s %(process)s %(levelname)s %(message)s',
@@ -59,71 +61,12 @@ def rank_bid(review_count, score, max_count, base):
     return sigmoid(review_count / max_count) + sigmoid(score / base)
 
 
-# reduce line length
-def partition(temp_l, n):
-    for i in range(0, len(temp_l), n):
-        yield ' '.join(temp_l[i:i + n])
-
-
 def preprocess(doc, stopwords=None, min_len=None):
     """Split, tokenize documents
         stopwords (set)
+        the rules are compiled in text_normalizer, see normalize_texts to run them in parallel
     """
-    # lowercase
-    if stopwords is None:
-        stopwords = set()
-
-    # replace url
-    doc = re.sub(r"https?:\S+", "url", doc)
-
-    doc = doc.replace('\n', ' ')
-    doc = doc.replace('\t', ' ')
-
-    # replace anonymized entities, numeric id
-    doc = re.sub(r"\[\*\*Numeric.*?\*\*\]", "num_id", doc)
-    # replace and extract anonymized entities, known lastname
-    # doc = re.sub(r"\[\*\*Known lastname.*?(\d+)\*\*\]", r"lastname\1", doc)
-    doc = re.sub(r"\[\*\*Known lastname.*?(\d+)\*\*\]", "lastname", doc)
-    doc = re.sub(r"\[\*\*Last Name.*?\*\*\]", "lastname", doc)
-
-    # replace anonymized entities, firstname
-    doc = re.sub(r"\[\*\*Known firstname.*?(\d+)\*\*\]", "firstname", doc)
-    doc = re.sub(r"\[\*\*First Name.*?\*\*\]", "firstname", doc)
-
-    # remove anonymized entities, MD
-    doc = re.sub(r"\[\*\*MD.*?\*\*\]", "", doc)
-    # replace anonymized entities, numeric id
-    doc = re.sub(r"\[\*\*Hospital.*?\*\*\]", "hospital", doc)
-
-    # replace date
-    doc = re.sub(r"(\d+)+(\-)+(\d+)+(\-)+(\d+)", "date", doc)
-    # remove all serialization eg 1. 1) or 1.1
-    doc = re.sub(r"(\d+)+(\.|\))+(\d+)", "", doc)
-    doc = re.sub(r"(\d+)+(\.|\))", "", doc)
-
-    doc = re.sub(r"\b(\w+)( \1\b)+", r"\1", doc)  # removing consecutive duplicate words
-    doc = re.sub(r"(\b)(d|[dD])\.?(r|[rR])\.?(\b)", " ", doc)  # remove Dr abbreviation
-    doc = re.sub(r"([^A-Za-z0-9\s](\s)){2,}", " ", doc)  # remove consecutive punctuations
-
-    # ellipsis normalization
-    doc = re.sub(r'\.+', '', doc)
-    doc = re.sub(r'!+', '!', doc)
-    doc = re.sub(r'\*+', ' ', doc)
-    doc = re.sub(r'_+', ' ', doc)
-    doc = re.sub(r',+', ',', doc)
-
-    # special character
-    doc = doc.replace('w/', '')
-
-    doc = doc.lower()
-    doc = [item.strip() for item in word_tokenize(doc)
-           if len(item.strip()) > 1 and item not in stopwords
-           ]  # tokenize
-
-    if min_len and len(doc) < min_len:
-        return 'x'
-    else:
-        return ' '.join(doc)
+    return text_normalizer.normalize(doc, stopwords=stopwords, min_len=min_len)
 
 
 def format_time(time):
@@ -163,375 +106,21 @@ def build_tokenizer(dname, indir, odir):
     odir = os.path.join(odir, dname)
     if not os.path.exists(odir):
         os.mkdir(odir)
-    opath = odir + '/' + dname + '.tkn'
+    opath = odir + '/' + dname + '.vocab.json'
 
     if os.path.exists(opath):
-        return pickle.load(open(opath, 'rb'))
+        return Vocab.load(opath)
     else:
-        tok = Tokenizer(num_words=20001)  # 20000 known + 1 unknown tokens
-        corpus = []
-
-        with open(os.path.join(indir, dname) + '/' + dname + '.json') as dfile:
-            for line in dfile:
-                user = json.loads(line)
-                for doc_entity in user['docs']:
-                    corpus.append(doc_entity['text'])
-        tok.fit_on_texts(corpus)
-        with open(opath, 'wb') as wfile:
-            pickle.dump(tok, wfile)
+        data_path = os.path.join(indir, dname) + '/' + dname + '.json'
+        # 20000 known + 1 unknown tokens
+        tok = Vocab.fit(
+            (text for _, texts in iter_json_users(data_path) for text in texts), num_words=20001,
+            num_workers=max(os.cpu_count() // 2, 1)
+        )
+        tok.save(opath)
         return tok
 
 
-# code adapt from https://github.com/AnthonyMRios/pymetamap/blob/master/pymetamap/SubprocessBackendLite.py
-def metamaplite_concepts(sentences=None, ids=None,
-                         restrict_to_sts=None, restrict_to_sources=None):
-    """ extract_concepts takes a list of sentences and ids(optional)
-        then returns a list of Concept objects extracted via
-        MetaMapLite.
-        Supported Options:
-            Restrict to Semantic Types --restrict_to_sts
-            Restrict to Sources --restrict_to_sources
-        For information about the available options visit
-        http://metamap.nlm.nih.gov/.
-        Note: If an error is encountered the process will be closed
-              and whatever was processed, if anything, will be
-              returned along with the error found.
-    """
-    metamap_home = os.environ['METAMAP_HOME']
-    if not sentences:
-        raise ValueError("You must either pass a list of sentences.")
-
-    input_file = tempfile.NamedTemporaryFile(mode="wb", delete=False, suffix='.mmi')
-
-    if sentences is not None:
-        if ids is not None:
-            for identifier, sentence in zip(ids, sentences):
-                input_file.write('{0!r}|{1}\n'.format(identifier, sentence).encode('utf8'))
-        else:
-            for sentence in sentences:
-                input_file.write('{0!r}\n'.format(sentence).encode('utf8'))
-        input_file.flush()
-        input_file.close()
-
-    command = ["bash", os.path.join(metamap_home, "metamaplite.sh")]
-    if restrict_to_sts:
-        if isinstance(restrict_to_sts, str):
-            restrict_to_sts = [restrict_to_sts]
-        if len(restrict_to_sts) > 0:
-            command.append('--restrict_to_sts={}'.format(str(','.join(restrict_to_sts))))
-            # command.append(str(','.join(restrict_to_sts)))
-
-    if restrict_to_sources:
-        if isinstance(restrict_to_sources, str):
-            restrict_to_sources = [restrict_to_sources]
-        if len(restrict_to_sources) > 0:
-            command.append('--restrict_to_sources')
-            command.append(str(','.join(restrict_to_sources)))
-
-    if ids is not None:
-        command.append('--inputformat=sldiwi')
-
-    command.append(input_file.name)
-    command.append('--overwrite')
-    command.append('--indexdir={}data/ivf/2020AA/USAbase'.format(metamap_home))
-    command.append('--modelsdir={}data/models/'.format(metamap_home))
-    command.append('--specialtermsfile={}data/specialterms.txt'.format(metamap_home))
-    # command.append(output_file.name)
-
-    output_file_name, file_extension = os.path.splitext(input_file.name)
-    output_file_name += "." + "mmi"
-
-    output_file_name, file_extension = os.path.splitext(input_file.name)
-    output_file_name += "." + "mmi"
-
-    # output = str(output_file.read())
-    metamap_process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    while metamap_process.poll() is None:
-        stdout = str(metamap_process.stdout.readline())
-        if 'ERROR' in stdout:
-            metamap_process.terminate()
-            print(stdout.rstrip())
-
-    # print("input file name: {0}".format(input_file.name))
-    output_file_name, file_extension = os.path.splitext(input_file.name)
-    output_file_name += "." + "mmi"
-    # print("output_file_name: {0}".format(output_file_name))
-    with open(output_file_name) as fd:
-        output = fd.read()
-    # output = str(output_file.read())
-    # print("output: {0}".format(output))
-    concepts = CorpusLite.load(output.splitlines())
-    return concepts
-
-
-# code adapt from https://github.com/AnthonyMRios/pymetamap/blob/master/pymetamap/SubprocessBackend.py
-def metamap_concepts(sentences=None,
-                     ids=None,
-                     composite_phrase=4,
-                     file_format='sldi',
-                     allow_acronym_variants=False,
-                     word_sense_disambiguation=False,
-                     allow_large_n=False,
-                     strict_model=False,
-                     relaxed_model=False,
-                     allow_overmatches=False,
-                     allow_concept_gaps=False,
-                     term_processing=False,
-                     no_derivational_variants=False,
-                     derivational_variants=False,
-                     ignore_word_order=False,
-                     unique_acronym_variants=False,
-                     prefer_multiple_concepts=False,
-                     ignore_stop_phrases=False,
-                     compute_all_mappings=False,
-                     prune=-1,
-                     mm_data_version=False,
-                     exclude_sources=None,
-                     restrict_to_sources=None,
-                     restrict_to_sts=None,
-                     exclude_sts=None,
-                     no_nums=None):
-    """ extract_concepts takes a list of sentences and ids(optional)
-        then returns a list of Concept objects extracted via
-        MetaMap.
-        Supported Options:
-            Composite Phrase -Q
-            Word Sense Disambiguation -y
-            use strict model -A
-            use relaxed model -C
-            allow large N -l
-            allow overmatches -o
-            allow concept gaps -g
-            term processing -z
-            No Derivational Variants -d
-            All Derivational Variants -D
-            Ignore Word Order -i
-            Allow Acronym Variants -a
-            Unique Acronym Variants -u
-            Prefer Multiple Concepts -Y
-            Ignore Stop Phrases -K
-            Compute All Mappings -b
-            MM Data Version -V
-            Exclude Sources -e
-            Restrict to Sources -R
-            Restrict to Semantic Types -J
-            Exclude Semantic Types -k
-            Suppress Numerical Concepts --no_nums
-        For information about the available options visit
-        http://metamap.nlm.nih.gov/.
-        Note: If an error is encountered the process will be closed
-              and whatever was processed, if anything, will be
-              returned along with the error found.
-    """
-    if no_nums is None:
-        no_nums = []
-    if exclude_sts is None:
-        exclude_sts = []
-    if restrict_to_sts is None:
-        restrict_to_sts = []
-    if restrict_to_sources is None:
-        restrict_to_sources = []
-    if allow_acronym_variants and unique_acronym_variants:
-        raise ValueError("You can't use both allow_acronym_variants and unique_acronym_variants.")
-    if not sentences:
-        raise ValueError("You must either pass a list of sentences.")
-    if file_format not in ['sldi', 'sldiID']:
-        raise ValueError("file_format must be either sldi or sldiID")
-
-    command = list()
-    command.append('metamap')
-    command.append('-N')
-    command.append('-Q')
-    command.append(str(composite_phrase))
-    if mm_data_version is not False:
-        if mm_data_version not in ['Base', 'USAbase', 'NLM']:
-            raise ValueError("mm_data_version must be Base, USAbase, or NLM.")
-        command.append('-V')
-        command.append(str(mm_data_version))
-    if word_sense_disambiguation:
-        command.append('-y')
-    if strict_model:
-        command.append('-A')
-    if prune != -1:
-        command.append('--prune')
-        command.append(str(prune))
-    if relaxed_model:
-        command.append('-C')
-    if allow_large_n:
-        command.append('-l')
-    if allow_overmatches:
-        command.append('-o')
-    if allow_concept_gaps:
-        command.append('-g')
-    if term_processing:
-        command.append('-z')
-    if no_derivational_variants:
-        command.append('-d')
-    if derivational_variants:
-        command.append('-D')
-    if ignore_word_order:
-        command.append('-i')
-    if allow_acronym_variants:
-        command.append('-a')
-    if unique_acronym_variants:
-        command.append('-u')
-    if prefer_multiple_concepts:
-        command.append('-Y')
-    if ignore_stop_phrases:
-        command.append('-K')
-    if compute_all_mappings:
-        command.append('-b')
-    if exclude_sources and len(exclude_sources) > 0:
-        command.append('-e')
-        command.append(str(','.join(exclude_sources)))
-    if restrict_to_sources and len(restrict_to_sources) > 0:
-        command.append('-R')
-        command.append(str(','.join(restrict_to_sources)))
-    if restrict_to_sts and len(restrict_to_sts) > 0:
-        command.append('-J')
-        command.append(str(','.join(restrict_to_sts)))
-    if exclude_sts and len(exclude_sts) > 0:
-        command.append('-k')
-        command.append(str(','.join(exclude_sts)))
-    if no_nums and len(no_nums) > 0:
-        command.append('--no_nums')
-        command.append(str(','.join(no_nums)))
-    if ids is not None or (file_format == 'sldiID' and sentences is None):
-        command.append('--sldiID')
-    else:
-        command.append('--sldi')
-
-    command.append('--silent')
-
-    output = None
-    if sentences is not None:
-        input_text = None
-        if ids is not None:
-            for identifier, sentence in zip(ids, sentences):
-                if input_text is None:
-                    input_text = '{0!r}|{1!r}\n'.format(identifier, sentence).encode('utf8')
-                else:
-                    input_text += '{0!r}|{1!r}\n'.format(identifier, sentence).encode('utf8')
-        else:
-            for sentence in sentences:
-                if input_text is None:
-                    input_text = '{0!r}\n'.format(sentence).encode('utf8')
-                else:
-                    input_text += '{0!r}\n'.format(sentence).encode('utf8')
-
-        input_command = list()
-        input_command.append('echo')
-        input_command.append('-e')
-        input_command.append(input_text)
-
-        input_process = subprocess.Popen(input_command, stdout=subprocess.PIPE)
-        metamap_process = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=input_process.stdout)
-
-        output, error = metamap_process.communicate()
-        if sys.version_info[0] > 2:
-            if isinstance(output, bytes):
-                output = output.decode()
-
-        if metamap_process.returncode == 0:
-            output = output.split('\n')
-            info_line = 0
-            for idx in range(len(output)):
-                if len(output[idx].split('|')) > 1 and output[idx].split('|')[1] in ['MMI', 'AA', 'UA']:
-                    info_line = idx
-                    break
-            output = [item for item in output[info_line:] if len(item) > 3]
-            output = Corpus.load(output)
-        else:
-            return None
-    return output
-
-
-def process_concepts(entities):
-    results = []
-    for entity in entities:
-        item = dict()
-        try:
-            item['semtypes'] = entity.semtypes.lstrip('[').rstrip(']').split(',')
-        except AttributeError:
-            continue
-        # define filter list
-        # if 'qnco' in item['semtypes']:  # filter out Quantitative Concept: per year
-        #     continue
-        # if 'tmco' in item['semtypes']:  # filter out Temporal Concept: day
-        #     continue
-        # if 'hlca' in item['semtypes']:  # Health Care Activity: Hospital admission; Tapering - action;
-        #     continue
-        # if 'idcn' in item['semtypes']:  # Idea or Concept: Presentation
-        #     continue
-        # if 'hcro' in item['semtypes']:  # Health Care Related Organization: Accident and Emergency department
-        #     continue
-        # if 'clna' in item['semtypes']:  # Clinical Attribute: History of present illness
-        #     continue
-        # if 'ftcn' in item['semtypes']:  # Functional Concept: Negation, Extraocular; Due to
-        #     continue
-        # if 'qlco' in item['semtypes']:  # Qualitative Concept: Started
-        #     continue
-        # if 'fndg' in item['semtypes']:  # Finding: Present
-        #     continue
-        # if 'acty' in item['semtypes']:  # Activity: Obscure; Assessed; Departure - action
-        #     continue
-        # if 'mnob' in item['semtypes']:  # Manufactured Object: Machine; Beds
-        #     continue
-        # if 'plnt' in item['semtypes']:  # Plant
-        #     continue
-        # if 'podg' in item['semtypes']:  # Patient or Disabled Group: Patients
-        #     continue
-        # if 'popg' in item['semtypes']:  # Population Group
-        #     continue
-        # if 'prog' in item['semtypes']:  # Professional or Occupational Group: Physicians
-        #     continue
-        # if 'pros' in item['semtypes']:  # Professional Society
-        #     continue
-        # if 'elii' in item['semtypes']:  # Element, Ion, or Isotope: lead
-        #     continue
-        # if 'anim' in item['semtypes']:  # Animal: Show
-        #     continue
-        # if 'inpr' in item['semtypes']:  # Intellectual Product: Code; Telephone Number
-        #     continue
-        # if 'orgf' in item['semtypes']:  # Organism Function: Movement; Expiration, function; Inspiration function
-        #     continue
-        # if 'npop' in item['semtypes']:  # Natural Phenomenon or Process: Saturated
-        #     continue
-        # if 'lang' in item['semtypes']:  # Language: Herero language
-        #     continue
-        # if 'spco' in item['semtypes']:  # Spatial Concept: Scattered; Round shape
-        #     continue
-        # if 'bpoc' in item['semtypes']:  # Body Part, Organ, or Organ Component: Eminence
-        #     continue
-        # if 'phsf' in item['semtypes']:  # Physiologic Function: Respiration
-        #     continue
-        # if 'clas' in item['semtypes']:  # Classification: Trial Phase
-        #     continue
-        # if 'food' in item['semtypes']:  # Food: Food
-        #     continue
-        # if 'orga' in item['semtypes']:  # Organism Attribute: Body Temperature
-        #     continue
-        # if 'cnce' in item['semtypes']:  # Conceptual Entity: System Alert
-        #     continue
-        # if 'ocdi' in item['semtypes']:  # Occupation or Discipline: Science of Chemistry
-        #     continue
-        # if 'resa' in item['semtypes']:  # Research Activity: Diagnosis Study
-        #     continue
-        # if 'lbpr' in item['semtypes']:  # Laboratory Procedure: International Normalized Ratio
-        #     continue
-
-        # item['index'] = len(results)
-        # item['mm'] = entity.mm
-        item['score'] = entity.score
-        item['preferred_name'] = entity.preferred_name
-        item['cui'] = entity.cui
-        # item['trigger'] = entity.trigger.lstrip('[').rstrip(']').split(',')
-        # item['pos_info'] = entity.pos_info
-        results.append(item)
-
-    return results
-
-
 def process_amazon(indir, odir):
     """ Extract the amazon health data according to our needs
 
@@ -787,13 +376,19 @@ def process_amazon(indir, odir):
         wfile.write(json.dumps(product_idx_encoder))
 
 
-def process_diabetes_thread(finfo):
-    fname, opath, user_age, indir = finfo
-    print('Working on: ', fname)
+def parse_diabetes_file(finfo):
+    """Parse and clean one n2c2 xml file, concepts are extracted by the extraction workers
+
+    :param finfo: file name, user ages and input directory
+    :return: file name, the user record (None for empty patients)
+        and the list of ({uid}_{doc_id}, sentences) to extract concepts
+    """
+    fname, user_age, indir = finfo
     result = dict()
     result['uid'] = fname.split('.')[0]
     all_user_tokens = []
     fpath = os.path.join(indir, fname)
+    concept_docs = []
 
     # convert the xml to json dictionary
     dfile = xmltodict.parse(open(fpath).read())
@@ -816,7 +411,7 @@ def process_diabetes_thread(finfo):
     separator = '*' * 100  # each report was separated by 100 stars
     did = 0  # doc id
 
-    for snippet in tqdm(dfile['PatientMatching']['TEXT'].split(separator)):
+    for snippet in dfile['PatientMatching']['TEXT'].split(separator):
         result['docs'].append(dict())
         snippet = snippet.strip()
 
@@ -855,69 +450,7 @@ def process_diabetes_thread(finfo):
             result['docs'].pop(-1)
             continue
         result['docs'][-1]['text'] = doc_text
-
-        concepts_collection = []
-        # parameters documentation: https://metamap.nlm.nih.gov/Docs/MM_2016_Usage.pdf
-        # https://metamap.nlm.nih.gov/Docs/README_javaapi.shtml
-        step_size = 5
-        steps = len(collection) // step_size
-
-        # reduce line length
-        if len(collection) % step_size != 0:
-            steps += 1
-        for step in range(steps):
-            try:
-                # concepts, error = mm.extract_concepts(
-                concepts = metamap_concepts(
-                    collection[step * step_size: (step + 1) * step_size], word_sense_disambiguation=True,
-                    unique_acronym_variants=True, ignore_stop_phrases=True, no_derivational_variants=True,
-                    no_nums=['all'], exclude_sts=[
-                        'bpoc', 'spco', 'lang', 'npop', 'orgf', 'qnco', 'tmco', 'hlca', 'idcn', 'hcro', 'clna',
-                        'ftcn', 'qlco', 'fndg', 'acty', 'mnob', 'plnt', 'podg', 'popg', 'prog', 'pros', 'elii',
-                        'anim', 'inpr'
-                    ],
-                )
-                if concepts:
-                    concepts_collection.extend(process_concepts(concepts))
-            except IndexError:
-                try:
-                    tmp_collection = collection[step * step_size: (step + 1) * step_size]
-                    partition_size = 100
-                    collection_len = len(tmp_collection)
-                    for line_idx in range(len(tmp_collection)):
-                        if len(tmp_collection[line_idx].split()) > partition_size:
-                            tmp_collection.extend(
-                                list(partition(tmp_collection[line_idx].split(), partition_size)))
-                        else:
-                            tmp_collection.append(tmp_collection[line_idx])
-                    tmp_collection = tmp_collection[collection_len:]
-
-                    tmp_steps = len(tmp_collection) // step_size
-                    if len(tmp_collection) % step_size != 0:
-                        tmp_steps += 1
-
-                    for tmp_step in range(tmp_steps):
-                        # concepts, error = mm.extract_concepts(
-                        concepts = metamap_concepts(
-                            tmp_collection[tmp_step * step_size: (tmp_step + 1) * step_size],
-                            word_sense_disambiguation=True,
-                            unique_acronym_variants=True, ignore_stop_phrases=True, no_derivational_variants=True,
-                            no_nums=['all'], exclude_sts=[
-                                'bpoc', 'spco', 'lang', 'npop', 'orgf', 'qnco', 'tmco', 'hlca', 'idcn', 'hcro',
-                                'clna', 'ftcn', 'qlco', 'fndg', 'acty', 'mnob', 'plnt', 'podg', 'popg', 'prog',
-                                'pros', 'elii', 'anim', 'inpr'
-                            ], prune=33,
-                        )
-                        if concepts:
-                            concepts_collection.extend(process_concepts(concepts))
-                except IndexError:
-                    continue
-
-        if len(concepts_collection) > 0:
-            with open(
-                    os.environ['CONCEPT_ODIR'] + '{}_{}.pkl'.format(result['uid'], did), 'wb'
-            ) as cfile:
-                pickle.dump(concepts_collection, cfile)
+        concept_docs.append(('{}_{}'.format(result['uid'], did), collection))
 
         result['docs'][-1]['tags'] = result['tags']
         result['docs'][-1]['doc_id'] = str(did)
@@ -925,31 +458,75 @@ def process_diabetes_thread(finfo):
 
     # filter out empty patients
     if len(result['docs']) < 1:
-        return
+        return fname, None, concept_docs
 
     # classify the gender by token counts
     result['gender'] = simple_gender_clf(all_user_tokens)
     result['age'] = user_age[result['uid']]
     if len(result['docs'][-1]) == 0:
         result['docs'].pop(-1)
-    with open(opath, 'a') as wfile:
+    return fname, result, concept_docs
+
+
+def recover_records(opath):
+    """Drop the partially written last line of a json-lines file and return the uids of its records"""
+    with open(opath, 'rb+') as dfile:
+        content = dfile.read()
+        if len(content) > 0 and not content.endswith(b'\n'):
+            dfile.truncate(content.rfind(b'\n') + 1)
+            content = content[:content.rfind(b'\n') + 1]
+    return set(json.loads(line)['uid'] for line in content.decode('utf8').splitlines() if len(line) > 0)
+
+
+def write_diabetes_file(wfile, manifest, writer, item):
+    """Save the concepts and the record of a parsed file, blocks until its concepts are extracted.
+        The concepts are flushed into a shard before the record, shards are compacted when the writer is closed.
+    """
+    fname, result, tasks = item
+    for task in tasks:
+        doc_key, concepts = task.get()
+        if len(concepts) > 0:
+            writer.add(doc_key, concepts)
+    writer.flush()
+    if result is not None:
         wfile.write(json.dumps(result) + '\n')
+        wfile.flush()
+    manifest.add(fname)
 
 
-def process_diabetes(indir, odir):
+def process_diabetes(indir, odir, backend='metamap', backend_kwargs=None,
+                     num_parsers=None, num_extractors=None, max_pending=None):
     """ Extract the diabetes data according to our needs
+        XML parsing and concept extraction run in two worker pools, the main process is the only writer.
+        Records are written in the order of the file names, and finished files are recorded in
+        diabetes.json.manifest, a stopped run resumes from the first unfinished file.
 
     :param indir:
     :param odir:
+    :param backend: name of the concept-extraction backend
+    :param backend_kwargs: parameters of the backend
+    :param num_parsers: number of parsing workers, default to a quarter of the cpus
+    :param num_extractors: number of extraction workers, default to the number of cpus
+    :param max_pending: maximum number of files being parsed or extracted, bounds the memory
     :return:
     """
     opath = os.path.join(odir, 'diabetes.json')
-    wfile = open(opath, 'w')
-    wfile.close()
-    if not os.path.exists(os.environ['CONCEPT_ODIR']):
-        os.mkdir(os.environ['CONCEPT_ODIR'])
-
-    # load tokenizers and concept extractor
+    concept_dir = os.environ['CONCEPT_ODIR']
+    if num_parsers is None:
+        num_parsers = max(1, os.cpu_count() // 4)
+    if num_extractors is None:
+        num_extractors = os.cpu_count()
+    if max_pending is None:
+        max_pending = 4 * num_extractors
+
+    # a fresh run without manifest starts from an empty output
+    manifest = concept_extractor.ExtractionManifest(opath)
+    written = set()
+    if len(manifest.done) == 0 or not os.path.exists(opath):
+        wfile = open(opath, 'w')
+        wfile.close()
+    else:
+        written = recover_records(opath)
 
     # extract age information
     user_age = dict()
@@ -963,9 +540,59 @@ def process_diabetes(indir, odir):
             if len(line) != len(cols):
                 continue
             user_age[line[user_idx]] = line[age_idx] if line[age_idx] != '-1' else 'x'
-    file_list = [(fname, opath, user_age, indir) for fname in os.listdir(indir) if fname != '.DS_Store']
-    pool = Pool(os.cpu_count())
-    pool.map(process_diabetes_thread, file_list)
+
+    file_list = sorted(fname for fname in os.listdir(indir) if fname != '.DS_Store')
+    todo = deque()
+    for fname in file_list:
+        if fname in manifest:
+            continue
+        # the record was written but the run stopped before the manifest
+        if fname.split('.')[0] in written:
+            manifest.add(fname)
+            continue
+        todo.append(fname)
+    print('Processing {} of {} files...'.format(len(todo), len(file_list)))
+
+    if backend_kwargs is None:
+        backend_kwargs = dict()
+    parse_pool = Pool(num_parsers)
+    extract_pool = Pool(num_extractors, initializer=concept_extractor.init_worker, initargs=(backend, backend_kwargs))
+    writer = concept_store.open_concept_writer(concept_dir)
+
+    # files in the file order: being parsed, and being extracted with their concept tasks
+    parsing = deque()
+    extracting = deque()
+    try:
+        with open(opath, 'a') as wfile, tqdm(total=len(todo)) as pbar:
+            while len(todo) > 0 or len(parsing) > 0 or len(extracting) > 0:
+                while len(todo) > 0 and len(parsing) + len(extracting) < max_pending:
+                    parsing.append(parse_pool.apply_async(parse_diabetes_file, ((todo.popleft(), user_age, indir),)))
+
+                if len(parsing) > 0:
+                    fname, result, concept_docs = parsing.popleft().get()
+                    tasks = [
+                        extract_pool.apply_async(concept_extractor.extract_doc_sentences, (doc,))
+                        for doc in concept_docs
+                    ]
+                    extracting.append((fname, result, tasks))
+
+                # write the finished files in order
+                while len(extracting) > 0 and all(task.ready() for task in extracting[0][2]):
+                    write_diabetes_file(wfile, manifest, writer, extracting.popleft())
+                    pbar.update(1)
+                # nothing can be parsed, wait for the oldest file
+                if len(parsing) == 0 and len(extracting) > 0 and (len(todo) == 0 or len(extracting) >= max_pending):
+                    write_diabetes_file(wfile, manifest, writer, extracting.popleft())
+                    pbar.update(1)
+        for pool in [parse_pool, extract_pool]:
+            pool.close()
+            pool.join()
+    finally:
+        # a failed file stops the workers instead of draining the queued tasks
+        for pool in [parse_pool, extract_pool]:
+            pool.terminate()
+        writer.close()
+    manifest.close()
 
 
 def reformat(code, is_diag):
@@ -1013,194 +640,51 @@ def ethnicity_encode_mimic(ethnicity):
     return e_map[ethnicity] if ethnicity in e_map else e_map['OTHER']
 
 
-def get_concept_thread(input_text):
-    # parameters documentation: https://metamap.nlm.nih.gov/Docs/MM_2016_Usage.pdf
-    # https://metamap.nlm.nih.gov/Docs/README_javaapi.shtml
-    row_id, input_text, uid = input_text
-    if os.path.exists(os.environ['CONCEPT_ODIR'] + '{}_{}.pkl'.format(uid, row_id)):
-        return
-    collection = sent_tokenize(input_text)
-    step_size = 5
-    steps = len(collection) // step_size
-    if len(collection) % step_size != 0:
-        steps += 1
-
-    concepts_collection = []
-    mm = MetaMap.get_instance(os.environ['METAMAP_HOME'])
-
-    for step in tqdm(range(steps)):
-        step_collection = collection[step * step_size: (step + 1) * step_size]
-        try:
-            #print(f"step_collection {step_collection}")
-            # concepts = metamap_concepts(
-            concepts, error = mm.extract_concepts(
-                sentences=step_collection,
-                word_sense_disambiguation=True,
-                unique_acronym_variants=True,
-                ignore_stop_phrases=True,
-                no_derivational_variants=True,
-                #no_nums=['all'],
-                #exclude_sts=[
-                #    'bpoc', 'spco', 'lang', 'npop', 'orgf', 'qnco', 'tmco', 'hlca', 'idcn', 'hcro', 'clna',
-                #    'ftcn', 'qlco', 'fndg', 'acty', 'mnob', 'plnt', 'podg', 'popg', 'prog', 'pros', 'elii',
-                #    'anim', 'inpr', 'food'
-                #],
-                # for metamap lite only
-                # restrict_to_sts=[],
-            )
-            #print(f"step_collection--> concepts {concepts}")
-            if concepts:
-                concepts_collection.extend(process_concepts(concepts))
-             
-            #print(f"step_collection-->concepts-->concepts_collection {concepts_collection}")
-            
-            
-        except IndexError:
-            pass
-            # try:
-            #     tmp_collection = step_collection
-            #     partition_size = 60
-            #     collection_len = len(tmp_collection)
-            #     for line_idx in range(len(tmp_collection)):
-            #         if len(tmp_collection[line_idx].split()) > partition_size:
-            #             tmp_collection.extend(list(partition(tmp_collection[line_idx].split(), partition_size)))
-            #         else:
-            #             tmp_collection.append(tmp_collection[line_idx])
-            #     tmp_collection = tmp_collection[collection_len:]
-            #
-            #     tmp_steps = len(tmp_collection) // step_size
-            #     if len(tmp_collection) % step_size != 0:
-            #         tmp_steps += 1
-            #
-            #     for tmp_step in range(tmp_steps):
-            #         # concepts = metamap_concepts(
-            #         concepts, error = mm.extract_concepts(
-            #             sentences=tmp_collection[tmp_step * step_size: (tmp_step + 1) * step_size],
-            #             word_sense_disambiguation=True,
-            #             unique_acronym_variants=True,
-            #             ignore_stop_phrases=True, no_derivational_variants=True,
-            #             no_nums=['all'], exclude_sts=[
-            #                 'bpoc', 'spco', 'lang', 'npop', 'orgf', 'qnco', 'tmco', 'hlca', 'idcn', 'hcro', 'clna',
-            #                 'ftcn', 'qlco', 'fndg', 'acty', 'mnob', 'plnt', 'podg', 'popg', 'prog', 'pros', 'elii',
-            #                 'anim', 'inpr'
-            #             ], prune=33,
-            #             # for metamap lite only
-            #             # restrict_to_sts=[],
-            #         )
-            #         if concepts:
-            #             concepts_collection.extend(process_concepts(concepts))
-            # except IndexError:
-            #     pass
-
-    with multiprocessing.Lock():
-        logging.debug("Finished concept extraction with ROW_ID %s." % row_id)
-
-    if len(concepts_collection) > 0:
-        with open(os.environ['CONCEPT_ODIR'] + '{}_{}.pkl'.format(uid, row_id), 'wb') as wfile:
-            pickle.dump(concepts_collection, wfile)
-
-
-def extract_concepts_sequential(notes_df):
-    # get list of row_id and text pairs
-    texts = list(notes_df.TEXT.iteritems())
-    uids = list(notes_df.SUBJECT_ID.iteritems())
-    # filter out blank lines
-    texts = [
-        [item[0].strip(), item[1], uids[idx][1].strip()] for idx, item in enumerate(texts)
-        if len(item) > 1 and len(item[1].strip()) > 2
+def note_docs(notes_df):
+    # get list of {uid}_{row_id} and text pairs, filter out blank notes
+    return [
+        ('{}_{}'.format(uid.strip(), row_id), text)
+        for row_id, uid, text in zip(notes_df.index, notes_df.SUBJECT_ID, notes_df.TEXT)
+        if type(text) == str and len(text.strip()) > 2
     ]
 
-    print('Extracting Concepts ...')
-    for idx in tqdm(range(len(texts))):
-        get_concept_thread(texts[idx])
 
+def extract_concepts_sequential(notes_df, backend='metamap', backend_kwargs=None, writer=None):
+    extract_concepts(
+        note_docs(notes_df), os.environ['CONCEPT_ODIR'], backend=backend,
+        backend_kwargs=backend_kwargs, num_workers=1, writer=writer
+    )
 
-def extract_concepts_parallel(notes_df):
-    # get list of row_id and text pairs
-    texts = list(notes_df.TEXT.items())
-    uids = list(notes_df.SUBJECT_ID.items()) #(44005, '3'), (4788, '4'), (20825, '6'),
-    # filter out blank lines
-    texts = [
-        [item[0], item[1], uids[idx][1]] for idx, item in enumerate(texts)
-        if len(item) > 1 and len(item[1].strip()) > 2
-    ]
-    num_thread = os.cpu_count()
-    pool = Pool(num_thread)
 
-    print('Extracting Concepts ...')
-    pool.map(get_concept_thread, texts)
-    pool.close()
+def extract_concepts_parallel(notes_df, backend='metamap', backend_kwargs=None, pool=None, writer=None):
+    # long-lived workers, each keeps its own backend and sends sentences in batches
+    extract_concepts(
+        note_docs(notes_df), os.environ['CONCEPT_ODIR'], backend=backend,
+        backend_kwargs=backend_kwargs, num_workers=os.cpu_count(), pool=pool, writer=writer
+    )
 
 
-def process_mimic(indir, odir):
+def process_mimic(indir, odir, backend='metamap', backend_kwargs=None):
     """
 
     :param indir:
     :param odir:
+    :param backend: name of the concept-extraction backend
+    :param backend_kwargs: parameters of the backend
     :return:
     """
-    # progressively load the note event
-    notes = pd.read_csv(
-        indir + 'NOTEEVENTS.csv', dtype=str, index_col='ROW_ID',
-        usecols=['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CATEGORY', 'TEXT']
-    )
-    notes.CHARTDATE = pd.to_datetime(notes.CHARTDATE)
-    notes.SUBJECT_ID = notes.SUBJECT_ID.apply(lambda x: x.strip())
-
-    # load patient table
+    # the first pass over the notes without texts, to get ages of patients at the time of admission
     print('Getting patient and admission information...')
-    patient_set = set(notes.SUBJECT_ID)
-    patients = pd.read_csv(
-        indir + 'PATIENTS.csv', dtype=str,
-        usecols=['SUBJECT_ID', 'GENDER', 'DOB']
-    )
-    patients.SUBJECT_ID = patients.SUBJECT_ID.apply(lambda x: x.strip())
-    patients = patients[patients.SUBJECT_ID.isin(patient_set)]
-    patients.DOB = pd.to_datetime(patients.DOB)
-    patients.fillna('x', inplace=True)
-    patients = patients[patients.DOB != 'x']
-    # convert to a dictionary for fast search, the first value is id, the 2nd value is the timestamp
-    patients = dict((z[0], list(z[1:])) for z in zip(patients.SUBJECT_ID, patients.GENDER, patients.DOB))
-
-    # get age of patients at the time of admission
-    for index, row in notes.iterrows():
-        if row['SUBJECT_ID'] not in patients:
-            continue
-
-        u_age = (
-            row['CHARTDATE'].to_pydatetime() - patients[row['SUBJECT_ID']][1].to_pydatetime()
-        ).total_seconds() / 3600 / 24 / 365
-
-        patients[row['SUBJECT_ID']].append(u_age)
-
-        if u_age < 18:
-            del patients[row['SUBJECT_ID']]
-
-    print('Filtering and Preprocessing Notes...')
+    patients = mimic_stream.load_patients(indir)
     # only limit to the discharge summary
     # similar to https://github.com/jamesmullenbach/caml-mimic/blob/master/notebooks/dataproc_mimic_III.ipynb
-    notes = notes[notes.CATEGORY == 'Discharge summary']
     # filter out notes by the patients age
-    notes = notes[notes.SUBJECT_ID.isin(set(list(patients.keys())))]
-    # remove some types of documents
-    # notes = notes[notes.CATEGORY.isin([
-    #     'Nursing/other', 'Radiology', 'Nursing', 'ECG', 'Physician ',
-    #     'Discharge summary', 'Echo', 'Respiratory ',
-    # ])]
-    # filter out patients who have less than two notes
-    # patient_counts = Counter(notes.SUBJECT_ID)
-    # patient_counts = set([item[0] for item in patient_counts.items() if item[-1] >= 2])
-    # notes = notes[notes.SUBJECT_ID.isin(patient_counts)]
-    # filter out patients whoever generates less than 2 notes per stay
-    # counts = Counter(notes.HADM_ID)
-    # counts = dict([item for item in counts.items() if item[1] >= 2])
-    # notes = notes[notes.HADM_ID.isin(counts)]
-
-    # process the patients again
-    patient_set = set(notes.SUBJECT_ID)
-    for pid in list(patients.keys()):
-        if pid not in patient_set:
-            del patients[pid]
+    scan = mimic_stream.scan_notes(indir, patients, category='Discharge summary', min_age=18)
+    patient_set = scan['patient_set']
+    # convert to a dictionary for fast search, the values are gender, DOB and age
+    patients = dict(
+        (pid, [patients.GENDER[pid], patients.DOB[pid], scan['ages'][pid]]) for pid in patient_set
+    )
     print('We have number of patients: ', len(patients))
 
     # get admission table, aim for the ethnicity information
@@ -1216,131 +700,114 @@ def process_mimic(indir, odir):
 
     # load icd codes
     print('Converting ICD codes...')
-    icd_encoder = dict()
-    dfile = yaml.load(open('../resources/hcup_ccs_2015_definitions.yaml'), Loader=yaml.FullLoader)
-    for tmp_key in dfile:
-        for tmp_code in dfile[tmp_key]['codes']:
-            icd_encoder[tmp_code] = tmp_key
-    
-    dfcodes = dict()
-    hadm_set = set(notes.HADM_ID)
-    diagnosis_icd_hadm_set = set()
-    with open(indir + 'DIAGNOSES_ICD.csv') as dfile:
-        cols = [col.replace('"', '').strip() for col in dfile.readline().strip().split(',')]
-        icd_idx = cols.index('ICD9_CODE')
-        subj_idx = cols.index('SUBJECT_ID')
-        hadm_idx = cols.index('HADM_ID')
-
-        counterLineNotEqual = 0 
-        counterNotInPatient = 0
-        counterNotInHadm = 0
-        counterTotal = 0
-        counterIcdCodeNotInEncoder = 0
-
-        for line in dfile:
-            counterTotal+=1
-            line = [item.replace('"', '').strip() for item in line.strip().split(',')]
-            if len(line) != len(cols):
-                counterLineNotEqual+=1
-                continue
-            if line[subj_idx] not in patient_set:
-                counterNotInPatient+=1
-                continue
-            if line[hadm_idx] not in hadm_set:
-                diagnosis_icd_hadm_set.add(line[hadm_idx])
-                counterNotInHadm+=1
-                continue 
-            if line[icd_idx].strip() not in icd_encoder.keys():
-                counterIcdCodeNotInEncoder+=1
-                continue
-            
-            code_id = '{0}-{1}'.format(line[subj_idx], line[hadm_idx])
-            if code_id not in dfcodes:
-                dfcodes[code_id] = list()
-            dfcodes[code_id].append(icd_encoder.get(line[icd_idx].strip()))
-    
-    print(f"diagnosis stats: {counterTotal} total lines {counterNotInPatient} patients not in patient set, {counterNotInHadm} hadm not in hadm set, {counterLineNotEqual} lines not equal, {counterIcdCodeNotInEncoder} icd code not in encoder")
+    icd_encoder = icd_mapper.load_icd_encoder('../resources/hcup_ccs_2015_definitions.yaml')
+    hadm_set = scan['hadm_set']
+    dfcodes, diagnosis_icd_hadm_set, stats = icd_mapper.map_diagnoses(
+        indir + 'DIAGNOSES_ICD.csv', icd_encoder, patient_set, hadm_set
+    )
+    print(f"diagnosis stats: {stats['total']} total lines {stats['not_in_patient']} patients not in patient set, {stats['not_in_hadm']} hadm not in hadm set, {stats['lines_not_equal']} lines not equal, {stats['icd_not_in_encoder']} icd code not in encoder")
     print(f"size of dfcodes: {len(dfcodes)}")
+    # json artifacts and the compact dfcodes.npz for evaluation
+    icd_mapper.write_artifacts(odir, icd_encoder, dfcodes, hadm_set, diagnosis_icd_hadm_set)
 
-    with open('./processed_data/mimic-iii/hadm_id_set.json','w') as dfile:
-        for id in hadm_set:
-            dfile.write(f"{id},")
-
-    with open('./processed_data/mimic-iii/diagnosis_icd_hadm_id_set.json','w') as dfile:
-        for id in diagnosis_icd_hadm_set:
-            dfile.write(f"{id},")
- 
-    with open('./processed_data/mimic-iii/icd_encoder.json','w') as dfile:
-         dfile.write(json.dumps(icd_encoder)) 
-
-    with open('./processed_data/mimic-iii/dfcodes.json','w') as dfile:
-         dfile.write(json.dumps(dfcodes)) 
-
-    # extract concepts from the notes
+    # extract concepts from the notes into the concept store
     notes_concepts_dir = os.environ['CONCEPT_ODIR']
-    if not os.path.exists(notes_concepts_dir):
-        os.mkdir(notes_concepts_dir)
-    # extract_concepts_sequential(notes, notes_concepts_path)
-    extract_concepts_parallel(notes)
-
-    # preprocess the note documents, filter out documents less than 50 tokens
-    # notes.TEXT = notes.TEXT.apply(lambda x: preprocess(x, min_len=50))
-    # run parallel, consumes lots of memories for 15 GB / 48 workers.
-    pandarallel.initialize()
-    notes.TEXT = notes.TEXT.parallel_apply(lambda x: preprocess(x, min_len=50))
-    notes.fillna('x', inplace=True)
-    notes = notes[notes.TEXT != 'x']
-    print('We have number of documents: ', len(notes))
-
-    # loop through each note
+
+    # the second pass over the notes with texts, records are written once all their notes are processed
     print('Processing each row...')
-    results = dict()
-    for index, row in notes.iterrows():
-        uid = f"{row['SUBJECT_ID']}-{row['HADM_ID']}"
-        if uid not in results:
-            results[uid] = {
-                'uid': uid,
-                # calculate from the current stay and patient's DOB
-                'age': patients[row['SUBJECT_ID']][2],  # third value is the age
-                'gender': patients[row['SUBJECT_ID']][0],  # first value is the gender
-                'ethnicity': admits[row['SUBJECT_ID']],  # ethnicity
-                'tags_set': set(),  # convert to list in the end, unique tags
-                'tags': list(),  # collect all patient tags
-                'docs': list(),  # collect all patient notes
-            }
-
-        results[uid]['docs'].append({
-            'doc_id': index,
-            'date': row['CHARTDATE'].strftime('%Y-%m-%d'),
-            'text': row['TEXT'],
-            'tags': dfcodes.get(uid,list()),
-        })
-        results[uid]['tags_set'].update(dfcodes.get(uid, set()))
-        results[uid]['tags'].extend(dfcodes.get(uid, list()))
-    
-
-    
-
-
-    opath = os.path.join(odir, 'mimic-iii.json')
-    with open(opath, 'w') as wfile:
-        for uid in results:
-            # filter out empty records
-            if len(results[uid]['docs']) == 0:
+    writer = mimic_stream.OrderedRecordWriter(os.path.join(odir, 'mimic-iii.json'), scan['doc_counts'])
+    num_docs = 0
+    # both pools and the concept writer live over all chunks, the backends are started once
+    extract_pool = concept_extractor.extraction_pool(backend, backend_kwargs, os.cpu_count())
+    normalize_pool = text_normalizer.normalize_pool(min_len=50)
+    concept_writer = concept_store.open_concept_writer(notes_concepts_dir)
+    try:
+        for notes in mimic_stream.read_notes(indir, with_text=True):
+            notes = notes[(notes.CATEGORY == 'Discharge summary') & notes.SUBJECT_ID.isin(patient_set)]
+            if len(notes) == 0:
                 continue
-            results[uid]['tags_set'] = list(results[uid]['tags_set'])
-            wfile.write(json.dumps(results[uid]) + '\n')
+
+            # extract_concepts_sequential(notes, backend, backend_kwargs, writer=concept_writer)
+            extract_concepts_parallel(notes, backend, backend_kwargs, pool=extract_pool, writer=concept_writer)
+
+            # preprocess the note documents, filter out documents less than 50 tokens
+            # run parallel by blocks of notes, the memory is bounded by the block size
+            notes = notes.assign(TEXT=list(text_normalizer.normalize_texts(notes.TEXT, pool=normalize_pool)))
+            notes = notes.fillna('x')
+
+            for index, row in notes.iterrows():
+                uid = f"{row['SUBJECT_ID']}-{row['HADM_ID']}"
+                writer.done(uid)
+                if row['TEXT'] == 'x':
+                    continue
+                num_docs += 1
+
+                if uid not in writer:
+                    writer.start(uid, {
+                        'uid': uid,
+                        # calculate from the current stay and patient's DOB
+                        'age': patients[row['SUBJECT_ID']][2],  # third value is the age
+                        'gender': patients[row['SUBJECT_ID']][0],  # first value is the gender
+                        'ethnicity': admits[row['SUBJECT_ID']],  # ethnicity
+                        'tags_set': set(),  # convert to list in the end, unique tags
+                        'tags': list(),  # collect all patient tags
+                        'docs': list(),  # collect all patient notes
+                    })
+
+                writer[uid]['docs'].append({
+                    'doc_id': index,
+                    'date': row['CHARTDATE'].strftime('%Y-%m-%d'),
+                    'text': row['TEXT'],
+                    'tags': dfcodes.get(uid, list()),
+                })
+                writer[uid]['tags_set'].update(dfcodes.get(uid, set()))
+                writer[uid]['tags'].extend(dfcodes.get(uid, list()))
+            writer.flush()
+        for pool in [extract_pool, normalize_pool]:
+            pool.close()
+            pool.join()
+    finally:
+        # a failed chunk stops the workers instead of draining the queued tasks
+        for pool in [extract_pool, normalize_pool]:
+            pool.terminate()
+        concept_writer.close()
+
+    writer.close()
+    print('We have number of documents: ', num_docs)
+    print('We have number of users: ', writer.num_records)
+
+
+def concept_backend_params(backend, dname, lexicon_path=None):
+    """Parameters of the concept-extraction backend per dataset"""
+    if backend == 'metamap':
+        if dname == 'diabetes':
+            # split long lines into 100 tokens and prune candidates when MetaMap fails on them
+            params = dict(DIABETES_METAMAP_OPTIONS)
+            params.update({'partition_size': 100, 'fallback_options': {'prune': 33}})
+            return params
+        return dict(METAMAP_OPTIONS)
+    elif backend == 'dictionary':
+        if lexicon_path is None or not os.path.exists(lexicon_path):
+            raise ValueError('Build the lexicon first by concept_extractor.py, {} not found!'.format(lexicon_path))
+        return {'lexicon_path': lexicon_path}
+    return dict()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--metamap_home', type=str, help='Home Directory of Your MetaMap')
     parser.add_argument('--mimic_dir', type=str, help='MIMIC-III Data Directory')
+    parser.add_argument(
+        '--concept_backend', type=str, default='metamap', help='metamap, metamaplite, dictionary or stub')
+    parser.add_argument('--lexicon_path', type=str, default=None, help='Lexicon of the dictionary backend')
+    parser.add_argument(
+        '--concept_odir', type=str, default=None, help='Output directory of concepts, default to concepts/')
     args = parser.parse_args()
 
     # flist = ['amazon', 'diabetes', 'mimic']
     output_dir = './processed_data/'
-    os.environ['METAMAP_HOME'] = args.metamap_home
+    if args.metamap_home:
+        os.environ['METAMAP_HOME'] = args.metamap_home
 
     # amazon health dataset
     # amazon_indir = './data/raw_data/amazon/'
@@ -1350,15 +817,20 @@ if __name__ == '__main__':
 
     # diabetes
     #diabetes_indir = './raw_data/diabetes/all/'
-    #os.environ['CONCEPT_ODIR'] = './processed_data/{}/concepts/'.format('diabetes')
+    #os.environ['CONCEPT_ODIR'] = args.concept_odir or './processed_data/{}/concepts/'.format('diabetes')
     #if not os.path.exists(output_dir + 'diabetes/'):
     #    os.mkdir(output_dir + 'diabetes/')
-    #process_diabetes(diabetes_indir, output_dir + 'diabetes/')
+    #process_diabetes(
+    #    diabetes_indir, output_dir + 'diabetes/', args.concept_backend,
+    #    concept_backend_params(args.concept_backend, 'diabetes', args.lexicon_path))
 
     # mimic-iii
     # '/data/xxx/physionet.org/files/mimiciii/1.4/'
     mimic_indir = args.mimic_dir
-    os.environ['CONCEPT_ODIR'] = './processed_data/{}/concepts/'.format('mimic-iii')
+    os.environ['CONCEPT_ODIR'] = args.concept_odir or './processed_data/{}/concepts/'.format('mimic-iii')
     if not os.path.exists(output_dir + 'mimic-iii/'):
         os.mkdir(output_dir + 'mimic-iii/')
-    process_mimic(mimic_indir, output_dir + 'mimic-iii/')
+    process_mimic(
+        mimic_indir, output_dir + 'mimic-iii/', args.concept_backend,
+        concept_backend_params(args.concept_backend, 'mimic-iii', args.lexicon_path)
+    )
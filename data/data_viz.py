@@ -1,14 +1,16 @@
 import json
 import os
 import subprocess
+import sys
 
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-import numpy as np
-from sklearn.manifold import TSNE
 import umap
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from emb_store import open_user_embs
+
 
 def analysis_viz(dpath, data_name='Diabetes'):
     df = pd.read_csv(dpath)
@@ -73,19 +75,8 @@ def user_viz_phenotype(data_name, method_name):
     if not os.path.exists(inpath):
         # load user embeddings
         # load the user embeddings, default to load the user.npy
-        if os.path.exists(emb_dir + 'user.npy'):
-            uembs = np.load(emb_dir + 'user.npy')
-        else:
-            # this assumes using .txt file
-            uembs = [[]] * len(user_tags)
-            with open(emb_dir + 'user.txt') as dfile:
-                for line in dfile:
-                    line = line.strip().split('\t')
-                    if len(line) != 2:
-                        continue
-                    uid = user_encoder[line[0]]
-                    uembs[uid] = [float(item) for item in line[1].split()]
-            uembs = np.asarray(uembs)
+        uembs = open_user_embs(emb_dir, data_dir + 'user_encoder.json', method=method_name).aligned(
+            data_dir + 'user_encoder.json')
 
         # tsne = TSNE(n_components=2, n_jobs=-1)
         tsne = umap.UMAP(n_jobs=-1, n_components=2, n_neighbors=9)
@@ -151,19 +142,8 @@ def user_mortality_viz(data_name, method_name):
     if not os.path.exists(inpath):
         # load user embeddings
         # load the user embeddings, default to load the user.npy
-        if os.path.exists(emb_dir + 'user.npy'):
-            uembs = np.load(emb_dir + 'user.npy')
-        else:
-            # this assumes using .txt file
-            uembs = [[]] * len(user_tags)
-            with open(emb_dir + 'user.txt') as dfile:
-                for line in dfile:
-                    line = line.strip().split('\t')
-                    if len(line) != 2:
-                        continue
-                    uid = user_encoder[line[0]]
-                    uembs[uid] = [float(item) for item in line[1].split()]
-            uembs = np.asarray(uembs)
+        uembs = open_user_embs(emb_dir, data_dir + 'user_encoder.json', method=method_name).aligned(
+            data_dir + 'user_encoder.json')
 
         # tsne = TSNE(n_components=2, n_jobs=-1)
         tsne = umap.UMAP(n_jobs=-1, n_components=2, n_neighbors=9)
@@ -197,8 +177,8 @@ if __name__ == '__main__':
     for dname in ['MIMIC-III']:
         analysis_viz(quant_path, dname)
 
-     for dname in ['mimic-iii']:
-         for method in ['caue_gru']:  # , 'user2vec', 'suisil2user'
-             print('Current job {}, {}'.format(dname, method))
-             user_viz_phenotype(dname, method)
-             user_mortality_viz(dname, method)
+    for dname in ['mimic-iii']:
+        for method in ['caue_gru']:  # , 'user2vec', 'suisil2user'
+            print('Current job {}, {}'.format(dname, method))
+            user_viz_phenotype(dname, method)
+            user_mortality_viz(dname, method)
@@ -0,0 +1,135 @@
+"""Vectorized mapping of the MIMIC-III diagnoses into the HCUP CCS categories
+
+DIAGNOSES_ICD is loaded once, filtered by the selected patients and admissions,
+joined against the ICD-9 -> CCS table and grouped per {SUBJECT_ID}-{HADM_ID} user.
+Besides the dfcodes json, the grouped codes are saved in a compact npz for evaluation:
+    uids: user ids
+    ptr: CCS ids of the i-th user are ccs_ids[ptr[i]:ptr[i+1]], in the file order
+    ccs_ids: int16 indices of the categories
+    categories: CCS names, in the order of the definition file
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import yaml
+
+DIAGNOSIS_COLUMNS = ['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE']
+
+
+def load_icd_encoder(definition_path):
+    """ICD-9 code -> CCS category from the HCUP definition yaml"""
+    icd_encoder = dict()
+    with open(definition_path) as dfile:
+        definitions = yaml.load(dfile, Loader=yaml.FullLoader)
+    for tmp_key in definitions:
+        for tmp_code in definitions[tmp_key]['codes']:
+            icd_encoder[tmp_code] = tmp_key
+    return icd_encoder
+
+
+def map_diagnoses(diagnosis_path, icd_encoder, patient_set, hadm_set):
+    """Map the diagnoses of the selected admissions into CCS categories
+
+    :param diagnosis_path: path of DIAGNOSES_ICD.csv
+    :param icd_encoder: ICD-9 code -> CCS category
+    :param patient_set: selected SUBJECT_IDs
+    :param hadm_set: selected HADM_IDs
+    :return: dfcodes (user id -> list of CCS categories), the set of HADM_IDs missing in hadm_set, and the stats
+    """
+    # lines with a different number of fields are counted as lines not equal and skipped as the original
+    # parser did, they are found before parsing since the parser fills the short rows with empty codes
+    stats = {'total': 0}
+    bad_lines = []
+    with open(diagnosis_path) as dfile:
+        num_cols = len(dfile.readline().split(','))
+        for idx, line in enumerate(dfile, 1):
+            stats['total'] += 1
+            if len(line.strip().split(',')) != num_cols:
+                bad_lines.append(idx)
+    stats['lines_not_equal'] = len(bad_lines)
+
+    # empty codes of the full-length rows stay, they are counted as codes not in the encoder
+    diagnoses = pd.read_csv(
+        diagnosis_path, dtype=str, keep_default_na=False, skiprows=bad_lines, usecols=DIAGNOSIS_COLUMNS
+    )
+    for col in DIAGNOSIS_COLUMNS:
+        diagnoses[col] = diagnoses[col].str.replace('"', '', regex=False).str.strip()
+
+    in_patient = diagnoses.SUBJECT_ID.isin(patient_set)
+    stats['not_in_patient'] = int((~in_patient).sum())
+    diagnoses = diagnoses[in_patient]
+
+    in_hadm = diagnoses.HADM_ID.isin(hadm_set)
+    stats['not_in_hadm'] = int((~in_hadm).sum())
+    missing_hadm_set = set(diagnoses.HADM_ID[~in_hadm])
+    diagnoses = diagnoses[in_hadm]
+
+    ccs = diagnoses.ICD9_CODE.map(icd_encoder)
+    stats['icd_not_in_encoder'] = int(ccs.isna().sum())
+    diagnoses = diagnoses.assign(CCS=ccs)[ccs.notna()]
+
+    # users keep the order of their first diagnoses, and the codes keep the file order
+    uids = diagnoses.SUBJECT_ID + '-' + diagnoses.HADM_ID
+    dfcodes = diagnoses.CCS.groupby(uids, sort=False).agg(list).to_dict()
+    return dfcodes, missing_hadm_set, stats
+
+
+def save_dfcodes_npz(dfcodes, categories, opath):
+    """Save the dfcodes in the compact form
+
+    :param dfcodes: user id -> list of CCS categories
+    :param categories: list of all CCS categories, their positions are the ids
+    :param opath: output path of the npz file
+    """
+    category_index = dict((category, idx) for idx, category in enumerate(categories))
+    uids = list(dfcodes.keys())
+    ptr = np.zeros(len(uids) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(dfcodes[uid]) for uid in uids])
+    ccs_ids = np.fromiter(
+        (category_index[category] for uid in uids for category in dfcodes[uid]), dtype=np.int16, count=ptr[-1]
+    )
+    np.savez(opath, uids=np.asarray(uids, dtype=str), ptr=ptr, ccs_ids=ccs_ids, categories=np.asarray(categories))
+
+
+def load_dfcodes_npz(path):
+    """Load the compact dfcodes back as the dict of user id and CCS categories"""
+    with np.load(path) as dfile:
+        uids, ptr, ccs_ids, categories = dfile['uids'], dfile['ptr'], dfile['ccs_ids'], dfile['categories']
+    names = categories[ccs_ids].tolist()
+    return dict((uid, names[ptr[idx]: ptr[idx + 1]]) for idx, uid in enumerate(uids.tolist()))
+
+
+def multi_hot(path, uids):
+    """Binary label matrix of (len(uids), number of categories), users without diagnoses are all zeros"""
+    with np.load(path) as dfile:
+        uid_index = dict((uid, idx) for idx, uid in enumerate(dfile['uids'].tolist()))
+        ptr, ccs_ids, categories = dfile['ptr'], dfile['ccs_ids'], dfile['categories']
+
+    labels = np.zeros((len(uids), len(categories)), dtype=np.uint8)
+    for row, uid in enumerate(uids):
+        if uid in uid_index:
+            idx = uid_index[uid]
+            labels[row, ccs_ids[ptr[idx]: ptr[idx + 1]]] = 1
+    return labels, categories.tolist()
+
+
+def write_artifacts(odir, icd_encoder, dfcodes, hadm_set, missing_hadm_set):
+    """Write the mapping artifacts into the output directory"""
+    with open(odir + 'hadm_id_set.json', 'w') as dfile:
+        for id in hadm_set:
+            dfile.write(f"{id},")
+
+    with open(odir + 'diagnosis_icd_hadm_id_set.json', 'w') as dfile:
+        for id in missing_hadm_set:
+            dfile.write(f"{id},")
+
+    with open(odir + 'icd_encoder.json', 'w') as dfile:
+        dfile.write(json.dumps(icd_encoder))
+
+    with open(odir + 'dfcodes.json', 'w') as dfile:
+        dfile.write(json.dumps(dfcodes))
+
+    # the definition order of the categories
+    categories = list(dict.fromkeys(icd_encoder.values()))
+    save_dfcodes_npz(dfcodes, categories, odir + 'dfcodes.npz')
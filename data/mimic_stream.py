@@ -0,0 +1,160 @@
+"""Streaming readers of the MIMIC-III tables
+
+NOTEEVENTS is read by chunks in two passes:
+    1. without the TEXT column, to compute the patient ages and the discharge summaries per admission,
+    2. with the TEXT column, only the discharge summaries of the selected patients are kept in memory.
+User records are written as soon as all their documents are collected,
+in the same order as loading the full table.
+"""
+import json
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+NOTE_COLUMNS = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CATEGORY', 'TEXT']
+SECONDS_PER_YEAR = 3600 * 24 * 365
+
+
+def read_notes(indir, with_text=True, chunksize=100000):
+    """Iterate over NOTEEVENTS.csv by chunks of rows
+
+    :param indir: directory of the MIMIC-III tables
+    :param with_text: load the TEXT column or not
+    :param chunksize: number of rows per chunk
+    :return: generator of DataFrames indexed by ROW_ID
+    """
+    usecols = NOTE_COLUMNS if with_text else [col for col in NOTE_COLUMNS if col != 'TEXT']
+    reader = pd.read_csv(
+        indir + 'NOTEEVENTS.csv', dtype=str, index_col='ROW_ID', usecols=usecols, chunksize=chunksize
+    )
+    for chunk in reader:
+        chunk.CHARTDATE = pd.to_datetime(chunk.CHARTDATE)
+        chunk.SUBJECT_ID = chunk.SUBJECT_ID.str.strip()
+        yield chunk
+
+
+def load_patients(indir):
+    """Patients with known birth dates, indexed by SUBJECT_ID"""
+    patients = pd.read_csv(
+        indir + 'PATIENTS.csv', dtype=str,
+        usecols=['SUBJECT_ID', 'GENDER', 'DOB']
+    )
+    patients.SUBJECT_ID = patients.SUBJECT_ID.str.strip()
+    patients.DOB = pd.to_datetime(patients.DOB)
+    patients.GENDER = patients.GENDER.fillna('x')
+    patients = patients.dropna(subset=['DOB'])
+    return patients.drop_duplicates('SUBJECT_ID', keep='last').set_index('SUBJECT_ID')
+
+
+def note_ages(notes, patients):
+    """Ages in years at the chart dates of the notes, NaN if the chart date is unknown.
+        The differences are taken in seconds, the shifted birth dates of the elderly patients
+        are about 300 years earlier and overflow the nanosecond timedeltas.
+
+    :param notes: chunk of NOTEEVENTS, patients of the notes must be in the patient table
+    :param patients: patient table from load_patients
+    :return: float array of ages
+    """
+    dobs = patients.DOB.reindex(notes.SUBJECT_ID.values).values
+    charts = notes.CHARTDATE.values
+    known = ~np.isnat(charts)
+
+    ages = np.full(len(notes), np.nan)
+    ages[known] = (
+        charts[known].astype('datetime64[s]').astype(np.int64) - dobs[known].astype('datetime64[s]').astype(np.int64)
+    ).astype(np.float64) / 3600 / 24 / 365
+    return ages
+
+
+def scan_notes(indir, patients, category='Discharge summary', min_age=18, chunksize=100000):
+    """The first pass over the notes without texts.
+        A patient is dropped if any of the notes is written under min_age,
+        the age of a patient is computed at the first note in the file, from notes of all categories.
+
+    :param indir: directory of the MIMIC-III tables
+    :param patients: patient table from load_patients
+    :param category: note category to keep
+    :param min_age: minimum age of the patients
+    :param chunksize: number of rows per chunk
+    :return: dict of ages (patient id -> age), patient_set, hadm_set,
+        and doc_counts (number of notes per {SUBJECT_ID}-{HADM_ID} user)
+    """
+    first_ages = dict()
+    minors = set()
+    selected = []
+    for chunk in tqdm(read_notes(indir, with_text=False, chunksize=chunksize), desc='Scanning notes'):
+        chunk = chunk[chunk.SUBJECT_ID.isin(patients.index)]
+        ages = note_ages(chunk, patients)
+
+        minors.update(chunk.SUBJECT_ID.values[ages < min_age])
+        firsts = pd.DataFrame({'SUBJECT_ID': chunk.SUBJECT_ID.values, 'age': ages}).drop_duplicates('SUBJECT_ID')
+        for pid, age in zip(firsts.SUBJECT_ID, firsts.age):
+            if pid not in first_ages:
+                first_ages[pid] = age
+        selected.append(chunk.loc[chunk.CATEGORY == category, ['SUBJECT_ID', 'HADM_ID']])
+
+    selected = pd.concat(selected)
+    selected = selected[~selected.SUBJECT_ID.isin(minors)]
+    patient_set = set(selected.SUBJECT_ID)
+    return {
+        'ages': dict((pid, first_ages[pid]) for pid in patient_set),
+        'patient_set': patient_set,
+        'hadm_set': set(selected.HADM_ID),
+        # admissions without ids are filled as 'x', the same as the user ids of the records
+        'doc_counts': Counter(
+            '{}-{}'.format(pid, hadm_id) for pid, hadm_id in zip(selected.SUBJECT_ID, selected.HADM_ID.fillna('x'))
+        ),
+    }
+
+
+class OrderedRecordWriter(object):
+    """Write user records into json lines incrementally.
+        A record is written when all its documents are seen and all the records started before it are written,
+        records are then in the order of their first kept documents.
+
+        Parameters
+        ----------
+        opath: str
+            Output path of the json lines
+        doc_counts: dict
+            Number of documents per user, including documents filtered out later
+    """
+    def __init__(self, opath, doc_counts):
+        self.wfile = open(opath, 'w')
+        self.remaining = Counter(doc_counts)
+        self.pending = OrderedDict()
+        self.num_records = 0
+
+    def __contains__(self, uid):
+        return uid in self.pending
+
+    def __getitem__(self, uid):
+        return self.pending[uid]
+
+    def start(self, uid, record):
+        self.pending[uid] = record
+
+    def done(self, uid):
+        """Mark one document of the user as seen, kept or not"""
+        self.remaining[uid] -= 1
+
+    def flush(self, force=False):
+        while len(self.pending) > 0:
+            uid = next(iter(self.pending))
+            if not force and self.remaining[uid] > 0:
+                break
+            self.write(self.pending.pop(uid))
+
+    def write(self, record):
+        # filter out empty records
+        if len(record['docs']) == 0:
+            return
+        record['tags_set'] = list(record['tags_set'])
+        self.wfile.write(json.dumps(record) + '\n')
+        self.num_records += 1
+
+    def close(self):
+        self.flush(force=True)
+        self.wfile.close()
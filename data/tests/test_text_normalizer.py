@@ -0,0 +1,43 @@
+"""The compiled normalizer against the golden file of the reference implementation
+
+normalizer_golden.json was built by text_normalizer.build_golden from synthetic notes,
+it covers digit runs, serial numbers, ? and ! sentences and the triggers of the word tokenizer.
+The saved punkt sentences stand in for the punkt model, only the live check needs it.
+"""
+import json
+import os
+import sys
+
+import nltk
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import text_normalizer
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'normalizer_golden.json')
+
+
+def punkt_available():
+    try:
+        nltk.data.find('tokenizers/punkt_tab/english/')
+    except LookupError:
+        return False
+    return True
+
+
+def load_golden():
+    with open(GOLDEN_PATH) as dfile:
+        return [json.loads(line) for line in dfile]
+
+
+@pytest.mark.parametrize('entry', load_golden(), ids=lambda entry: entry['text'][:30])
+def test_normalize_golden(entry, monkeypatch):
+    # a changed cleaning gives a text without saved sentences and fails with a KeyError
+    monkeypatch.setattr(text_normalizer, 'sent_tokenize', lambda text: entry['sentences'][text])
+    stopwords = set(entry['stopwords']) if entry['stopwords'] else None
+    assert text_normalizer.normalize(entry['text'], stopwords, entry['min_len']) == entry['output']
+
+
+@pytest.mark.skipif(not punkt_available(), reason='the punkt model of nltk is not installed')
+def test_check_golden():
+    assert text_normalizer.check_golden(GOLDEN_PATH) == []
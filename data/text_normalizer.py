@@ -0,0 +1,378 @@
+"""Compiled normalizer of the clinical notes
+
+The same rules as the original ``preprocess`` with the same output, but faster:
+    1. every regex is compiled once, rules are skipped when their trigger strings are absent,
+    2. nested quantifiers such as ``(\\d+)+`` are flattened, they backtrack exponentially on long numbers,
+    3. the serial-number passes and the ellipsis passes are merged,
+    4. normalized texts have no periods, so texts without ``?`` and ``!`` are a single punkt sentence
+       and go to the word tokenizer directly,
+    5. the rules of the NLTK word tokenizer are guarded by their trigger strings as well.
+Notes are normalized by a worker pool in blocks, only one block of texts is in flight at a time.
+Golden files built by the reference implementation check that outputs stay the same.
+"""
+import argparse
+import json
+import re
+import time
+from multiprocessing import Pool
+
+from nltk.tokenize import sent_tokenize, word_tokenize
+from nltk.tokenize.destructive import NLTKWordTokenizer
+from tqdm import tqdm
+
+URL_RE = re.compile(r"https?:\S+")
+# (trigger, regex, replacement) of the anonymized entities, applied in order
+ANONYMIZED_RULES = [
+    ('[**Numeric', re.compile(r"\[\*\*Numeric.*?\*\*\]"), 'num_id'),
+    ('[**Known lastname', re.compile(r"\[\*\*Known lastname.*?(\d+)\*\*\]"), 'lastname'),
+    ('[**Last Name', re.compile(r"\[\*\*Last Name.*?\*\*\]"), 'lastname'),
+    ('[**Known firstname', re.compile(r"\[\*\*Known firstname.*?(\d+)\*\*\]"), 'firstname'),
+    ('[**First Name', re.compile(r"\[\*\*First Name.*?\*\*\]"), 'firstname'),
+    ('[**MD', re.compile(r"\[\*\*MD.*?\*\*\]"), ''),
+    ('[**Hospital', re.compile(r"\[\*\*Hospital.*?\*\*\]"), 'hospital'),
+]
+DATE_RE = re.compile(r"\d+-+\d+-+\d+")
+# serializations, eg 1. 1) or 1.1
+SERIAL_RE = re.compile(r"\d+[.)](?:[.)]*\d+)?")
+DUPLICATE_RE = re.compile(r"\b(\w+)( \1\b)+")
+DR_RE = re.compile(r"\b[dD]\.?[rR]\.?\b")
+PUNCTUATION_RE = re.compile(r"(?:[^A-Za-z0-9\s]\s){2,}")
+# (trigger, regex, replacement) of the ellipsis normalization after removing periods
+ELLIPSIS_RULES = [
+    ('!!', re.compile(r'!+'), '!'),
+    ('*', re.compile(r'\*+'), ' '),
+    ('_', re.compile(r'_+'), ' '),
+    (',,', re.compile(r',+'), ','),
+]
+WHITESPACE_TABLE = str.maketrans({'\n': ' ', '\t': ' '})
+
+
+class FastWordTokenizer(NLTKWordTokenizer):
+    """NLTKWordTokenizer that skips the rules whose trigger strings are absent from the text.
+        Rules unknown to the trigger table make the tokenizer fall back to the NLTK implementation.
+    """
+    # pattern -> trigger strings, the rule can only change texts containing one of the triggers
+    TRIGGERS = {
+        '([«“‘„]|[`]+)': ('«', '“', '‘', '„', '`'),
+        r'^\"': ('"',),
+        r'(``)': ('``',),
+        r'([ \(\[{<])(\"|\'{2})': ('"', "''"),
+        r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)": ("'",),
+        '([»”’])': ('»', '”', '’'),
+        r"''": ("''",),
+        r'"': ('"',),
+        # the whitespace normalization only matters for the following rules with quotes
+        r'\s+': ("'",),
+        r"([^' ])('[sS]|'[mM]|'[dD]|') ": ("'",),
+        r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ": ("'",),
+        r'([^\.])(\.)([\]\)}>"\'' '»”’ ' r']*)\s*$': ('.',),
+        r'([:,])([^\d])': (':', ','),
+        r'([:,])$': (':', ','),
+        r'\.{2,}': ('..',),
+        r'[;@#$%&]': (';', '@', '#', '$', '%', '&'),
+        r'[\u2012-\u2015]': ('\u2012', '\u2013', '\u2014', '\u2015'),
+        r'([^\.])(\.)([\]\)}>"\']*)\s*$': ('.',),
+        r'[?!]': ('?', '!'),
+        r"([^'])' ": ("' ",),
+        r'[*]': ('*',),
+        r'[\]\[\(\)\{\}\<\>]': ('[', ']', '(', ')', '{', '}', '<', '>'),
+        r'--': ('--',),
+        r"(?i)\b(can)(?#X)(not)\b": ('cannot',),
+        r"(?i)\b(d)(?#X)('ye)\b": ("d'ye",),
+        r"(?i)\b(gim)(?#X)(me)\b": ('gimme',),
+        r"(?i)\b(gon)(?#X)(na)\b": ('gonna',),
+        r"(?i)\b(got)(?#X)(ta)\b": ('gotta',),
+        r"(?i)\b(lem)(?#X)(me)\b": ('lemme',),
+        r"(?i)\b(more)(?#X)('n)\b": ("more'n",),
+        r"(?i)\b(wan)(?#X)(na)(?=\s)": ('wanna',),
+        r"(?i) ('t)(?#X)(is)\b": ("'",),
+        r"(?i) ('t)(?#X)(was)\b": ("'",),
+    }
+
+    def __init__(self):
+        self.starting_quotes = self.guard(self.STARTING_QUOTES)
+        self.punctuation = self.guard(self.PUNCTUATION)
+        self.parens_brackets = self.guard([self.PARENS_BRACKETS])
+        self.double_dashes = self.guard([self.DOUBLE_DASHES])
+        self.ending_quotes = self.guard(self.ENDING_QUOTES)
+        # triggers of the case-insensitive contractions are checked in the lowercased text
+        self.contractions2 = self.guard([(regexp, r" \1 \2 ") for regexp in self.CONTRACTIONS2])
+        self.contractions3 = self.guard([(regexp, r" \1 \2 ") for regexp in self.CONTRACTIONS3])
+
+        rules = self.starting_quotes + self.punctuation + self.parens_brackets + self.double_dashes + \
+            self.ending_quotes + self.contractions2 + self.contractions3
+        self.enabled = all(triggers is not None for triggers, _, _ in rules)
+
+    def guard(self, rules):
+        return [(self.TRIGGERS.get(regexp.pattern), regexp, substitution) for regexp, substitution in rules]
+
+    def apply(self, rules, text):
+        for triggers, regexp, substitution in rules:
+            if any(trigger in text for trigger in triggers):
+                text = regexp.sub(substitution, text)
+        return text
+
+    def tokenize(self, text, convert_parentheses=False, return_str=False):
+        if not self.enabled or convert_parentheses or return_str:
+            return super(FastWordTokenizer, self).tokenize(text, convert_parentheses, return_str)
+
+        text = self.apply(self.starting_quotes, text)
+        text = self.apply(self.punctuation, text)
+        text = self.apply(self.parens_brackets, text)
+        text = self.apply(self.double_dashes, text)
+
+        text = " " + text + " "
+        text = self.apply(self.ending_quotes, text)
+        lowered = text.lower()
+        # a few characters lowercase into several, the triggers cannot be located then
+        if len(lowered) == len(text):
+            for triggers, regexp, substitution in self.contractions2:
+                if any(trigger in lowered for trigger in triggers):
+                    text = regexp.sub(substitution, text)
+                    lowered = text.lower()
+        else:
+            for _, regexp, substitution in self.contractions2:
+                text = regexp.sub(substitution, text)
+        text = self.apply(self.contractions3, text)
+        return text.split()
+
+
+word_tokenizer = FastWordTokenizer()
+
+
+def tokenize(doc):
+    """Same tokens as nltk word_tokenize for the normalized texts"""
+    if '.' not in doc and '?' not in doc and '!' not in doc:
+        # without sentence-ending characters, punkt returns the right-stripped text as the only sentence
+        return word_tokenizer.tokenize(doc.rstrip())
+    return [token for sent in sent_tokenize(doc) for token in word_tokenizer.tokenize(sent)]
+
+
+def clean_text(doc):
+    """Replace urls, anonymized entities, dates and serial numbers and strip the punctuations,
+        the lowercased output is the text given to the sentence and word tokenizers
+    """
+    if 'http' in doc:
+        doc = URL_RE.sub('url', doc)
+    doc = doc.translate(WHITESPACE_TABLE)
+
+    if '[**' in doc:
+        for trigger, regexp, replacement in ANONYMIZED_RULES:
+            if trigger in doc:
+                doc = regexp.sub(replacement, doc)
+
+    if '-' in doc:
+        doc = DATE_RE.sub('date', doc)
+    if '.' in doc or ')' in doc:
+        doc = SERIAL_RE.sub('', doc)
+
+    doc = DUPLICATE_RE.sub(r"\1", doc)
+    doc = DR_RE.sub(' ', doc)
+    doc = PUNCTUATION_RE.sub(' ', doc)
+
+    doc = doc.replace('.', '')
+    for trigger, regexp, replacement in ELLIPSIS_RULES:
+        if trigger in doc:
+            doc = regexp.sub(replacement, doc)
+    return doc.replace('w/', '').lower()
+
+
+def normalize(doc, stopwords=None, min_len=None):
+    """Split, tokenize documents, the compiled version of the original preprocess
+
+    :param doc: raw text
+    :param stopwords: set of tokens to remove
+    :param min_len: documents with fewer tokens are returned as 'x'
+    :return: space-joined tokens
+    """
+    if stopwords is None:
+        stopwords = set()
+
+    # split() leaves no whitespace around the tokens
+    doc = [token for token in tokenize(clean_text(doc)) if len(token) > 1 and token not in stopwords]
+
+    if min_len and len(doc) < min_len:
+        return 'x'
+    else:
+        return ' '.join(doc)
+
+
+def reference_normalize(doc, stopwords=None, min_len=None):
+    """The original preprocess, kept for the golden files and benchmarks"""
+    if stopwords is None:
+        stopwords = set()
+
+    doc = re.sub(r"https?:\S+", "url", doc)
+    doc = doc.replace('\n', ' ')
+    doc = doc.replace('\t', ' ')
+
+    doc = re.sub(r"\[\*\*Numeric.*?\*\*\]", "num_id", doc)
+    doc = re.sub(r"\[\*\*Known lastname.*?(\d+)\*\*\]", "lastname", doc)
+    doc = re.sub(r"\[\*\*Last Name.*?\*\*\]", "lastname", doc)
+    doc = re.sub(r"\[\*\*Known firstname.*?(\d+)\*\*\]", "firstname", doc)
+    doc = re.sub(r"\[\*\*First Name.*?\*\*\]", "firstname", doc)
+    doc = re.sub(r"\[\*\*MD.*?\*\*\]", "", doc)
+    doc = re.sub(r"\[\*\*Hospital.*?\*\*\]", "hospital", doc)
+
+    doc = re.sub(r"(\d+)+(\-)+(\d+)+(\-)+(\d+)", "date", doc)
+    doc = re.sub(r"(\d+)+(\.|\))+(\d+)", "", doc)
+    doc = re.sub(r"(\d+)+(\.|\))", "", doc)
+
+    doc = re.sub(r"\b(\w+)( \1\b)+", r"\1", doc)
+    doc = re.sub(r"(\b)(d|[dD])\.?(r|[rR])\.?(\b)", " ", doc)
+    doc = re.sub(r"([^A-Za-z0-9\s](\s)){2,}", " ", doc)
+
+    doc = re.sub(r'\.+', '', doc)
+    doc = re.sub(r'!+', '!', doc)
+    doc = re.sub(r'\*+', ' ', doc)
+    doc = re.sub(r'_+', ' ', doc)
+    doc = re.sub(r',+', ',', doc)
+
+    doc = doc.replace('w/', '')
+
+    doc = doc.lower()
+    doc = [item.strip() for item in word_tokenize(doc)
+           if len(item.strip()) > 1 and item not in stopwords
+           ]
+
+    if min_len and len(doc) < min_len:
+        return 'x'
+    else:
+        return ' '.join(doc)
+
+
+# the parameters of the current worker process
+worker_params = None
+
+
+def init_worker(stopwords, min_len):
+    global worker_params
+    worker_params = (stopwords, min_len)
+
+
+def normalize_worker(doc):
+    return normalize(doc, *worker_params)
+
+
+def normalize_pool(stopwords=None, min_len=None, num_workers=None):
+    """Worker pool of normalize_texts, to be reused over several calls"""
+    return Pool(num_workers, initializer=init_worker, initargs=(stopwords, min_len))
+
+
+def normalize_texts(texts, stopwords=None, min_len=None, num_workers=None, block_size=20000, chunksize=64,
+                    pool=None):
+    """Normalize the texts by a worker pool, in order
+
+    :param texts: iterable of raw texts, None or NaN values are returned as they are
+    :param stopwords: set of tokens to remove
+    :param min_len: documents with fewer tokens are returned as 'x'
+    :param num_workers: number of worker processes, default to the number of cpus
+    :param block_size: number of texts sent to the pool at a time, bounds the memory
+    :param chunksize: number of texts sent to a worker per task
+    :param pool: pool from normalize_pool, kept open for the caller, its stopwords and min_len are used
+    :return: generator of the normalized texts
+    """
+    if pool is None and num_workers == 1:
+        for doc in texts:
+            yield normalize(doc, stopwords, min_len) if isinstance(doc, str) else doc
+        return
+
+    if pool is not None:
+        yield from normalize_blocks(pool, texts, block_size, chunksize)
+        return
+
+    with normalize_pool(stopwords, min_len, num_workers) as pool:
+        yield from normalize_blocks(pool, texts, block_size, chunksize)
+
+
+def normalize_blocks(pool, texts, block_size, chunksize):
+    block = []
+    for doc in texts:
+        block.append(doc)
+        if len(block) == block_size:
+            yield from normalize_block(pool, block, chunksize)
+            block = []
+    if len(block) > 0:
+        yield from normalize_block(pool, block, chunksize)
+
+
+def normalize_block(pool, block, chunksize):
+    positions = [idx for idx, doc in enumerate(block) if isinstance(doc, str)]
+    outputs = pool.map(normalize_worker, [block[idx] for idx in positions], chunksize=chunksize)
+    for idx, output in zip(positions, outputs):
+        block[idx] = output
+    return block
+
+
+def build_golden(texts, opath, stopwords=None, min_len=None):
+    """Save the outputs of the reference implementation as a golden file, one json per line.
+        The punkt sentences of the cleaned texts with ``?`` or ``!`` are saved as well,
+        the golden outputs can be checked without the punkt model.
+    """
+    with open(opath, 'w') as wfile:
+        for doc in tqdm(texts):
+            cleaned = clean_text(doc)
+            sentences = dict()
+            if '?' in cleaned or '!' in cleaned:
+                sentences[cleaned] = sent_tokenize(cleaned)
+            wfile.write(json.dumps({
+                'text': doc,
+                'stopwords': sorted(stopwords) if stopwords else None,
+                'min_len': min_len,
+                'sentences': sentences,
+                'output': reference_normalize(doc, stopwords, min_len),
+            }) + '\n')
+
+
+def check_golden(golden_path):
+    """Compare the normalizer with a golden file
+
+    :return: list of line numbers with different outputs
+    """
+    mismatches = []
+    with open(golden_path) as dfile:
+        for idx, line in enumerate(dfile):
+            entry = json.loads(line)
+            stopwords = set(entry['stopwords']) if entry['stopwords'] else None
+            if normalize(entry['text'], stopwords, entry['min_len']) != entry['output']:
+                mismatches.append(idx)
+    return mismatches
+
+
+def benchmark(texts, min_len=None):
+    """Documents per second of the reference implementation and the normalizer"""
+    results = dict()
+    for name, func in [('reference', reference_normalize), ('normalizer', normalize)]:
+        start = time.time()
+        for doc in texts:
+            func(doc, min_len=min_len)
+        results[name] = len(texts) / max(time.time() - start, 1e-9)
+    results['speedup'] = results['normalizer'] / results['reference']
+    return results
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Golden files and benchmarks of the text normalizer.')
+    parser.add_argument('--task', type=str, default='check', help='build, check or benchmark')
+    parser.add_argument('--golden_path', type=str, default='./processed_data/mimic-iii/normalizer_golden.json')
+    parser.add_argument('--notes_path', type=str, default='./raw/mimic-iii/NOTEEVENTS.csv')
+    parser.add_argument('--sample', type=int, default=2000)
+    parser.add_argument('--min_len', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.task == 'check':
+        diffs = check_golden(args.golden_path)
+        print('Number of mismatched documents: ', len(diffs))
+        if len(diffs) > 0:
+            print('Mismatched lines: ', diffs[:20])
+    else:
+        notes = pd.read_csv(args.notes_path, usecols=['TEXT'], nrows=args.sample, dtype=str)
+        samples = notes.TEXT.dropna().tolist()
+        if args.task == 'build':
+            build_golden(samples, args.golden_path, min_len=args.min_len)
+        elif args.task == 'benchmark':
+            print(benchmark(samples, min_len=args.min_len))
+        else:
+            raise ValueError('Task {} is not supported!'.format(args.task))
@@ -0,0 +1,185 @@
+"""Quantized exports of the stored user embeddings
+
+Three variants are supported, each saved next to the source matrix as ``user[_{epoch}].{variant}.npz``
+plus a ``.meta.json`` sidecar that copies the source metadata:
+    float16: half precision matrix
+    int8: per-row symmetric scaling, ``vector ~= codes * scale``
+    pq: product quantization, every subspace is encoded by the index of its closest k-means centroid
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from emb_store import EmbeddingStore, open_user_embs
+
+QUANT_VARIANTS = ['float16', 'int8', 'pq']
+
+
+def quantize_float16(embs):
+    return {'codes': np.asarray(embs, dtype=np.float16)}
+
+
+def quantize_int8(embs):
+    embs = np.asarray(embs, dtype=np.float32)
+    scale = np.abs(embs).max(axis=1) / 127.
+    scale[scale == 0] = 1.
+    codes = np.clip(np.rint(embs / scale[:, None]), -127, 127).astype(np.int8)
+    return {'codes': codes, 'scale': scale.astype(np.float32)}
+
+
+def quantize_pq(embs, n_subspaces=8, n_centroids=256, seed=33):
+    """Product quantization of the user matrix
+
+    :param embs: user matrix
+    :param n_subspaces: number of subspaces, the last one is zero-padded if dims is not divisible
+    :param n_centroids: centroids per subspace, at most 256 to fit the uint8 codes
+    :param seed: random seed of k-means
+    :return: dict of codebooks (n_subspaces, n_centroids, sub_dims) and codes (num_users, n_subspaces)
+    """
+    if n_centroids > 256:
+        raise ValueError('PQ with more than 256 centroids is not supported!')
+    embs = np.asarray(embs, dtype=np.float32)
+    sub_dims = int(np.ceil(embs.shape[1] / n_subspaces))
+    if sub_dims * n_subspaces != embs.shape[1]:
+        embs = np.pad(embs, ((0, 0), (0, sub_dims * n_subspaces - embs.shape[1])))
+    n_centroids = min(n_centroids, len(embs))
+
+    codebooks = np.zeros((n_subspaces, n_centroids, sub_dims), dtype=np.float32)
+    codes = np.zeros((len(embs), n_subspaces), dtype=np.uint8)
+    for sdx in range(n_subspaces):
+        sub_embs = embs[:, sdx * sub_dims: (sdx + 1) * sub_dims]
+        kmeans = KMeans(n_clusters=n_centroids, n_init=1, random_state=seed).fit(sub_embs)
+        codebooks[sdx] = kmeans.cluster_centers_
+        codes[:, sdx] = kmeans.labels_
+    return {'codes': codes, 'codebooks': codebooks}
+
+
+def export_quantized(emb_dir, user_encoder_path, variant, epoch=None, **kwargs):
+    """Quantize a stored user matrix and save it next to the source
+
+    :return: path of the quantized file
+    """
+    store = open_user_embs(emb_dir, user_encoder_path, epoch=epoch)
+    embs = np.asarray(store.matrix, dtype=np.float32)
+    if variant == 'float16':
+        arrays = quantize_float16(embs)
+    elif variant == 'int8':
+        arrays = quantize_int8(embs)
+    elif variant == 'pq':
+        arrays = quantize_pq(embs, **kwargs)
+    else:
+        raise ValueError('Quantization {} is not supported!'.format(variant))
+
+    meta = dict(store.meta)
+    meta['quantization'] = variant
+    meta['quantization_params'] = kwargs
+    opath = os.path.join(emb_dir, '{}.{}.npz'.format(store.name, variant))
+    np.savez(opath, **arrays)
+    with open(os.path.join(emb_dir, '{}.{}.meta.json'.format(store.name, variant)), 'w') as wfile:
+        json.dump(meta, wfile)
+    return opath
+
+
+class QuantizedStore(EmbeddingStore):
+    """Reader of the quantized user matrix, a drop-in replacement of the EmbeddingStore.
+        ``matrix`` dequantizes the full matrix on the first access,
+        ``similarity`` computes dot products directly on the compressed codes.
+    """
+    def __init__(self, emb_dir, variant, epoch=None):
+        super(QuantizedStore, self).__init__(emb_dir, epoch)
+        if variant not in QUANT_VARIANTS:
+            raise ValueError('Quantization {} is not supported!'.format(variant))
+        self.variant = variant
+        self.path = os.path.join(emb_dir, '{}.{}.npz'.format(self.name, variant))
+        self.meta_path = os.path.join(emb_dir, '{}.{}.meta.json'.format(self.name, variant))
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            with np.load(self.path) as dfile:
+                self._arrays = dict((key, dfile[key]) for key in dfile.files)
+        return self._arrays
+
+    def dequantize(self, rows=None):
+        """Decode the given rows, all users by default, into a float32 matrix"""
+        codes = self.arrays['codes']
+        if rows is not None:
+            codes = codes[rows]
+
+        if self.variant == 'float16':
+            return codes.astype(np.float32)
+        elif self.variant == 'int8':
+            scale = self.arrays['scale'] if rows is None else self.arrays['scale'][rows]
+            return codes.astype(np.float32) * scale[:, None]
+        else:
+            codebooks = self.arrays['codebooks']
+            embs = np.concatenate([codebooks[sdx][codes[:, sdx]] for sdx in range(len(codebooks))], axis=1)
+            return embs[:, :self.dims]
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = self.dequantize()
+        return self._matrix
+
+    def __getitem__(self, uidx):
+        if np.isscalar(uidx):
+            return self.dequantize([uidx])[0]
+        return self.dequantize(uidx)
+
+    def get(self, uid):
+        return self[self.uid_index[uid]]
+
+    def similarity(self, queries, block_size=65536):
+        """Dot products between the query vectors and all users without decoding the matrix
+
+        :param queries: vector or matrix of (num_queries, dims)
+        :param block_size: float16 and int8 codes are cast to float32 by blocks of block_size users
+        :return: array of (num_queries, num_users), or (num_users,) for a single vector
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+        codes = self.arrays['codes']
+
+        if self.variant in ['float16', 'int8']:
+            sims = np.empty((len(queries), len(codes)), dtype=np.float32)
+            for start in range(0, len(codes), block_size):
+                block = codes[start: start + block_size].astype(np.float32)
+                sims[:, start: start + block_size] = queries.dot(block.T)
+            if self.variant == 'int8':
+                sims *= self.arrays['scale'][None, :]
+        else:
+            codebooks = self.arrays['codebooks']
+            n_subspaces, _, sub_dims = codebooks.shape
+            if queries.shape[1] < n_subspaces * sub_dims:
+                queries = np.pad(queries, ((0, 0), (0, n_subspaces * sub_dims - queries.shape[1])))
+            sims = np.zeros((len(queries), len(codes)), dtype=np.float32)
+            for sdx in range(n_subspaces):
+                # lookup table of (num_queries, n_centroids)
+                lookup = queries[:, sdx * sub_dims: (sdx + 1) * sub_dims].dot(codebooks[sdx].T)
+                sims += lookup[:, codes[:, sdx]]
+
+        return sims[0] if single else sims
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--dname', type=str, help='data name')
+    args.add_argument('--model', type=str, help='user embedding model')
+    args.add_argument('--epoch', type=str, default='')
+    args.add_argument('--variants', type=str, default='float16,int8,pq')
+    args.add_argument('--pq_subspaces', type=int, default=8)
+    args = args.parse_args()
+
+    emb_dir = './resources/embedding/{}/{}/'.format(args.dname, args.model)
+    user_encoder_path = './data/processed_data/{}/user_encoder.json'.format(args.dname)
+    for quant in args.variants.split(','):
+        if quant == 'pq':
+            print(export_quantized(emb_dir, user_encoder_path, quant, args.epoch, n_subspaces=args.pq_subspaces))
+        else:
+            print(export_quantized(emb_dir, user_encoder_path, quant, args.epoch))
@@ -0,0 +1,223 @@
+"""Unified on-disk store of user embeddings
+
+Every method saves its user matrix as ``user.npy`` (or ``user_{epoch}.npy``) whose rows follow
+the indices of ``user_encoder.json``, plus a ``user[_{epoch}].meta.json`` sidecar recording
+the method, epoch, dimensions, dtype, the uid of every row and a hash of the user encoder.
+Readers memory-map the matrix, so evaluation jobs never re-parse or re-align embeddings.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    """sha1 of the file content, read by blocks.
+        Used to fingerprint the data a matrix was aligned with, and the inputs of the build cache.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as dfile:
+        for block in iter(lambda: dfile.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def emb_name(epoch=None):
+    if epoch is None or epoch == '':
+        return 'user'
+    return 'user_{}'.format(epoch)
+
+
+def encoder_uids(user_encoder):
+    """Convert the user encoder into a list of uids in row order"""
+    uids = [None] * (max(user_encoder.values()) + 1)
+    for uid, uidx in user_encoder.items():
+        uids[uidx] = uid
+    return uids
+
+
+def save_user_embs(emb_dir, embs, method, user_encoder_path, epoch=None, dtype='float32', missing=0):
+    """Save a user matrix whose rows already follow the user encoder indices.
+
+    :param emb_dir: output directory of the method
+    :param embs: user matrix, extra rows (e.g., the unknown user of usr2vec) are dropped
+    :param method: user embedding method name
+    :param user_encoder_path: path of the user_encoder.json the rows are aligned with
+    :param epoch: training epoch, None or '' for the final embedding
+    :param dtype: float32 or float16
+    :param missing: number of users without vectors (zero rows)
+    :return: path of the matrix
+    """
+    if dtype not in ['float32', 'float16']:
+        raise ValueError('Embedding dtype {} is not supported!'.format(dtype))
+    with open(user_encoder_path) as dfile:
+        uids = encoder_uids(json.load(dfile))
+
+    embs = np.asarray(embs)
+    if embs.ndim != 2 or len(embs) < len(uids):
+        raise ValueError('User matrix of shape {} does not cover {} users.'.format(embs.shape, len(uids)))
+    embs = embs[:len(uids)].astype(dtype, copy=False)
+
+    name = emb_name(epoch)
+    opath = os.path.join(emb_dir, name + '.npy')
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'method': method,
+        'epoch': None if epoch is None or epoch == '' else str(epoch),
+        'num_users': len(uids),
+        'dims': int(embs.shape[1]),
+        'dtype': dtype,
+        'missing': int(missing),
+        'data_hash': file_hash(user_encoder_path),
+        'uids': uids,
+    }
+
+    # write to temporary files first, a crashed job should not leave a half-written store
+    with open(opath + '.tmp', 'wb') as wfile:
+        np.save(wfile, embs)
+    with open(os.path.join(emb_dir, name + '.meta.json.tmp'), 'w') as wfile:
+        json.dump(meta, wfile)
+    os.replace(opath + '.tmp', opath)
+    os.replace(os.path.join(emb_dir, name + '.meta.json.tmp'), os.path.join(emb_dir, name + '.meta.json'))
+    return opath
+
+
+class UserEmbWriter(object):
+    """Collect user vectors by uid and save them into the store in the user encoder order.
+        Replace the per-method ``uid \\t vector`` text files.
+    """
+    def __init__(self, emb_dir, method, user_encoder_path, epoch=None, dtype='float32'):
+        self.emb_dir = emb_dir
+        self.method = method
+        self.user_encoder_path = user_encoder_path
+        self.epoch = epoch
+        self.dtype = dtype
+        with open(user_encoder_path) as dfile:
+            self.user_encoder = json.load(dfile)
+        self.embs = None
+        self.filled = np.zeros(max(self.user_encoder.values()) + 1, dtype=bool)
+
+    def add(self, uid, vector):
+        if uid not in self.user_encoder:
+            return
+        if self.embs is None:
+            self.embs = np.zeros((len(self.filled), len(vector)), dtype=np.float32)
+        uidx = self.user_encoder[uid]
+        self.embs[uidx] = vector
+        self.filled[uidx] = True
+
+    def close(self):
+        if self.embs is None:
+            raise ValueError('No user vectors were added for {}.'.format(self.method))
+        return save_user_embs(
+            self.emb_dir, self.embs, self.method, self.user_encoder_path, epoch=self.epoch,
+            dtype=self.dtype, missing=len(self.filled) - self.filled.sum()
+        )
+
+
+class EmbeddingStore(object):
+    """Lazy, memory-mapped reader of a stored user matrix
+
+        Parameters
+        ----------
+        emb_dir: str
+            Directory of the method, such as ./resources/embedding/diabetes/caue_gru/
+        epoch: str
+            Training epoch, None or '' for the final embedding
+    """
+    def __init__(self, emb_dir, epoch=None):
+        self.emb_dir = emb_dir
+        self.name = emb_name(epoch)
+        self.path = os.path.join(emb_dir, self.name + '.npy')
+        self.meta_path = os.path.join(emb_dir, self.name + '.meta.json')
+        self._meta = None
+        self._matrix = None
+        self._uid_index = None
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.exists(self.meta_path)
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(self.meta_path) as dfile:
+                self._meta = json.load(dfile)
+        return self._meta
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.load(self.path, mmap_mode='r')
+        return self._matrix
+
+    @property
+    def dims(self):
+        return self.meta['dims']
+
+    @property
+    def method(self):
+        return self.meta['method']
+
+    @property
+    def uid_index(self):
+        if self._uid_index is None:
+            self._uid_index = dict((uid, uidx) for uidx, uid in enumerate(self.meta['uids']))
+        return self._uid_index
+
+    def __len__(self):
+        return self.meta['num_users']
+
+    def __getitem__(self, uidx):
+        return self.matrix[uidx]
+
+    def get(self, uid):
+        return self.matrix[self.uid_index[uid]]
+
+    def aligned(self, user_encoder_path, dtype=np.float32):
+        """Return the user matrix with rows following the given user encoder.
+            The memory map is returned as it is if the encoder did not change.
+        """
+        if file_hash(user_encoder_path) == self.meta['data_hash']:
+            matrix = self.matrix
+        else:
+            with open(user_encoder_path) as dfile:
+                uids = encoder_uids(json.load(dfile))
+            matrix = np.zeros((len(uids), self.dims), dtype=self.matrix.dtype)
+            rows = [(uidx, self.uid_index[uid]) for uidx, uid in enumerate(uids) if uid in self.uid_index]
+            if len(rows) > 0:
+                rows = np.asarray(rows)
+                matrix[rows[:, 0]] = self.matrix[rows[:, 1]]
+
+        if dtype is not None and matrix.dtype != dtype:
+            matrix = matrix.astype(dtype)
+        return matrix
+
+
+def open_user_embs(emb_dir, user_encoder_path, epoch=None, method=None):
+    """Open the store of a method, legacy outputs are converted once into the store format:
+        a bare ``user[_{epoch}].npy`` is assumed to follow the user encoder already,
+        a ``user.txt`` (uid \\t vector per line) is parsed and saved as ``user.npy``.
+    """
+    store = EmbeddingStore(emb_dir, epoch)
+    if store.exists():
+        return store
+
+    if method is None:
+        method = os.path.basename(os.path.normpath(emb_dir))
+    if os.path.exists(store.path):
+        save_user_embs(emb_dir, np.load(store.path), method, user_encoder_path, epoch=epoch)
+    elif (epoch is None or epoch == '') and os.path.exists(os.path.join(emb_dir, 'user.txt')):
+        writer = UserEmbWriter(emb_dir, method, user_encoder_path)
+        with open(os.path.join(emb_dir, 'user.txt')) as dfile:
+            for line in dfile:
+                line = line.strip().split('\t')
+                if len(line) != 2:
+                    continue
+                writer.add(line[0], np.asarray(line[1].split(), dtype=np.float32))
+        writer.close()
+    else:
+        raise ValueError('No user embeddings found under {}'.format(emb_dir))
+    return EmbeddingStore(emb_dir, epoch)
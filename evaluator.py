@@ -15,6 +15,9 @@ from sklearn.cluster import SpectralClustering
 import keras
 from tqdm import tqdm
 
+from emb_store import open_user_embs
+from emb_quant import QuantizedStore
+
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # for cpu usage
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
@@ -50,21 +53,15 @@ def data_loader(params):
             }
 
     # load the user embeddings, default to load the user.npy
-    if os.path.exists(params['emb_dir'] + 'user_{}.npy'.format(params['epoch'])):
-        uembs = np.load(params['emb_dir'] + 'user_{}.npy'.format(params['epoch']))
-    elif os.path.exists(params['emb_dir'] + 'user.txt'):
-        # this assumes using .txt file
-        uembs = [[]] * len(user_tags)
-        with open(params['emb_dir'] + 'user.txt') as dfile:
-            for line in dfile:
-                line = line.strip().split('\t')
-                if len(line) != 2:
-                    continue
-                uid = user_encoder[line[0]]
-                uembs[uid] = [float(item) for item in line[1].split()]
+    # dequantize the compressed user embeddings if required
+    if params.get('quant'):
+        store = QuantizedStore(params['emb_dir'], params['quant'], epoch=params['epoch'])
     else:
-        raise ValueError('Not support!')
-        # uembs = np.load(params['emb_dir'] + 'user_9.npy')
+        store = open_user_embs(
+            params['emb_dir'], params['data_dir'] + 'user_encoder.json',
+            epoch=params['epoch'], method=params['model']
+        )
+    uembs = store.aligned(params['data_dir'] + 'user_encoder.json')
     return uembs, user_tags, tag_encoder, user_encoder
 
 
@@ -142,12 +139,13 @@ def regression(params):
         y_true=true_labels_sets, y_pred=pred_labels_vals
     )
 
-    results = json.dumps(results, indent=4)
-    print(results)
+    report = json.dumps(results, indent=4)
+    print(report)
     with open(opath, 'a') as wfile:
         wfile.write(json.dumps(params) + '\n')
-        wfile.write(results)
+        wfile.write(report)
         wfile.write('\n\n')
+    return results
 
 
 def classification(params):
@@ -175,8 +173,8 @@ def classification(params):
     data = np.asarray(data)
     labels = np.asarray(labels)
 
-    # split into train/test, k-folds cross validation
-    kf = KFold(n_splits=5, shuffle=True)
+    # split into train/test, k-folds cross validation, a fixed kfold_seed reuses the same folds across runs
+    kf = KFold(n_splits=5, shuffle=True, random_state=params.get('kfold_seed'))
     results = {
         'precision': [],
         'recall': [],
@@ -210,12 +208,13 @@ def classification(params):
     results['recall'] = np.average(results['recall'])
     results['f1-score'] = np.average(results['f1-score'])
 
-    results = json.dumps(results, indent=4)
-    print(results)
+    report = json.dumps(results, indent=4)
+    print(report)
     with open(opath, 'a') as wfile:
         wfile.write(json.dumps(params) + '\n')
-        wfile.write(results)
+        wfile.write(report)
         wfile.write('\n\n')
+    return results
 
 
 def retrieval(params):
@@ -259,12 +258,13 @@ def retrieval(params):
     results['tags'] = np.average(results['tags'])
     results['tags_set'] = np.average(results['tags_set'])
 
-    results = json.dumps(results, indent=4)
-    print(results)
+    report = json.dumps(results, indent=4)
+    print(report)
     with open(opath, 'a') as wfile:
         wfile.write(json.dumps(params) + '\n')
-        wfile.write(results)
+        wfile.write(report)
         wfile.write('\n\n')
+    return results
 
 
 def mortality_eval(params):
@@ -351,14 +351,52 @@ def mortality_eval(params):
     results['f1-score'] = np.average(results['f1-score'])
     results['precision'] = np.average(results['precision'])
     results['recall'] = np.average(results['recall'])
-    results = json.dumps(results, indent=4)
-    print(results)
+    report = json.dumps(results, indent=4)
+    print(report)
 
     opath = params['odir'] + 'mortality-{}.json'.format(params['dname'])
     with open(opath, 'a') as wfile:
         wfile.write(json.dumps(params) + '\n')
-        wfile.write(results)
+        wfile.write(report)
         wfile.write('\n\n')
+    return results
+
+
+def quantization_report(params, variants):
+    """ Accuracy drop of the quantized user embeddings on the retrieval and classification tasks
+
+    :param params: parameters
+    :param variants: list of quantization variants, exported by emb_quant.py
+    :return:
+    """
+    opath = params['odir'] + 'quantization-{}.json'.format(params['dname'])
+    # the baseline and the quantized variants are classified on the same folds
+    params = dict(params)
+    params.setdefault('kfold_seed', 33)
+    results = dict()
+    for quant in [''] + variants:
+        print('Quantization: {}'.format(quant if quant else 'none'))
+        quant_params = dict(params)
+        quant_params['quant'] = quant
+        results[quant if quant else 'none'] = {
+            'retrieval': retrieval(quant_params),
+            'classification': classification(quant_params),
+        }
+
+    for quant in variants:
+        for task in ['retrieval', 'classification']:
+            results[quant][task + '_drop'] = dict(
+                (metric, results['none'][task][metric] - value)
+                for metric, value in results[quant][task].items()
+            )
+
+    report = json.dumps(results, indent=4)
+    print(report)
+    with open(opath, 'a') as wfile:
+        wfile.write(json.dumps(params) + '\n')
+        wfile.write(report)
+        wfile.write('\n\n')
+    return results
 
 
 if __name__ == '__main__':
@@ -368,6 +406,8 @@ if __name__ == '__main__':
     args.add_argument('--sim_method', type=str, default='cosine')
     args.add_argument('--top_tags', type=int, default=50)
     args.add_argument('--epoch', type=str, default='')
+    args.add_argument('--quant', type=str, default='', help='evaluate a quantized variant: float16, int8 or pq')
+    args.add_argument('--quant_report', type=str, default='', help='comma separated variants to compare')
     args = args.parse_args()
 
     # categories of data names
@@ -381,11 +421,17 @@ if __name__ == '__main__':
         'eval_time': datetime.datetime.now().strftime('%H:%M:%S %m-%d-%Y'),
         'sim_method': args.sim_method,
         'top_tags': args.top_tags,
-        'epoch': args.epoch
+        'epoch': args.epoch,
+        'quant': args.quant,
     }
     if not os.path.exists(parameters['odir']):
         os.mkdir(parameters['odir'])
 
+    if args.quant_report:
+        print('Quantization Report: ')
+        quantization_report(parameters, args.quant_report.split(','))
+        exit()
+
     # comment out any tasks based your needs
     print('Regression Evaluation: ')
     regression(parameters)
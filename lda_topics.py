@@ -0,0 +1,123 @@
+"""Batched topic inference of the LDA models
+
+model[bow] infers one document at a time and returns the sparse (topic, probability) pairs.
+Here chunks of bag-of-words documents are inferred by one model.inference call, the gamma rows are
+normalized and the probabilities under the minimum probability of the model are zeroed, the same as model[bow],
+and the rows are scattered into a preallocated float32 matrix of (num_docs, num_topics).
+Averages of the users are segment reductions over the rows of their documents.
+Documents of the token corpus are fed as a sparse bag-of-words matrix in the ids of the LDA dictionary.
+"""
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from scipy import sparse
+
+
+def topic_rows(model, bows, minimum_probability=None):
+    """Dense topic distributions of the bag-of-words documents, one inference call
+
+    :param model: gensim LdaModel
+    :param bows: list of bag-of-words documents
+    :param minimum_probability: probabilities under it are zeros, None for the minimum probability of the model
+    :return: float32 matrix of (len(bows), num_topics)
+    """
+    if len(bows) == 0:
+        return np.zeros((0, model.num_topics), dtype=np.float32)
+    if minimum_probability is None:
+        minimum_probability = model.minimum_probability
+    # the same lower bound as get_document_topics
+    minimum_probability = max(minimum_probability, 1e-8)
+
+    gamma, _ = model.inference(bows)
+    topics = gamma / gamma.sum(axis=1)[:, None]
+    topics[topics < minimum_probability] = 0.
+    return topics.astype(np.float32)
+
+
+def infer_topics(model, bows, num_docs=None, chunk_size=2000):
+    """Topic matrix of the documents, inferred by chunks
+
+    :param bows: iterable of bag-of-words documents
+    :param num_docs: number of documents, None if bows has a length
+    :return: float32 matrix of (num_docs, num_topics)
+    """
+    if num_docs is None:
+        num_docs = len(bows)
+    topics = np.zeros((num_docs, model.num_topics), dtype=np.float32)
+    chunk = []
+    row = 0
+    for bow in bows:
+        chunk.append(bow)
+        if len(chunk) >= chunk_size:
+            topics[row: row + len(chunk)] = topic_rows(model, chunk)
+            row += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        topics[row: row + len(chunk)] = topic_rows(model, chunk)
+    return topics
+
+
+def segment_means(matrix, ptr):
+    """Means of the row segments, the i-th segment is matrix[ptr[i]:ptr[i+1]]
+
+    :return: float64 matrix of (len(ptr) - 1, dims) and the mask of the non-empty segments, the others are zeros
+    """
+    ptr = np.asarray(ptr, dtype=np.int64)
+    lengths = np.diff(ptr)
+    found = lengths > 0
+    means = np.zeros((len(lengths), matrix.shape[1]), dtype=np.float64)
+    if found.any():
+        # empty segments are skipped, each sum then ends at the start of the next non-empty segment
+        means[found] = np.add.reduceat(matrix[:ptr[-1]].astype(np.float64), ptr[:-1][found], axis=0)
+        means[found] /= lengths[found][:, None]
+    return means, found
+
+
+def bow_matrix(corpus, dictionary):
+    """Sparse bag-of-words matrix of (num_docs, len(dictionary)) of the token corpus, the same counts as doc2bow
+
+    :param corpus: token_corpus.TokenCorpus
+    :param dictionary: gensim Dictionary
+    """
+    # corpus word ids -> dictionary ids, the words out of the dictionary are dropped
+    pairs = [
+        (wid + 1, dictionary.token2id[word]) for wid, word in enumerate(corpus.words) if word in dictionary.token2id
+    ]
+    rows = np.asarray([wid for wid, _ in pairs], dtype=np.int64)
+    cols = np.asarray([tid for _, tid in pairs], dtype=np.int64)
+    remap = sparse.csr_matrix(
+        (np.ones(len(pairs)), (rows, cols)), shape=(corpus.vocab_size + 1, len(dictionary)))
+    bows = corpus.doc_word_counts() @ remap
+    bows.sort_indices()
+    return bows
+
+
+def user_topics(model, dictionary, corpus, mode='average', chunk_size=2000):
+    """Topic vectors of the users of the token corpus, users repeated in the data are merged
+
+    :param mode: average to average the topics of the documents, otherwise the documents of a user are concatenated
+    :return: list of the uids, float64 matrix of (num_uids, num_topics) and the mask of the users with documents
+    """
+    uids = []
+    item_index = dict()
+    for uid in corpus.uids:
+        if uid not in item_index:
+            item_index[uid] = len(uids)
+            uids.append(uid)
+    user_rows = np.asarray([item_index[uid] for uid in corpus.uids], dtype=np.int64)
+    doc_rows = np.repeat(user_rows, np.diff(corpus.user_ptr))
+    bows = bow_matrix(corpus, dictionary)
+
+    if mode == 'average':
+        topics = infer_topics(model, Sparse2Corpus(bows, documents_columns=False), bows.shape[0], chunk_size)
+        # documents grouped by the users for the segment reductions
+        order = np.argsort(doc_rows, kind='stable')
+        ptr = np.zeros(len(uids) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum(np.bincount(doc_rows, minlength=len(uids)))
+        means, found = segment_means(topics[order], ptr)
+        return uids, means, found
+
+    # the bag-of-words of the concatenated documents
+    bows = corpus.user_doc_matrix(user_rows, len(uids)) @ bows
+    bows.sort_indices()
+    topics = infer_topics(model, Sparse2Corpus(bows, documents_columns=False), bows.shape[0], chunk_size)
+    return uids, topics.astype(np.float64), np.bincount(doc_rows, minlength=len(uids)) > 0
@@ -0,0 +1,222 @@
+"""Indexed, memory-mapped copy of the pretrained word vectors
+
+Loading the full BioWordVec binary only to extract the rows of a small vocabulary takes minutes,
+the vectors are converted once into an index directory next to the pretrained file:
+    vectors.f32: float32 rows of the vectors, memory-mapped
+    words.bin, word_ptr.npy: utf-8 words of the rows, the i-th word is words[word_ptr[i]:word_ptr[i+1]]
+    hashes.npy, hash_rows.npy: sorted 64-bit hashes of the words and their rows
+    meta.json: number of rows and vector size
+A vocabulary is looked up by the hashes and its rows are gathered in one step.
+Words appearing more than once keep their last vectors, the same as loading them into a dict.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from build_cache import BuildCache
+
+FORMAT_VERSION = 1
+
+
+def word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def iter_bin_vectors(emb_path):
+    """(word, vector) of the word2vec binary format"""
+    with open(emb_path, 'rb') as dfile:
+        num_rows, vector_size = [int(item) for item in dfile.readline().split()]
+        num_bytes = np.dtype(np.float32).itemsize * vector_size
+        for _ in range(num_rows):
+            word = bytearray()
+            while True:
+                char = dfile.read(1)
+                if char == b' ' or char == b'':
+                    break
+                # some files end the vectors by newlines
+                if char != b'\n':
+                    word.extend(char)
+            yield word.decode('utf-8'), np.frombuffer(dfile.read(num_bytes), dtype=np.float32)
+
+
+def iter_txt_vectors(emb_path):
+    """(word, vector) of the text format, rows not in the vector size of the first row are skipped"""
+    vector_size = -1
+    with open(emb_path) as dfile:
+        for line in dfile:
+            line = line.strip().split()
+            # header of the word2vec text format
+            if vector_size == -1 and len(line) == 2 and line[0].isdigit() and line[1].isdigit():
+                continue
+            if len(line) < 2:
+                continue
+            vectors = np.asarray(line[1:], dtype='float32')
+            if vector_size == -1:
+                vector_size = len(vectors)
+            if len(vectors) != vector_size:
+                continue
+            yield line[0], vectors
+
+
+def build_vector_index(emb_path, index_dir):
+    """Convert the pretrained vectors, .bin or .txt, into the index directory"""
+    if emb_path.endswith('.bin'):
+        pairs = iter_bin_vectors(emb_path)
+    elif emb_path.endswith('.txt'):
+        pairs = iter_txt_vectors(emb_path)
+    else:
+        raise ValueError('Current other formats are not supported!')
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    hashes = []
+    word_ptr = [0]
+    vector_size = -1
+    with open(os.path.join(index_dir, 'vectors.f32'), 'wb') as vfile, \
+            open(os.path.join(index_dir, 'words.bin'), 'wb') as wfile:
+        for word, vectors in tqdm(pairs, desc='Indexing vectors'):
+            vector_size = len(vectors)
+            vfile.write(vectors.astype(np.float32).tobytes())
+            word = word.encode('utf-8')
+            wfile.write(word)
+            word_ptr.append(word_ptr[-1] + len(word))
+            hashes.append(hashlib.blake2b(word, digest_size=8).digest())
+
+    hashes = np.frombuffer(b''.join(hashes), dtype='<u8')
+    rows = np.arange(len(hashes), dtype=np.int64)
+    # sorted by hashes then rows, the last row of each word is kept
+    order = np.lexsort((rows, hashes))
+    hashes = hashes[order]
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[:-1] = hashes[:-1] != hashes[1:]
+    np.save(os.path.join(index_dir, 'hashes.npy'), hashes[keep])
+    np.save(os.path.join(index_dir, 'hash_rows.npy'), rows[order][keep])
+    np.save(os.path.join(index_dir, 'word_ptr.npy'), np.asarray(word_ptr, dtype=np.int64))
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as wfile:
+        json.dump({
+            'format_version': FORMAT_VERSION, 'num_rows': len(rows), 'vector_size': vector_size
+        }, wfile)
+
+
+class PretrainedVectors(object):
+    """Reader of the indexed vectors
+
+        Parameters
+        ----------
+        index_dir: str
+            Directory of the indexed vectors
+    """
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as dfile:
+            meta = json.load(dfile)
+        self.vector_size = meta['vector_size']
+        if meta['num_rows'] == 0:
+            raise ValueError('No vectors found in {}'.format(index_dir))
+        self.vectors = np.memmap(
+            os.path.join(index_dir, 'vectors.f32'), dtype=np.float32, mode='r',
+            shape=(meta['num_rows'], meta['vector_size'])
+        )
+        self.words = np.memmap(os.path.join(index_dir, 'words.bin'), dtype=np.uint8, mode='r')
+        self.word_ptr = np.load(os.path.join(index_dir, 'word_ptr.npy'))
+        self.hashes = np.load(os.path.join(index_dir, 'hashes.npy'))
+        self.hash_rows = np.load(os.path.join(index_dir, 'hash_rows.npy'))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def word(self, row):
+        return self.words[self.word_ptr[row]: self.word_ptr[row + 1]].tobytes().decode('utf-8')
+
+    def lookup(self, words):
+        """Rows of the words, -1 for the missing ones"""
+        queries = np.asarray([word_hash(word) for word in words], dtype='<u8')
+        rows = np.full(len(queries), -1, dtype=np.int64)
+        if len(queries) == 0:
+            return rows
+        pos = np.minimum(np.searchsorted(self.hashes, queries), len(self.hashes) - 1)
+        found = np.flatnonzero(self.hashes[pos] == queries)
+        for idx in found.tolist():
+            row = int(self.hash_rows[pos[idx]])
+            # hashes are 64 bits, the words are compared in case of collisions
+            if self.word(row) == words[idx]:
+                rows[idx] = row
+        return rows
+
+    def gather(self, words):
+        """Vectors of the words, zeros for the missing ones
+
+        :return: float32 matrix of (len(words), vector_size) and the boolean mask of the found words
+        """
+        rows = self.lookup(words)
+        found = np.flatnonzero(rows >= 0)
+        vectors = np.zeros((len(words), self.vector_size), dtype=np.float32)
+        # rows are read in the file order
+        order = found[np.argsort(rows[found], kind='stable')]
+        vectors[order] = self.vectors[rows[order]]
+        return vectors, rows >= 0
+
+    def embedding_matrix(self, word_index, num_rows):
+        """Rows of a word index, words with indices not under num_rows are skipped
+
+        :param word_index: word -> row index, such as the Keras word_index
+        :param num_rows: number of rows of the matrix
+        :return: float64 matrix of (num_rows, vector_size), rows of the missing words are zeros
+        """
+        pairs = [(word, idx) for word, idx in word_index.items() if idx < num_rows]
+        emb_model = np.zeros((num_rows, self.vector_size))
+        vectors, found = self.gather([word for word, _ in pairs])
+        indices = np.asarray([idx for _, idx in pairs], dtype=np.int64)
+        emb_model[indices[found]] = vectors[found]
+        return emb_model
+
+    def compose(self, phrases):
+        """Average vectors of the whitespace tokens of each phrase, repeated tokens are counted repeatedly.
+            Phrases are composed by one product of a sparse phrase x token averaging matrix and the token vectors.
+
+        :param phrases: list of phrases
+        :return: float64 matrix of (len(phrases), vector_size), rows of phrases without known tokens are zeros
+        """
+        token_index = dict()
+        rows = []
+        cols = []
+        for pdx, phrase in enumerate(phrases):
+            for token in phrase.split():
+                if token not in token_index:
+                    token_index[token] = len(token_index)
+                rows.append(pdx)
+                cols.append(token_index[token])
+        vectors, found = self.gather(list(token_index.keys()))
+
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        known = found[cols]
+        rows, cols = rows[known], cols[known]
+        # weights of the known tokens, 1 / number of known tokens in the phrase
+        counts = np.bincount(rows, minlength=len(phrases))
+        averaging = sparse.csr_matrix(
+            (1. / counts[rows], (rows, cols)), shape=(len(phrases), len(token_index))
+        )
+        return np.asarray(averaging @ vectors.astype(np.float64))
+
+
+def index_path(emb_path):
+    """Default location of the index, next to the pretrained file"""
+    return emb_path + '.index/'
+
+
+def open_pretrained_vectors(emb_path, index_dir=None):
+    """Open the indexed vectors of a pretrained file, the index is built on the first use"""
+    if not emb_path.endswith('.bin') and not emb_path.endswith('.txt'):
+        raise ValueError('Current other formats are not supported!')
+    if index_dir is None:
+        index_dir = index_path(emb_path)
+    cache = BuildCache(index_dir)
+    key = cache.key(inputs=[emb_path])
+    if not cache.fresh('vector_index', key, [os.path.join(index_dir, 'meta.json')]):
+        build_vector_index(emb_path, index_dir)
+        cache.record('vector_index', key, [os.path.join(index_dir, 'meta.json')])
+    return PretrainedVectors(index_dir)
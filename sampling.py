@@ -0,0 +1,112 @@
+"""Negative samplers of the word ids
+
+The unigram distribution raised to the power of 0.75 is built once as a Walker alias table,
+every draw is then O(1): pick a column uniformly, keep it by its probability or take its alias.
+Words used by a document are excluded by rejection, the rejected draws are drawn again,
+which is the same as sampling from the distribution renormalized over the other words.
+Random numbers are drawn from the global np.random state, the same as the samplers it replaces.
+"""
+import numpy as np
+
+
+def build_alias_table(probs):
+    """Walker alias table of a discrete distribution, by the Vose algorithm
+
+    :param probs: probabilities summing to 1
+    :return: acceptance probabilities and aliases of the columns
+    """
+    num = len(probs)
+    scaled = np.asarray(probs, dtype=np.float64) * num
+    accept = np.zeros(num, dtype=np.float64)
+    alias = np.zeros(num, dtype=np.int64)
+    small = [idx for idx in range(num) if scaled[idx] < 1.]
+    large = [idx for idx in range(num) if scaled[idx] >= 1.]
+
+    while len(small) > 0 and len(large) > 0:
+        sdx = small.pop()
+        ldx = large.pop()
+        accept[sdx] = scaled[sdx]
+        alias[sdx] = ldx
+        scaled[ldx] = scaled[ldx] + scaled[sdx] - 1.
+        if scaled[ldx] < 1.:
+            small.append(ldx)
+        else:
+            large.append(ldx)
+    # the remaining columns are full, up to rounding errors
+    for idx in large + small:
+        accept[idx] = 1.
+        alias[idx] = idx
+    return accept, alias
+
+
+class UnigramSampler(object):
+    """Sample word ids by their counts to the power
+
+        Parameters
+        ----------
+        counts: np.ndarray
+            Counts of the word ids, ids with zero counts such as the padding are never drawn
+        power: float
+            Power of the counts
+    """
+    def __init__(self, counts, power=.75):
+        counts = np.asarray(counts, dtype=np.float64)
+        if counts.sum() <= 0:
+            raise ValueError('Unigram sampler needs positive counts!')
+        self.probs = counts ** power
+        self.probs[counts <= 0] = 0.
+        self.probs /= self.probs.sum()
+        self.accept, self.alias = build_alias_table(self.probs)
+
+    @classmethod
+    def from_vocab(cls, vocab, power=.75):
+        """Sampler of the ids under num_words of a vocabulary, with word_counts and index_word"""
+        counts = np.zeros(vocab.num_words, dtype=np.float64)
+        for wid in vocab.index_word:
+            if wid < vocab.num_words:
+                counts[wid] = vocab.word_counts[vocab.index_word[wid]]
+        return cls(counts, power)
+
+    def __len__(self):
+        return len(self.probs)
+
+    def sample(self, size):
+        columns = np.random.randint(0, len(self.probs), size=size)
+        keep = np.random.random_sample(size) < self.accept[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+    def sample_excluding(self, size, exclude=None):
+        """Draw size ids not in the exclude set"""
+        return self.sample_many([size], [exclude])[0]
+
+    def sample_many(self, sizes, excludes=None):
+        """Draw the negative ids of many documents at once
+
+        :param sizes: number of ids of each document
+        :param excludes: set of ids excluded from each document, such as the words used by the document
+        :return: list of int64 arrays
+        """
+        sizes = np.asarray(sizes, dtype=np.int64)
+        ptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum(sizes)
+        draws = self.sample(ptr[-1])
+        if excludes is None:
+            return [draws[ptr[idx]: ptr[idx + 1]] for idx in range(len(sizes))]
+
+        results = []
+        for idx, exclude in enumerate(excludes):
+            ids = draws[ptr[idx]: ptr[idx + 1]]
+            if not exclude:
+                results.append(ids)
+                continue
+            exclude = np.fromiter(exclude, dtype=np.int64, count=len(exclude))
+            exclude = exclude[(exclude >= 0) & (exclude < len(self.probs))]
+            if self.probs[np.unique(exclude)].sum() >= 1. - 1e-12:
+                raise ValueError('No words to sample out of the excluded words!')
+
+            rejected = np.isin(ids, exclude)
+            while rejected.any():
+                ids[rejected] = self.sample(int(rejected.sum()))
+                rejected = np.isin(ids, exclude)
+            results.append(ids)
+        return results
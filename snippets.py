@@ -0,0 +1,147 @@
+"""Deterministic snippet index of the documents
+
+Long documents are split into snippets of a random length, drawn between 200 and max_len tokens.
+The length of each document is drawn from a generator seeded by the global seed and the document key,
+the boundaries are then the same across rebuilds and do not depend on the order of the documents.
+The index keeps the offsets of the snippets in the words of the documents, the same words as the token corpus:
+    doc_keys: {uid}_{doc_id}
+    doc_ptr: snippets of the i-th document are rows doc_ptr[i]:doc_ptr[i+1]
+    starts, ends: int32 word offsets of the snippets
+"""
+import json
+import zlib
+
+import numpy as np
+from tqdm import tqdm
+
+from vocab import text_to_words
+
+MIN_SNIPPET_LEN = 200
+
+
+def snippet_length(doc_key, max_len=512, seed=0):
+    """Number of tokens per snippet of a document, two positions are kept for the start and end tokens"""
+    rng = np.random.RandomState([seed, zlib.crc32(doc_key.encode('utf-8'))])
+    return rng.randint(MIN_SNIPPET_LEN, high=max_len) - 2
+
+
+def split_offsets(num_tokens, length):
+    """Token offsets of the consecutive snippets, the last one keeps the remaining tokens
+
+    :param num_tokens: number of tokens of the document
+    :param length: number of tokens per snippet
+    :return: int32 arrays of starts and ends
+    """
+    starts = np.arange(0, num_tokens, length, dtype=np.int32)
+    ends = np.minimum(starts + length, num_tokens).astype(np.int32)
+    return starts, ends
+
+
+def split_docs(doc, max_len=512, seed=0, doc_key=''):
+    """Split a document into snippets of at most max_len - 2 tokens
+
+    :param doc: text or list of words
+    :return: list of snippet texts
+    """
+    if type(doc) == str:
+        doc = text_to_words(doc)
+    starts, ends = split_offsets(len(doc), snippet_length(doc_key, max_len, seed))
+    return [' '.join(doc[start: end]) for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def doc_key(uid, doc_id):
+    """Key of a document, the same as the concept store"""
+    return '{}_{}'.format(uid.split('-')[0], doc_id)
+
+
+class SnippetIndex(object):
+    """Snippet offsets of all documents of a dataset
+
+        Parameters
+        ----------
+        doc_keys: list
+            Keys of the documents
+        doc_ptr, starts, ends: np.ndarray
+            Ragged snippet offsets of the documents
+        max_len: int
+        seed: int
+    """
+    def __init__(self, doc_keys, doc_ptr, starts, ends, max_len, seed):
+        self.doc_keys = list(doc_keys)
+        self.doc_ptr = doc_ptr
+        self.starts = starts
+        self.ends = ends
+        self.max_len = max_len
+        self.seed = seed
+        self.doc_index = dict((key, idx) for idx, key in enumerate(self.doc_keys))
+
+    def __len__(self):
+        return len(self.doc_keys)
+
+    def __contains__(self, key):
+        return key in self.doc_index
+
+    @property
+    def num_snippets(self):
+        return len(self.starts)
+
+    def offsets(self, key):
+        """(starts, ends) of the snippets of a document"""
+        idx = self.doc_index[key]
+        return (
+            self.starts[self.doc_ptr[idx]: self.doc_ptr[idx + 1]],
+            self.ends[self.doc_ptr[idx]: self.doc_ptr[idx + 1]]
+        )
+
+    def snippets(self, key, tokens):
+        """Word lists of the snippets of a document
+
+        :param key: document key
+        :param tokens: words of the document
+        """
+        starts, ends = self.offsets(key)
+        return [tokens[start: end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+    @classmethod
+    def build(cls, data_path, max_len=512, seed=0):
+        """Index the documents of the json lines dataset, documents repeated under the same key are indexed once"""
+        doc_keys = []
+        seen = set()
+        doc_ptr = [0]
+        starts = []
+        ends = []
+        with open(data_path) as dfile:
+            for line in tqdm(dfile, desc='Indexing snippets'):
+                user_entity = json.loads(line)
+                for doc_entity in user_entity['docs']:
+                    key = doc_key(user_entity['uid'], doc_entity['doc_id'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    doc_starts, doc_ends = split_offsets(
+                        len(text_to_words(doc_entity['text'])), snippet_length(key, max_len, seed))
+                    doc_keys.append(key)
+                    starts.append(doc_starts)
+                    ends.append(doc_ends)
+                    doc_ptr.append(doc_ptr[-1] + len(doc_starts))
+
+        return cls(
+            doc_keys, np.asarray(doc_ptr, dtype=np.int64),
+            np.concatenate(starts) if len(starts) > 0 else np.zeros(0, dtype=np.int32),
+            np.concatenate(ends) if len(ends) > 0 else np.zeros(0, dtype=np.int32),
+            max_len, seed
+        )
+
+    def save(self, opath):
+        np.savez(
+            opath, doc_keys=np.asarray(self.doc_keys, dtype=str), doc_ptr=self.doc_ptr,
+            starts=self.starts, ends=self.ends, max_len=self.max_len, seed=self.seed
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as dfile:
+            return cls(
+                dfile['doc_keys'].tolist(), dfile['doc_ptr'], dfile['starts'], dfile['ends'],
+                int(dfile['max_len']), int(dfile['seed'])
+            )
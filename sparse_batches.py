@@ -0,0 +1,52 @@
+"""Sparse CSR inputs of the autoencoder baselines
+
+The user features of SuiSil2018, the tf-idf of the concepts, are mostly zeros.
+They are kept as a scipy CSR matrix, the dataset only yields row indices and the collate function
+slices the rows of a batch into a sparse COO tensor for the first layer and a dense tensor for the loss.
+Memory is then O(nnz) for the matrix and O(batch_size x dims) for each batch.
+"""
+import numpy as np
+import torch
+from scipy import sparse
+from torch.utils.data import Dataset
+
+
+def to_sparse_tensor(matrix):
+    """Sparse COO float tensor of a scipy sparse matrix"""
+    matrix = matrix.tocoo()
+    indices = torch.from_numpy(np.vstack((matrix.row, matrix.col)).astype(np.int64))
+    values = torch.from_numpy(matrix.data.astype(np.float32))
+    return torch.sparse_coo_tensor(indices, values, matrix.shape).coalesce()
+
+
+def sparse_dropout(features, dropout):
+    """Apply the dropout module on the values of a sparse tensor, zeros stay zeros"""
+    return torch.sparse_coo_tensor(features.indices(), dropout(features.values()), features.shape)
+
+
+def sparse_linear(features, layer):
+    """Linear layer of a sparse input, a sparse x dense product"""
+    return torch.sparse.mm(features, layer.weight.t()) + layer.bias
+
+
+class CSRDataset(Dataset):
+    """Rows of a CSR matrix, batches are built by its collate function
+
+        Parameters
+        ----------
+        matrix: scipy.sparse matrix
+            Features of (num_items, dims)
+    """
+    def __init__(self, matrix):
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, idx):
+        return idx
+
+    def collate(self, indices):
+        """Sparse input and dense target of the rows of a batch"""
+        rows = self.matrix[np.asarray(indices, dtype=np.int64)]
+        return to_sparse_tensor(rows), torch.from_numpy(rows.toarray())
@@ -0,0 +1,112 @@
+"""The vocabulary and the token corpus against the Keras Tokenizer on clinical strings
+
+The expected ids were produced by the Keras Tokenizer with the default filters and lower=True,
+the live cross-check needs keras_preprocessing.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from token_corpus import build_token_corpus, slice_corpus
+from vocab import Vocab, pad_ragged
+
+CLINICAL_TEXTS = [
+    'Pt c/o chest pain, SOB x2 days; BP 140/90.',
+    'Hx: DM-II, HTN (on Lisinopril 10mg), s/p CABG 2019!',
+    'No N/V/D. Denies CHEST PAIN.\tAfebrile\r\nTmax 99.1F',
+    "Pt's wife at bedside; plan: f/u w/ cardiology in 2-3 wks",
+    'BP 120/80 HR 72 RR 16 O2 98% RA, chest pain resolved',
+    '',
+]
+
+# texts_to_sequences of the Keras Tokenizer fitted on CLINICAL_TEXTS
+EXPECTED_SEQUENCES = {
+    None: [
+        [4, 5, 6, 1, 2, 7, 8, 9, 3, 10, 11],
+        [12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22],
+        [23, 24, 25, 26, 27, 1, 2, 28, 29, 30, 31],
+        [32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44],
+        [3, 45, 46, 47, 48, 49, 50, 51, 52, 53, 1, 2, 54],
+        [],
+    ],
+    10: [[4, 5, 6, 1, 2, 7, 8, 9, 3], [], [1, 2], [], [3, 1, 2], []],
+}
+
+
+@pytest.mark.parametrize('num_words', [None, 10])
+def test_texts_to_sequences(num_words):
+    vocab = Vocab.fit(CLINICAL_TEXTS, num_words=num_words)
+    assert vocab.word_index['afebrile\r'] == 28
+    assert vocab.texts_to_sequences(CLINICAL_TEXTS) == EXPECTED_SEQUENCES[num_words]
+
+
+def test_whitespace_split():
+    vocab = Vocab.fit(CLINICAL_TEXTS, keras_filters=False)
+    assert vocab.texts_to_sequences(['chest pain,'])[0] == [vocab.word_index['chest'], vocab.word_index['pain,']]
+
+
+def test_token_corpus(tmp_path):
+    users = [('u1', CLINICAL_TEXTS[:3]), ('u2', CLINICAL_TEXTS[3:])]
+    corpus = build_token_corpus(str(tmp_path) + '/', lambda: iter(users))
+    vocab = Vocab.fit(CLINICAL_TEXTS)
+    assert corpus.words == vocab.words
+    expected = Vocab.fit(CLINICAL_TEXTS, num_words=10).encode(CLINICAL_TEXTS, 8)
+    assert (corpus.padded(num_words=10, maxlen=8) == expected).all()
+    assert corpus.vocab().texts_to_sequences(CLINICAL_TEXTS) == EXPECTED_SEQUENCES[None]
+
+
+@pytest.mark.parametrize('block_size', [1 << 24, 1, 5])
+def test_slice_corpus(tmp_path, block_size):
+    corpus = build_token_corpus(str(tmp_path / 'docs') + '/', lambda: iter([('u1', CLINICAL_TEXTS)]))
+    rows, starts, ends = [3, 0, 0, 5, 2, 4], [2, 0, 4, 0, 1, 10], [9, 4, 11, 0, 3, 13]
+    sliced = slice_corpus(
+        str(tmp_path / 'snippets') + '/', corpus, ['u2', 'u3'], [0, 2, 6], rows, starts, ends, block_size)
+    assert sliced.uids == ['u2', 'u3']
+    assert list(sliced.user_doc_range(1)) == [2, 3, 4, 5]
+    texts = [' '.join(corpus.doc_words(row)[start: end]) for row, start, end in zip(rows, starts, ends)]
+    assert list(sliced.texts()) == texts
+
+    # the same ids as the corpus tokenized from the texts of the ranges
+    vocab = Vocab.fit(texts)
+    assert sliced.words == vocab.words and sliced.counts == vocab.counts
+    assert [sliced.doc(ddx).tolist() for ddx in range(len(texts))] == vocab.texts_to_sequences(texts)
+
+
+def test_pad_ragged():
+    # lengths 0, 2, 5 and 3: padded and truncated at the front, the last maxlen ids are kept
+    ids = np.arange(1, 11, dtype=np.int32)
+    expected = [[0, 0, 0], [0, 1, 2], [5, 6, 7], [8, 9, 10]]
+    assert pad_ragged(ids, [0, 0, 2, 7, 10], 3).tolist() == expected
+    assert pad_ragged(ids, [0, 0, 2, 7, 10], 5, value=-1).tolist() == [
+        [-1, -1, -1, -1, -1], [-1, -1, -1, 1, 2], [3, 4, 5, 6, 7], [-1, -1, 8, 9, 10]]
+
+
+@pytest.mark.parametrize('num_workers, block_size', [(1, 10000), (1, 1), (2, 3)])
+def test_encode_padding(num_workers, block_size):
+    vocab = Vocab(['w1', 'w2', 'w3', 'w4', 'w5'], [5, 4, 3, 2, 1])
+    texts = ['w1 w2 w3 w4 w5', 'w1', '', 'w2 w3 w4']
+    assert vocab.encode(texts, 3, num_workers, block_size).tolist() == [
+        [3, 4, 5], [0, 0, 1], [0, 0, 0], [2, 3, 4]]
+    assert vocab.encode(texts, 5, num_workers, block_size).tolist() == [
+        [1, 2, 3, 4, 5], [0, 0, 0, 0, 1], [0, 0, 0, 0, 0], [0, 0, 2, 3, 4]]
+
+    # the ids over num_words are dropped before truncating, as pad_sequences of texts_to_sequences
+    vocab = Vocab(vocab.words, vocab.counts, num_words=4)
+    assert vocab.encode(texts, 2, num_workers, block_size).tolist() == [[2, 3], [0, 1], [0, 0], [2, 3]]
+
+
+@pytest.mark.parametrize('num_words', [None, 10])
+def test_keras_tokenizer(num_words):
+    text = pytest.importorskip('keras_preprocessing.text')
+    sequence = pytest.importorskip('keras_preprocessing.sequence')
+    tokenizer = text.Tokenizer(num_words=num_words)
+    tokenizer.fit_on_texts(CLINICAL_TEXTS)
+    vocab = Vocab.fit(CLINICAL_TEXTS, num_words=num_words, num_workers=2, block_size=2)
+
+    assert vocab.word_index == tokenizer.word_index
+    assert vocab.texts_to_sequences(CLINICAL_TEXTS) == tokenizer.texts_to_sequences(CLINICAL_TEXTS)
+    expected = sequence.pad_sequences(tokenizer.texts_to_sequences(CLINICAL_TEXTS), maxlen=8)
+    assert (vocab.encode(CLINICAL_TEXTS, 8, num_workers=2, block_size=2) == expected).all()
@@ -0,0 +1,351 @@
+"""Tokenized corpus shared by the models
+
+Documents are tokenized once, as the Keras Tokenizer with its default filters and lower=True, into the word ids
+of a frequency ranked vocabulary. Like the Keras word_index, ids start from 1 by the descending counts, ties in the
+order of first occurrences, and 0 is left for padding. The corpus directory keeps:
+    tokens.npy: int32 word ids of all documents, concatenated
+    doc_ptr.npy: tokens of the i-th document are tokens[doc_ptr[i]:doc_ptr[i+1]]
+    user_ptr.npy: documents of the u-th user are rows user_ptr[u]:user_ptr[u+1]
+    meta.json: user ids, vocabulary words, their counts and the filter option
+The arrays are memory-mapped when loaded, models keep the first num_words - 1 words by dropping the larger ids.
+"""
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from build_cache import BuildCache
+from vocab import Vocab, pad_ragged, text_to_words
+
+FORMAT_VERSION = 2
+
+
+def iter_json_users(data_path):
+    """(uid, list of document texts) of the json lines dataset"""
+    with open(data_path) as dfile:
+        for line in dfile:
+            user_entity = json.loads(line)
+            yield str(user_entity['uid']), [doc_entity['text'] for doc_entity in user_entity['docs']]
+
+
+def count_words(read_users, keras_filters=True):
+    """Word counts, number of tokens, documents and users
+
+    :param read_users: function returning an iterator over (uid, list of texts)
+    :param keras_filters: split as the Keras Tokenizer, False to split by whitespace only
+    """
+    word_counts = dict()
+    num_tokens = 0
+    num_docs = 0
+    num_users = 0
+    for _, texts in tqdm(read_users(), desc='Counting words'):
+        num_users += 1
+        for text in texts:
+            num_docs += 1
+            for word in text_to_words(text, keras_filters):
+                num_tokens += 1
+                if word in word_counts:
+                    word_counts[word] += 1
+                else:
+                    word_counts[word] = 1
+    return word_counts, num_tokens, num_docs, num_users
+
+
+def build_token_corpus(odir, read_users, keras_filters=True):
+    """Tokenize the users into the corpus directory, the users are read twice, to count and to encode
+
+    :param odir: output directory of the corpus
+    :param read_users: function returning an iterator over (uid, list of texts)
+    :param keras_filters: split as the Keras Tokenizer, False to split by whitespace only
+    """
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+    word_counts, num_tokens, num_docs, num_users = count_words(read_users, keras_filters)
+    vocab = Vocab.from_counts(word_counts, document_count=num_docs, keras_filters=keras_filters)
+    word_index = vocab.word_index
+
+    tokens = np.lib.format.open_memmap(os.path.join(odir, 'tokens.npy'), mode='w+', dtype=np.int32, shape=(num_tokens,))
+    doc_ptr = np.zeros(num_docs + 1, dtype=np.int64)
+    user_ptr = np.zeros(num_users + 1, dtype=np.int64)
+    uids = []
+    pos = 0
+    ddx = 0
+    for udx, (uid, texts) in enumerate(tqdm(read_users(), desc='Encoding words', total=num_users)):
+        uids.append(uid)
+        for text in texts:
+            ids = [word_index[word] for word in text_to_words(text, keras_filters)]
+            tokens[pos: pos + len(ids)] = ids
+            pos += len(ids)
+            ddx += 1
+            doc_ptr[ddx] = pos
+        user_ptr[udx + 1] = ddx
+    tokens.flush()
+    del tokens
+
+    np.save(os.path.join(odir, 'doc_ptr.npy'), doc_ptr)
+    np.save(os.path.join(odir, 'user_ptr.npy'), user_ptr)
+    with open(os.path.join(odir, 'meta.json'), 'w') as wfile:
+        json.dump({
+            'format_version': FORMAT_VERSION,
+            'uids': uids,
+            'words': vocab.words,
+            'counts': vocab.counts,
+            'keras_filters': keras_filters,
+        }, wfile)
+    return TokenCorpus(odir)
+
+
+class TokenCorpus(object):
+    """Reader of the tokenized corpus
+
+        Parameters
+        ----------
+        corpus_dir: str
+            Directory of the corpus
+        mmap_mode: str
+            Memory map mode of the token array, None to load it in memory
+    """
+    def __init__(self, corpus_dir, mmap_mode='r'):
+        self.corpus_dir = corpus_dir
+        with open(os.path.join(corpus_dir, 'meta.json')) as dfile:
+            meta = json.load(dfile)
+        if meta['format_version'] != FORMAT_VERSION:
+            raise ValueError('Token corpus format {} not supported!'.format(meta['format_version']))
+        self.uids = meta['uids']
+        self.words = meta['words']
+        self.counts = meta['counts']
+        self.keras_filters = meta['keras_filters']
+        self.tokens = np.load(os.path.join(corpus_dir, 'tokens.npy'), mmap_mode=mmap_mode)
+        self.doc_ptr = np.load(os.path.join(corpus_dir, 'doc_ptr.npy'))
+        self.user_ptr = np.load(os.path.join(corpus_dir, 'user_ptr.npy'))
+
+    @property
+    def num_docs(self):
+        return len(self.doc_ptr) - 1
+
+    @property
+    def num_users(self):
+        return len(self.user_ptr) - 1
+
+    @property
+    def vocab_size(self):
+        """Number of words, excluding the padding"""
+        return len(self.words)
+
+    def word_index(self, num_words=None):
+        """word -> id, of ids under num_words"""
+        words = self.words if num_words is None else self.words[:max(num_words - 1, 0)]
+        return dict((word, idx + 1) for idx, word in enumerate(words))
+
+    def doc(self, idx, num_words=None):
+        """Word ids of a document, ids not under num_words are dropped"""
+        ids = self.tokens[self.doc_ptr[idx]: self.doc_ptr[idx + 1]]
+        if num_words is not None:
+            ids = ids[ids < num_words]
+        return np.asarray(ids)
+
+    def doc_words(self, idx):
+        """Words of a document"""
+        return [self.words[wid - 1] for wid in self.tokens[self.doc_ptr[idx]: self.doc_ptr[idx + 1]].tolist()]
+
+    def user_doc_range(self, udx):
+        return range(self.user_ptr[udx], self.user_ptr[udx + 1])
+
+    def user_docs(self, udx, num_words=None):
+        """Word ids of the documents of a user"""
+        return [self.doc(ddx, num_words) for ddx in self.user_doc_range(udx)]
+
+    def iter_docs(self, num_words=None):
+        for ddx in range(self.num_docs):
+            yield self.doc(ddx, num_words)
+
+    def iter_doc_words(self):
+        for ddx in range(self.num_docs):
+            yield self.doc_words(ddx)
+
+    def doc_word_counts(self, num_words=None, max_len=None, block_size=1 << 24):
+        """Sparse matrix of (num_docs, num_words) counting the word ids of each document
+
+        :param num_words: ids not under num_words are dropped, None to keep all words
+        :param max_len: only the first max_len tokens of each document are counted, None to count all
+        :param block_size: documents are counted by blocks of about block_size tokens
+        """
+        if num_words is None:
+            num_words = self.vocab_size + 1
+        blocks = []
+        start = 0
+        while start < self.num_docs:
+            end = np.searchsorted(self.doc_ptr, self.doc_ptr[start] + block_size, side='right') - 1
+            end = min(max(end, start + 1), self.num_docs)
+            ptr = self.doc_ptr[start: end + 1]
+            lengths = np.diff(ptr)
+            ids = np.asarray(self.tokens[ptr[0]: ptr[-1]])
+            rows = np.repeat(np.arange(end - start), lengths)
+            keep = ids < num_words
+            if max_len is not None:
+                # positions of the tokens in their documents
+                keep &= np.arange(len(ids)) - np.repeat(ptr[:-1] - ptr[0], lengths) < max_len
+            # rows of the block only, the blocks are stacked once at the end
+            blocks.append(sparse.csr_matrix(
+                (np.ones(keep.sum()), (rows[keep], ids[keep])), shape=(end - start, num_words)))
+            start = end
+        if len(blocks) == 0:
+            return sparse.csr_matrix((self.num_docs, num_words), dtype=np.float64)
+        return sparse.vstack(blocks, format='csr')
+
+    def word_remap(self, word_index, num_words):
+        """Sparse matrix of (vocab_size + 1, num_words) mapping the corpus ids into the ids of another vocabulary,
+            words out of word_index or not under num_words are dropped
+
+        :param word_index: word -> id of the other vocabulary
+        """
+        pairs = [
+            (wid + 1, word_index[word]) for wid, word in enumerate(self.words)
+            if word in word_index and word_index[word] < num_words
+        ]
+        rows = np.asarray([wid for wid, _ in pairs], dtype=np.int64)
+        cols = np.asarray([tid for _, tid in pairs], dtype=np.int64)
+        return sparse.csr_matrix((np.ones(len(pairs)), (rows, cols)), shape=(self.vocab_size + 1, num_words))
+
+    def user_doc_matrix(self, user_rows=None, num_rows=None):
+        """Sparse indicator matrix of (num_rows, num_docs) of the users and their documents
+
+        :param user_rows: output row of each user of the corpus, such as the rows of the repeated uids,
+            None for a row per user
+        """
+        if user_rows is None:
+            user_rows = np.arange(self.num_users)
+            num_rows = self.num_users
+        rows = np.repeat(np.asarray(user_rows, dtype=np.int64), np.diff(self.user_ptr))
+        return sparse.csr_matrix(
+            (np.ones(self.num_docs), (rows, np.arange(self.num_docs))), shape=(num_rows, self.num_docs))
+
+    def texts(self):
+        """The documents as space-joined words, made when accessed"""
+        return DocTexts(self)
+
+    def vocab(self, num_words=None):
+        """Vocabulary of the corpus, keeping the ids under num_words"""
+        return Vocab(self.words, self.counts, num_words, self.num_docs, self.keras_filters)
+
+    def padded(self, num_words=None, maxlen=512):
+        """All documents as an int32 matrix of (num_docs, maxlen), the same as pad_sequences of the documents"""
+        if num_words is None:
+            return pad_ragged(self.tokens, self.doc_ptr, maxlen)
+        keep = np.asarray(self.tokens) < num_words
+        # offsets of the documents after dropping the ids
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        kept[1:] = np.cumsum(keep)
+        return pad_ragged(np.asarray(self.tokens)[keep], kept[self.doc_ptr], maxlen)
+
+
+class DocTexts(object):
+    """Read-only list of the documents of a corpus as space-joined words"""
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return self.corpus.num_docs
+
+    def __getitem__(self, idx):
+        return ' '.join(self.corpus.doc_words(idx))
+
+    def __iter__(self):
+        for ddx in range(self.corpus.num_docs):
+            yield self[ddx]
+
+
+def slice_corpus(odir, corpus, uids, user_ptr, rows, starts, ends, block_size=1 << 24):
+    """Corpus of the word ranges of the documents of another corpus, tokens are copied without re-tokenizing.
+        The words are counted again on the ranges and ranked as the Keras Tokenizer fitted on their texts.
+
+    :param odir: output directory of the corpus
+    :param corpus: source TokenCorpus
+    :param uids: user ids of the new corpus
+    :param user_ptr: documents of the u-th user are rows user_ptr[u]:user_ptr[u+1]
+    :param rows, starts, ends: the i-th document is the words starts[i]:ends[i] of the document rows[i] of the corpus
+    :param block_size: documents are copied by blocks of about block_size tokens
+    """
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+    rows = np.asarray(rows, dtype=np.int64)
+    # ranges are clipped to their documents, as slices of the word lists
+    doc_lengths = corpus.doc_ptr[rows + 1] - corpus.doc_ptr[rows]
+    starts = np.minimum(np.asarray(starts, dtype=np.int64), doc_lengths)
+    ends = np.maximum(np.minimum(np.asarray(ends, dtype=np.int64), doc_lengths), starts)
+    begins = corpus.doc_ptr[rows] + starts
+    lengths = ends - starts
+    doc_ptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    doc_ptr[1:] = np.cumsum(lengths)
+
+    num_tokens = int(doc_ptr[-1])
+    tokens = np.lib.format.open_memmap(os.path.join(odir, 'tokens.npy'), mode='w+', dtype=np.int32, shape=(num_tokens,))
+    counts = np.zeros(len(corpus.words) + 1, dtype=np.int64)
+    firsts = np.full(len(corpus.words) + 1, num_tokens, dtype=np.int64)
+    start = 0
+    while start < len(rows):
+        end = max(int(np.searchsorted(doc_ptr, doc_ptr[start] + block_size, side='right')) - 1, start + 1)
+        # source positions of the block, every range is a run of consecutive positions
+        block_lengths = lengths[start: end]
+        offsets = np.arange(block_lengths.sum()) - np.repeat(doc_ptr[start: end] - doc_ptr[start], block_lengths)
+        block = corpus.tokens[np.repeat(begins[start: end], block_lengths) + offsets]
+        tokens[doc_ptr[start]: doc_ptr[end]] = block
+        ids, first, block_counts = np.unique(block, return_index=True, return_counts=True)
+        counts[ids] += block_counts
+        firsts[ids] = np.minimum(firsts[ids], first + doc_ptr[start])
+        start = end
+
+    # by counts, ties by first occurrences, the words out of the ranges are dropped
+    order = np.lexsort((firsts[1:], -counts[1:]))
+    order = order[counts[1:][order] > 0]
+    remap = np.zeros(len(counts), dtype=np.int32)
+    remap[order + 1] = np.arange(1, len(order) + 1, dtype=np.int32)
+    for pos in range(0, num_tokens, block_size):
+        tokens[pos: pos + block_size] = remap[tokens[pos: pos + block_size]]
+    tokens.flush()
+    del tokens
+
+    np.save(os.path.join(odir, 'doc_ptr.npy'), doc_ptr)
+    np.save(os.path.join(odir, 'user_ptr.npy'), np.asarray(user_ptr, dtype=np.int64))
+    with open(os.path.join(odir, 'meta.json'), 'w') as wfile:
+        json.dump({
+            'format_version': FORMAT_VERSION,
+            'uids': list(uids),
+            'words': [corpus.words[idx] for idx in order.tolist()],
+            'counts': counts[order + 1].tolist(),
+            'keras_filters': corpus.keras_filters,
+        }, wfile)
+    return TokenCorpus(odir)
+
+
+def average_rows(counts, embeddings):
+    """Weighted averages of the embedding rows, one sparse product
+
+    :param counts: sparse matrix of (num_items, num_rows) of the row counts of the items
+    :param embeddings: matrix of (num_rows, dims)
+    :return: float64 matrix of (num_items, dims) and the mask of the items with any rows, the others are zeros
+    """
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    means = np.asarray(counts @ np.asarray(embeddings, dtype=np.float64))
+    found = totals > 0
+    means[found] /= totals[found][:, None]
+    return means, found
+
+
+def corpus_path(data_path):
+    """Default location of the corpus of a json lines dataset, next to the dataset"""
+    return os.path.splitext(data_path)[0] + '_token_corpus/'
+
+
+def open_token_corpus(data_path, corpus_dir=None):
+    """Open the token corpus of a json lines dataset, it is rebuilt when the dataset changes"""
+    if corpus_dir is None:
+        corpus_dir = corpus_path(data_path)
+    cache = BuildCache(corpus_dir)
+    key = cache.key(inputs=[data_path], params={'format_version': FORMAT_VERSION})
+    if not cache.fresh('token_corpus', key, [os.path.join(corpus_dir, 'meta.json')]):
+        build_token_corpus(corpus_dir, lambda: iter_json_users(data_path))
+        cache.record('token_corpus', key, [os.path.join(corpus_dir, 'meta.json')])
+    return TokenCorpus(corpus_dir)
@@ -0,0 +1,56 @@
+"""Training pairs of the usr2vec models as contiguous columns
+
+Each column of the pairs, such as the user, word and concept ids, is an int32 array and the labels are an uint8 array.
+They are saved as .npy files under the output directory:
+    {prefix}_{name}.npy: int32 column of the pairs
+    {prefix}_labels.npy: uint8 labels of the pairs
+The columns are permuted together once per epoch, every batch is then a slice of the permuted arrays.
+"""
+import os
+
+import numpy as np
+
+
+def pair_paths(odir, prefix, names):
+    """Paths of the columns followed by the path of the labels"""
+    return [os.path.join(odir, '{}_{}.npy'.format(prefix, name)) for name in list(names) + ['labels']]
+
+
+def save_pairs(odir, prefix, names, columns, labels):
+    """Save the columns and the labels, each file is written to a temporary path and then replaced
+
+    :param names: names of the columns, such as ['uids', 'wids']
+    :param columns: list of the columns, in the order of the names
+    :param labels: labels of the pairs
+    """
+    arrays = [np.ascontiguousarray(column, dtype=np.int32) for column in columns]
+    arrays.append(np.ascontiguousarray(labels, dtype=np.uint8))
+    for opath, array in zip(pair_paths(odir, prefix, names), arrays):
+        if len(array) != len(arrays[-1]):
+            raise ValueError('Columns and labels of {} have different lengths!'.format(prefix))
+        with open(opath + '.tmp', 'wb') as wfile:
+            np.save(wfile, array)
+        os.replace(opath + '.tmp', opath)
+
+
+def load_pairs(odir, prefix, names, mmap_mode=None):
+    """Load the columns and the labels
+
+    :return: list of the columns and the labels
+    """
+    arrays = [np.load(path, mmap_mode=mmap_mode) for path in pair_paths(odir, prefix, names)]
+    return arrays[:-1], arrays[-1]
+
+
+def pair_batches(columns, labels, batch_size, shuffle=True):
+    """Batches of the pairs, the pairs are permuted once and the batches are views of the permuted arrays
+
+    :return: iterator over (list of the column slices, slice of the labels)
+    """
+    if shuffle:
+        order = np.random.permutation(len(labels))
+        columns = [column[order] for column in columns]
+        labels = labels[order]
+
+    for start in range(0, len(labels), batch_size):
+        yield [column[start: start + batch_size] for column in columns], labels[start: start + batch_size]
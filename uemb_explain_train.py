@@ -6,12 +6,9 @@ import sys
 import datetime
 import itertools
 
-from keras_preprocessing.text import Tokenizer
 from nltk.tokenize import RegexpTokenizer
 import numpy as np
 from tqdm import tqdm
-import gensim
-from keras.preprocessing.sequence import pad_sequences
 
 from transformers import BertTokenizer
 from torch.utils.tensorboard import SummaryWriter
@@ -20,30 +17,13 @@ import torch.nn as nn
 from transformers import AdamW, get_linear_schedule_with_warmup
 
 from uemb_explain_model import build_gru_model, CAUEgru, CAUEBert
-
-
-# because some documents can be extremely long
-def split_docs(doc, max_len=512):
-    """ let's split the document if its length is more than 512 token
-    :return:
-    """
-    if type(doc) == str:
-        doc = doc.split()
-    rand_max_len = np.random.randint(200, high=max_len)
-    rand_max_len -= 2  # for the two special tokens, start and end
-
-    docs = []
-    steps = len(doc) // rand_max_len
-    if len(doc) % rand_max_len != 0:
-        steps += 1
-
-    for idx in range(steps):
-        if idx == steps - 1 and len(doc[idx: rand_max_len * (idx + 1)]) < rand_max_len:
-            docs.append(' '.join(doc[rand_max_len * -1:]))  # to fill the last piece with full length
-        else:
-            docs.append(' '.join(doc[rand_max_len * idx: rand_max_len * (idx + 1)]))
-
-    return docs
+from emb_store import save_user_embs
+from concept_store import open_concept_store, store_path
+from build_cache import BuildCache, RecordCache, params_digest, record_digest
+from snippets import SnippetIndex, doc_key
+from token_corpus import FORMAT_VERSION as TOKEN_FORMAT_VERSION, TokenCorpus, open_token_corpus, slice_corpus
+from vocab import Vocab
+from pretrained_vectors import open_pretrained_vectors
 
 
 # because concepts are not well processed.
@@ -71,111 +51,96 @@ def concept_preprocessor(concepts):
 
 
 def build_concept_weights(params):
-    emb_path = params['emb_path']  # pretrained word embedding path
+    """Concept embeddings by the average pretrained vectors of the concept tokens,
+        the i-th row is the concept of index i in concept_tkn
+    """
     concept_tkn = pickle.load(open(params['concept_tkn_path'], 'rb'))
-
-    # derived by pretrained embeddings
-    # support three types, bin/txt/npy
-    emb_len = len(concept_tkn)
-    vector_size = -1
-    if emb_path.endswith('.bin'):
-        w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-            emb_path, binary=True
-        )
-        vector_size = w2v_model.vector_size
-
-    elif emb_path.endswith('.txt'):
-        w2v_model = {}
-
-        with open(emb_path) as dfile:
-            for line in dfile:
-                line = line.strip()
-                if len(line) < 10:
-                    continue
-                line = line.split()
-                word = line[0]
-                vectors = np.asarray(line[1:], dtype='float32')
-                if vector_size == -1:
-                    vector_size = len(vectors)
-                w2v_model[word] = vectors
-    else:
-        raise ValueError('Current other formats are not supported!')
-
-    emb_model = np.zeros((emb_len, vector_size))
-    for idx, concept in enumerate(list(concept_tkn.keys())):
-        tokens = concept.split()
-        vector = [w2v_model[token] for token in tokens if token in w2v_model]
-        if len(vector) > 1:
-            emb_model[idx] = np.average(vector, axis=0)
-        elif len(vector) == 1:
-            emb_model[idx] = vector[0]
-            del concept_tkn[concept]
+    concepts = sorted(concept_tkn, key=lambda concept: concept_tkn[concept])
+    emb_model = open_pretrained_vectors(params['emb_path']).compose(concepts)
 
     # save the extracted embedding weights
     np.save(params['concept_emb_path'], emb_model)
-    # if len(concept_tkn) != len(emb_model):
-    #     pickle.dump(concept_tkn, open(params['concept_tkn_path'], 'wb'))
 
 
 def build_emb_weights(tokenizer, emb_path, save_path):
-    """"""
-    # support three types, bin/txt/npy
-    emb_len = len(tokenizer.word_index)
+    """Extract the rows of the tokenizer vocabulary from the pretrained vectors, bin/txt"""
+    # index 0 is the padding, the known words are from 1 to num_words - 1
+    emb_len = len(tokenizer.word_index) + 1
     if emb_len > tokenizer.num_words:
         emb_len = tokenizer.num_words
 
-    if emb_path.endswith('.bin'):
-        w2v_model = gensim.models.KeyedVectors.load_word2vec_format(
-            emb_path, binary=True
-        )
-        emb_model = np.zeros((emb_len, w2v_model.vector_size))
-        for pair in zip(w2v_model.index_to_key, w2v_model.vectors):
-            if pair[0] in tokenizer.word_index and \
-                    tokenizer.word_index[pair[0]] < tokenizer.num_words:
-                emb_model[tokenizer.word_index[pair[0]]] = pair[1]
-
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-
-    elif emb_path.endswith('.txt'):
-        line = open(emb_path).readline()
-        emb_model = np.zeros((emb_len, len(line.strip().split()) - 1))  # first one is a word not vector.
-        emb_dim = len(line.strip().split()) - 1
-
-        with open(emb_path) as dfile:
-            for line in dfile:
-                line = line.strip().split()
-                word = line[0]
-                vectors = np.asarray(line[1:], dtype='float32')
-                if len(vectors) != emb_dim:
-                    continue
+    emb_model = open_pretrained_vectors(emb_path).embedding_matrix(tokenizer.word_index, emb_len)
+    # save the extracted embedding weights
+    np.save(save_path, emb_model)
 
-                if word in tokenizer.word_index and \
-                        tokenizer.word_index[word] < tokenizer.num_words:
-                    emb_model[tokenizer.word_index[word]] = vectors
 
-        # save the extracted embedding weights
-        np.save(save_path, emb_model)
-    else:
-        raise ValueError('Current other formats are not supported!')
+def build_user_record(user_entity, doc_concepts, min_score):
+    """Filtered concepts of each document of one user record, in the document order"""
+    results = []
+    for doc_entity in user_entity['docs']:
+        concepts = doc_concepts.get(doc_key(user_entity['uid'], doc_entity['doc_id']))
+        if concepts is not None:
+            # filter out low confident medical concepts
+            concepts = [item['preferred_name'].lower() for item in concepts if float(item['score']) > min_score]
+            # concepts = [item['preferred_name'] for item in concepts]
+            concepts = concept_preprocessor(concepts)
+        else:
+            concepts = []
+        results.append(concepts)
+    return results
 
 
 def data_builder(**kwargs):
+    """Build the user corpus, the concept and word tokenizers and their embedding weights.
+        Every stage is keyed by its inputs and parameters in the build cache of the output directory,
+        only the stages with changed keys are rebuilt, and user records are re-processed only if changed.
+        Snippets are cut by the offsets of the snippet index, each snippet has the concepts of its document.
+        The snippet token corpus is sliced from the token corpus of the documents, no snippet text is kept.
+    """
     output_dir = kwargs['odir']
-    if os.path.exists(output_dir + 'user_docs_concepts.pkl'):
-        loaded_data = pickle.load(open(output_dir + 'user_docs_concepts.pkl', 'rb'))
-        return loaded_data[0], loaded_data[1]  # user_corpus, all_docs
+    data_path = kwargs['data_dir'] + '{}.json'.format(kwargs['dname'])
+    store_dir = kwargs.get('concept_store_dir', store_path(kwargs['concept_dir']))
+    min_score = kwargs.get('min_concept_score', 3.6)
+    cache = BuildCache(output_dir)
+
+    index_path = output_dir + 'snippet_index.npz'
+    index_key = cache.key(inputs=[data_path], params={
+        'max_len': kwargs['max_len'], 'seed': kwargs['seed'], 'format_version': TOKEN_FORMAT_VERSION})
+    if cache.fresh('snippet_index', index_key, [index_path]):
+        snippet_index = SnippetIndex.load(index_path)
+    else:
+        snippet_index = SnippetIndex.build(data_path, max_len=kwargs['max_len'], seed=kwargs['seed'])
+        snippet_index.save(index_path)
+        cache.record('snippet_index', index_key, [index_path])
+
+    corpus_path = output_dir + 'user_docs_concepts.pkl'
+    counts_path = output_dir + 'concept_counts.json'
+    ranges_path = output_dir + 'snippet_ranges.npz'
+    corpus_key = cache.key(
+        inputs=[data_path, kwargs['user_stats_path'], store_dir + 'index.json', store_dir + 'vocab.json'],
+        params={'min_concept_score': min_score}, deps=[index_key]
+    )
+    if cache.fresh('user_docs', corpus_key, [corpus_path, counts_path, ranges_path]):
+        with open(corpus_path, 'rb') as dfile:
+            user_corpus = pickle.load(dfile)
+        concepts_info = None
     else:
         user_corpus = dict()
-        all_docs = []
         concepts_info = dict()  # will store concept count and index pair.
 
         user_stats_path = kwargs['user_stats_path']  # to encode users into indices
         user_encoder = json.load(open(user_stats_path))
-        concept_files = os.listdir(kwargs['concept_dir'])
+        # concepts are decoded per document for the changed records, the recent shards are cached
+        doc_concepts = open_concept_store(kwargs['concept_dir'], store_dir)
+        # processed records of the previous builds, concepts of unchanged users are not filtered again
+        records = RecordCache(output_dir + 'user_docs_records.pkl', params_digest({'min_concept_score': min_score}))
+        occurrences = dict()
+        # (document row, start, end) of the snippets, rows are in the token corpus of the documents
+        user_snippets = dict()
+        doc_row = 0
 
         # load dataset
-        with open(kwargs['data_dir'] + '{}.json'.format(kwargs['dname'])) as dfile:
+        with open(data_path) as dfile:
             for line in tqdm(dfile):
                 user_entity = json.loads(line)
 
@@ -185,35 +150,64 @@ def data_builder(**kwargs):
                         'docs': [],
                         'concepts': [],
                     }
-
-                uid = user_entity['uid'].split('-')[0]
-                for doc_entity in user_entity['docs']:
-                    snippets = split_docs(
-                        doc_entity['text'], max_len=kwargs['max_len'])
-                    for snippet in snippets:
-                        all_docs.append(snippet)
-                        # record the snippet index
-                        user_corpus[user_entity['uid']]['docs'].append(len(all_docs) - 1)
-                        user_corpus[user_entity['uid']]['concepts'].append([])
-
-                    did = doc_entity['doc_id']
-                    concept_fname = '{}_{}.pkl'.format(uid, did)
-
-                    if concept_fname in concept_files:
-                        concepts = pickle.load(open(kwargs['concept_dir'] + concept_fname, 'rb'))
-                        # filter out low confident medical concepts
-                        concepts = [item['preferred_name'].lower() for item in concepts if float(item['score']) > 3.6]
-                        # concepts = [item['preferred_name'] for item in concepts]
-                        concepts = concept_preprocessor(concepts)
-                        for concept in concepts:
-                            if concept not in concepts_info:
-                                concepts_info[concept] = 0
-                            concepts_info[concept] += 1
-
-                        user_corpus[user_entity['uid']]['concepts'].append(concepts)
-                    else:
-                        user_corpus[user_entity['uid']]['concepts'].append([])
-
+                occurrences[user_entity['uid']] = occurrences.get(user_entity['uid'], -1) + 1
+                record_id = '{}#{}'.format(user_entity['uid'], occurrences[user_entity['uid']])
+
+                # stored digests of the documents, only the records with changed concepts are decoded
+                digest = record_digest([
+                    doc_concepts.digest(doc_key(user_entity['uid'], doc_entity['doc_id']))
+                    for doc_entity in user_entity['docs']
+                ])
+                user_record = records.get(record_id, digest)
+                if user_record is None:
+                    user_record = build_user_record(user_entity, doc_concepts, min_score)
+                    records.put(record_id, digest, user_record)
+
+                for doc_entity, concepts in zip(user_entity['docs'], user_record):
+                    for concept in concepts:
+                        if concept not in concepts_info:
+                            concepts_info[concept] = 0
+                        concepts_info[concept] += 1
+
+                    starts, ends = snippet_index.offsets(doc_key(user_entity['uid'], doc_entity['doc_id']))
+                    user_snippets.setdefault(user_entity['uid'], []).extend(
+                        (doc_row, start, end, concepts) for start, end in zip(starts.tolist(), ends.tolist()))
+                    doc_row += 1
+
+        # snippets of a user are contiguous, the same order as the token corpus
+        uids = []
+        user_ptr = [0]
+        rows, starts, ends = [], [], []
+        for uid in user_corpus:
+            for row, start, end, concepts in user_snippets.get(uid, []):
+                # record the snippet index and its concepts
+                user_corpus[uid]['docs'].append(len(rows))
+                user_corpus[uid]['concepts'].append(list(concepts))
+                rows.append(row)
+                starts.append(start)
+                ends.append(end)
+            uids.append(uid)
+            user_ptr.append(len(rows))
+
+        records.save()
+        print('User records reused: {}, processed: {}'.format(records.hits, records.misses))
+        with open(corpus_path, 'wb') as wfile:
+            pickle.dump(user_corpus, wfile)
+        np.savez(
+            ranges_path, uids=np.asarray(uids, dtype=str), user_ptr=np.asarray(user_ptr, dtype=np.int64),
+            rows=np.asarray(rows, dtype=np.int64), starts=np.asarray(starts, dtype=np.int32),
+            ends=np.asarray(ends, dtype=np.int32)
+        )
+        # document level counts, in the order of their first occurrences
+        with open(counts_path, 'w') as wfile:
+            json.dump(list(concepts_info.items()), wfile)
+        cache.record('user_docs', corpus_key, [corpus_path, counts_path, ranges_path])
+
+    concept_key = cache.key(params={'vocab_size': kwargs['vocab_size']}, deps=[corpus_key])
+    if not cache.fresh('concept_tkn', concept_key, [kwargs['concept_tkn_path']]):
+        if concepts_info is None:
+            with open(counts_path) as dfile:
+                concepts_info = dict(json.load(dfile))
         # sort the concepts info, by its count
         concept_tkn = list(sorted(
             concepts_info.items(),
@@ -227,25 +221,51 @@ def data_builder(**kwargs):
         ))
         with open(kwargs['concept_tkn_path'], 'wb') as wfile:
             pickle.dump(concept_tkn, wfile)
+        cache.record('concept_tkn', concept_key, [kwargs['concept_tkn_path']])
+
+    concept_emb_key = cache.key(inputs=[kwargs['emb_path']], deps=[concept_key])
+    if not cache.fresh('concept_emb', concept_emb_key, [kwargs['concept_emb_path']]):
         build_concept_weights(kwargs)
+        cache.record('concept_emb', concept_emb_key, [kwargs['concept_emb_path']])
 
-        if not os.path.exists(kwargs['word_tkn_path']):
-            # 15000 known + 1 unknown tokens
-            # default value for this work is 15000
-            keras_tkn = Tokenizer(num_words=kwargs['vocab_size'] + 1)
-            keras_tkn.fit_on_texts(all_docs)
-            pickle.dump(keras_tkn, open(kwargs['word_tkn_path'], 'wb'))
-        else:
-            keras_tkn = pickle.load(open(kwargs['word_tkn_path'], 'rb'))
+    # snippets are the word ranges of the documents tokenized once, shared by the GRU model and the baselines
+    token_dir = output_dir + 'token_corpus/'
+    token_key = cache.key(params={'format_version': TOKEN_FORMAT_VERSION}, deps=[corpus_key])
+    if cache.fresh('token_corpus', token_key, [token_dir + 'meta.json']):
+        token_corpus = TokenCorpus(token_dir)
+    else:
+        doc_corpus = open_token_corpus(data_path)
+        with np.load(ranges_path) as dfile:
+            if len(dfile['rows']) > 0 and int(dfile['rows'].max()) >= doc_corpus.num_docs:
+                raise ValueError('Snippets of {} documents not in the token corpus!'.format(data_path))
+            token_corpus = slice_corpus(
+                token_dir, doc_corpus, dfile['uids'].tolist(), dfile['user_ptr'],
+                dfile['rows'], dfile['starts'], dfile['ends']
+            )
+        cache.record('token_corpus', token_key, [token_dir + 'meta.json'])
+
+    word_key = cache.key(params={'vocab_size': kwargs['vocab_size']}, deps=[token_key])
+    if not cache.fresh('word_tkn', word_key, [kwargs['word_tkn_path']]):
+        # 15000 known + 1 unknown tokens
+        # default value for this work is 15000
+        word_vocab = token_corpus.vocab(num_words=kwargs['vocab_size'] + 1)
+        word_vocab.save(kwargs['word_tkn_path'])
+        cache.record('word_tkn', word_key, [kwargs['word_tkn_path']])
+    else:
+        word_vocab = None
+
+    word_emb_key = cache.key(inputs=[kwargs['emb_path']], deps=[word_key])
+    if not cache.fresh('word_emb', word_emb_key, [kwargs['word_emb_path']]):
+        if word_vocab is None:
+            word_vocab = Vocab.load(kwargs['word_tkn_path'])
         build_emb_weights(
-            keras_tkn, kwargs['emb_path'], kwargs['word_emb_path'])
+            word_vocab, kwargs['emb_path'], kwargs['word_emb_path'])
+        cache.record('word_emb', word_emb_key, [kwargs['word_emb_path']])
 
-        with open(output_dir + 'user_docs_concepts.pkl', 'wb') as wfile:
-            pickle.dump([user_corpus, all_docs], wfile)
-        return user_corpus, all_docs
+    return user_corpus
 
 
-def user_doc_builder(user_docs, all_docs, params):
+def user_doc_builder(user_docs, params):
     max_len = params['max_len']
     concept_tkn = pickle.load(open(params['concept_tkn_path'], 'rb'))
     params['concept_size'] = len(concept_tkn)
@@ -253,26 +273,25 @@ def user_doc_builder(user_docs, all_docs, params):
     vocabs = None
 
     if params['method'] == 'caue_gru':
-        tokenizer = pickle.load(open(params['word_tkn_path'], 'rb'))
+        tokenizer = Vocab.load(params['word_tkn_path'])
     else:
         tokenizer = BertTokenizer.from_pretrained(params['bert_name'])
         vocabs = [item[1] for item in tokenizer.get_vocab().items()]
 
+    # snippets are the documents of the token corpus
+    token_corpus = TokenCorpus(params['odir'] + 'token_corpus/')
     if params['method'] == 'caue_gru':
         # GRU tokenizer
-        all_docs = pad_sequences(
-            tokenizer.texts_to_sequences(all_docs),
-            maxlen=params['max_len']
-        )
+        doc_inputs = token_corpus.padded(num_words=tokenizer.num_words, maxlen=params['max_len'])
         if not params['use_keras']:
-            all_docs = torch.tensor(all_docs)
+            doc_inputs = torch.tensor(doc_inputs)
     else:
         # BERT tokenizer
-        all_docs = [tokenizer.encode_plus(
+        doc_inputs = [tokenizer.encode_plus(
             doc_item, padding='max_length', max_length=max_len,
             return_tensors='pt', return_token_type_ids=False,
             truncation=True,
-        )['input_ids'][0] for doc_item in all_docs]
+        )['input_ids'][0] for doc_item in token_corpus.texts()]
 
     process = tqdm(list(user_docs.keys()))
     uids_docs = []
@@ -285,7 +304,7 @@ def user_doc_builder(user_docs, all_docs, params):
 
     # loop through each user
     for uid in process:
-        sample_doc_space = [idx for idx in range(len(all_docs)) if idx not in user_docs[uid]['docs']]
+        sample_doc_space = [idx for idx in range(len(doc_inputs)) if idx not in user_docs[uid]['docs']]
         user_concepts = set(list(itertools.chain.from_iterable(user_docs[uid]['concepts'])))
         sample_concept_space = [key for key in concept_tkn if key not in user_concepts]
 
@@ -297,7 +316,7 @@ def user_doc_builder(user_docs, all_docs, params):
             # documents
             if params['contrastive_ratio'] > 0 and contrastive_ratio < .2:
                 # contrastive samples on token level
-                contrastive_sample = all_docs[doc_idx]
+                contrastive_sample = doc_inputs[doc_idx]
 
                 # contrastive samples on token level
                 # if params['contrastive_level'] == 'token':
@@ -319,7 +338,7 @@ def user_doc_builder(user_docs, all_docs, params):
                     ud_labels.append(1)
                 uids_docs.append(user_encoder[uid])
             else:
-                docs.append(all_docs[doc_idx])
+                docs.append(doc_inputs[doc_idx])
                 ud_labels.append(1)
                 uids_docs.append(user_encoder[uid])
 
@@ -349,7 +368,7 @@ def user_doc_builder(user_docs, all_docs, params):
         sample_docs = np.random.choice(
             sample_doc_space, size=params['negative_sample'] * len(user_docs[uid]['docs']), replace=False
         )
-        docs.extend([all_docs[doc_idx] for doc_idx in sample_docs])
+        docs.extend([doc_inputs[doc_idx] for doc_idx in sample_docs])
         ud_labels.extend([0] * len(sample_docs))
         uids_docs.extend([user_encoder[uid]] * len(sample_docs))
 
@@ -433,9 +452,9 @@ def main(params):
     )
 
     print('Loading Dataset...')
-    user_corpus, all_docs = data_builder(**params)
+    user_corpus = data_builder(**params)
     print('Building Dataset...')
-    uids_docs, docs, ud_labels, uids_concepts, concepts, uc_labels = user_doc_builder(user_corpus, all_docs, params)
+    uids_docs, docs, ud_labels, uids_concepts, concepts, uc_labels = user_doc_builder(user_corpus, params)
     print(params)
 
     print('Building models...')
@@ -609,29 +628,29 @@ def main(params):
         # save the user embedding and the model
         if params['use_keras'] and params['method'] == 'caue_gru':
             caue_model.save(params['odir'] + '{}.model'.format(params['method']))
-            np.save(
-                params['odir'] + 'user_{}.npy'.format(epoch),
-                caue_model.get_layer(name='user_emb').get_weights()[0]
+            save_user_embs(
+                params['odir'], caue_model.get_layer(name='user_emb').get_weights()[0],
+                params['method'], params['user_stats_path'], epoch=epoch
             )
         else:
             torch.save(caue_model, params['odir'] + '{}.pth'.format(params['method']))
-            np.save(
-                params['odir'] + 'user_{}.npy'.format(epoch),
-                caue_model.uemb.weight.cpu().detach().numpy()
+            save_user_embs(
+                params['odir'], caue_model.uemb.weight.cpu().detach().numpy(),
+                params['method'], params['user_stats_path'], epoch=epoch
             )
 
     # save the user embedding and the model
     if params['use_keras'] and params['method'] == 'caue_gru':
         caue_model.save(params['odir'] + '{}.model'.format(params['method']))
-        np.save(
-            params['odir'] + 'user.npy',
-            caue_model.get_layer(name='user_emb').get_weights()[0]
+        save_user_embs(
+            params['odir'], caue_model.get_layer(name='user_emb').get_weights()[0],
+            params['method'], params['user_stats_path']
         )
     else:
         torch.save(caue_model, params['odir'] + '{}.pth'.format(params['method']))
-        np.save(
-            params['odir'] + 'user.npy',
-            caue_model.uemb.weight.cpu().detach().numpy()
+        save_user_embs(
+            params['odir'], caue_model.uemb.weight.cpu().detach().numpy(),
+            params['method'], params['user_stats_path']
         )
     writer.close()
 
@@ -667,6 +686,7 @@ if __name__ == '__main__':
     parser.add_argument('--ng_num', type=int, help='Number of negative samples', default=2)
     parser.add_argument('--batch_size', type=int, help='Batch size', default=32)
     parser.add_argument('--max_len', type=int, help='Max length', default=512)
+    parser.add_argument('--seed', type=int, help='Seed of the snippet lengths', default=0)
     parser.add_argument('--emb_dim', type=int, help='Embedding dimensions', default=300)
     parser.add_argument('--device', type=str, help='cpu or cuda')
     parser.add_argument('--c_ratio', type=float, help='Contrastive ratio', default=0.2)
@@ -714,6 +734,7 @@ if __name__ == '__main__':
         'lr': args.lr,
         'negative_sample': args.ng_num,
         'max_len': args.max_len,
+        'seed': args.seed,
         # 'emilyalsentzer/Bio_ClinicalBERT'
         # 'bionlp/bluebert_pubmed_mimic_uncased_L-12_H-768_A-12'
         # 'bionlp/bluebert_pubmed_uncased_L-12_H-768_A-12'
@@ -727,7 +748,7 @@ if __name__ == '__main__':
         'device': args.device,
         'vocab_size': 15000,
         'concept_tkn_path': data_dir + 'concept_tkn.pkl',
-        'word_tkn_path': data_dir + 'word_tkn.pkl',
+        'word_tkn_path': data_dir + 'word_vocab.json',
         'concept_sample_size': 33,  # to sample the number per document for training, prevent too many
         'use_concept': args.use_concept,
         'use_keras': args.use_keras,
@@ -0,0 +1,202 @@
+"""Word vocabulary with the num_words semantics of the Keras Tokenizer
+
+Words are split as text_to_word_sequence of Keras with its default filters and lower=True, the same as the
+token corpus, keras_filters=False splits the texts by whitespace only.
+Ids start from 1 by the descending counts, ties in the order of first occurrences, 0 is left for padding,
+and only ids under num_words are kept when encoding. The vocabulary is saved as a small json file:
+    {"num_words": 15001, "document_count": 1000, "words": [...], "counts": [...]}
+The attributes word_index, index_word, word_counts and num_words are the same as the Keras Tokenizer.
+"""
+import json
+import os
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+# default filters of the Keras Tokenizer, every character is replaced by a space
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+FILTER_TABLE = str.maketrans(KERAS_FILTERS, ' ' * len(KERAS_FILTERS))
+
+# word -> id and the filter option of the worker processes
+worker_index = None
+worker_filters = True
+
+
+def text_to_words(text, keras_filters=True):
+    """Words of a text, the same as text_to_word_sequence of Keras with the default filters and lower=True
+
+    :param keras_filters: False to split by whitespace only
+    """
+    if not keras_filters:
+        return text.split()
+    return [word for word in text.lower().translate(FILTER_TABLE).split(' ') if word]
+
+
+def count_block(texts, keras_filters=True):
+    counts = Counter()
+    for text in texts:
+        counts.update(text_to_words(text, keras_filters))
+    return counts, len(texts)
+
+
+def init_worker(word_index, num_words, keras_filters=True):
+    global worker_index, worker_filters
+    worker_index = dict((word, idx) for word, idx in word_index.items() if idx < num_words)
+    worker_filters = keras_filters
+
+
+def encode_block(texts):
+    """Flat int32 ids and the lengths of the texts"""
+    ids = []
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for tdx, text in enumerate(texts):
+        seq = [worker_index[word] for word in text_to_words(text, worker_filters) if word in worker_index]
+        ids.extend(seq)
+        lengths[tdx] = len(seq)
+    return np.asarray(ids, dtype=np.int32), lengths
+
+
+def iter_blocks(texts, block_size):
+    block = []
+    for text in texts:
+        block.append(text)
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if len(block) > 0:
+        yield block
+
+
+def pad_ragged(ids, ptr, maxlen, value=0):
+    """Pad the ragged sequences into a matrix, the same as pad_sequences with the pre padding and truncating
+
+    :param ids: flat int array of the sequences
+    :param ptr: the i-th sequence is ids[ptr[i]:ptr[i+1]]
+    :param maxlen: number of columns
+    :return: int32 matrix of (len(ptr) - 1, maxlen)
+    """
+    ptr = np.asarray(ptr, dtype=np.int64)
+    lengths = np.minimum(np.diff(ptr), maxlen)
+    matrix = np.full((len(lengths), maxlen), value, dtype=np.int32)
+    # the last maxlen ids of every sequence, aligned to the right
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    matrix[rows, maxlen - np.repeat(lengths, lengths) + offsets] = \
+        ids[np.repeat(ptr[1:] - lengths, lengths) + offsets]
+    return matrix
+
+
+class Vocab(object):
+    """Frequency ranked vocabulary
+
+        Parameters
+        ----------
+        words: list
+            Words by the descending counts
+        counts: list
+            Counts of the words
+        num_words: int
+            Number of ids to keep, including the padding, None to keep all words
+        document_count: int
+            Number of texts the vocabulary was fitted on
+        keras_filters: bool
+            Split the texts as the Keras Tokenizer, False to split by whitespace only
+    """
+    def __init__(self, words, counts, num_words=None, document_count=0, keras_filters=True):
+        self.words = list(words)
+        self.counts = list(counts)
+        self.num_words = num_words if num_words is not None else len(self.words) + 1
+        self.document_count = document_count
+        self.keras_filters = keras_filters
+        self.word_index = dict((word, idx + 1) for idx, word in enumerate(self.words))
+        self.index_word = dict((idx + 1, word) for idx, word in enumerate(self.words))
+        self.word_counts = OrderedDict(zip(self.words, self.counts))
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def from_counts(cls, word_counts, num_words=None, document_count=0, keras_filters=True):
+        """Vocabulary of the word counts, dict keys are in the order of first occurrences"""
+        # stable sort, ties keep the order of first occurrences
+        words = sorted(word_counts, key=lambda word: word_counts[word], reverse=True)
+        return cls(words, [word_counts[word] for word in words], num_words, document_count, keras_filters)
+
+    @classmethod
+    def fit(cls, texts, num_words=None, num_workers=1, block_size=10000, keras_filters=True):
+        """Count the words of the texts by blocks, the blocks are merged in order
+
+        :param texts: iterable of texts
+        :param num_workers: number of processes, 1 to count in the current process
+        :param keras_filters: split as the Keras Tokenizer, False to split by whitespace only
+        """
+        word_counts = Counter()
+        document_count = 0
+        blocks = iter_blocks(texts, block_size)
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                for counts, num_texts in pool.imap(partial(count_block, keras_filters=keras_filters), blocks):
+                    word_counts.update(counts)
+                    document_count += num_texts
+        else:
+            for block in blocks:
+                counts, num_texts = count_block(block, keras_filters)
+                word_counts.update(counts)
+                document_count += num_texts
+        return cls.from_counts(word_counts, num_words, document_count, keras_filters)
+
+    def texts_to_sequences(self, texts):
+        init_worker(self.word_index, self.num_words, self.keras_filters)
+        return [encode_block([text])[0].tolist() for text in texts]
+
+    def encode(self, texts, maxlen, num_workers=1, block_size=10000):
+        """Encode and pad the texts into a preallocated int32 matrix of (len(texts), maxlen),
+            the blocks are written into the matrix as they are encoded
+
+        :param texts: list of texts
+        """
+        matrix = np.zeros((len(texts), maxlen), dtype=np.int32)
+        blocks = iter_blocks(texts, block_size)
+        pool = None
+        if num_workers > 1:
+            pool = Pool(
+                num_workers, initializer=init_worker, initargs=(self.word_index, self.num_words, self.keras_filters)
+            )
+            results = pool.imap(encode_block, blocks)
+        else:
+            init_worker(self.word_index, self.num_words, self.keras_filters)
+            results = (encode_block(block) for block in blocks)
+
+        try:
+            row = 0
+            for ids, lengths in results:
+                ptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+                ptr[1:] = np.cumsum(lengths)
+                matrix[row: row + len(lengths)] = pad_ragged(ids, ptr, maxlen)
+                row += len(lengths)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return matrix
+
+    def save(self, opath):
+        with open(opath + '.tmp', 'w') as wfile:
+            json.dump({
+                'num_words': self.num_words,
+                'document_count': self.document_count,
+                'keras_filters': self.keras_filters,
+                'words': self.words,
+                'counts': self.counts,
+            }, wfile)
+        os.replace(opath + '.tmp', opath)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as dfile:
+            vocab = json.load(dfile)
+        return cls(
+            vocab['words'], vocab['counts'], vocab['num_words'], vocab['document_count'],
+            vocab.get('keras_filters', True)
+        )